@@ -5,9 +5,15 @@
 
 """The main program"""
 import os
+import time
 from . import testsuite
+from .config import Config
+from .discovery import DiscoveryIndex, indexPath
+from .history import loadHistory
+from .report import findResults, getWriter, loadDurations, loadFixtureDurations
 from .topo import Topo
-from .log import setLogPath
+from .log import log, setLogPath
+from .watch import getWatcher
 
 
 def run(testcases=[],
@@ -22,7 +28,21 @@ def run(testcases=[],
         dryrun=False,
         pause_on_fail=False,
         log_path='.',
-        recursive=False):
+        recursive=False,
+        lazy_connect=None,
+        shared_fixture=False,
+        row_workers=None,
+        reports=[],
+        topo_workers=None,
+        shard=None,
+        history=[],
+        order=None,
+        discover_only=False,
+        rerun_failed=False,
+        rerun_from=None,
+        changed_since=None,
+        changed_files=None,
+        keep_fixtures=False):
     """Run a test
     :param testcases: the testcases to run, by default is to run all found testcases
     :param pathes: the path or script where to find testcases, by default is current path and syspath
@@ -37,6 +57,22 @@ def run(testcases=[],
     :param pause_on_fail: enter pdb when testcase fails, default False
     :param log_path: Path for chorus log files, '.' by default
     :param recursive: recursive search the testcases from the pathes, default False
+    :param lazy_connect: connect devices on first use and prewarm used ones in background, by testcase by default
+    :param shared_fixture: run all rows of the data file with the fixtures called only once, default False
+    :param row_workers: max count of data rows running at the same time with shared fixtures, one by default
+    :param reports: extra result files in format of `<format>[:<path>]`, besides those in `report.writers` config
+    :param topo_workers: run cases of different topologies in this many worker processes at the same time
+    :param shard: (i, n), run only the i-th of n shards of the cases, from 1
+    :param history: result files of former runs, by whose durations cases are scheduled and shards are balanced,
+        the history kept under the log path by default
+    :param order: order cases by the history under the log path, `failed-first` or `longest-first`
+    :param discover_only: find testcases and report the time taken only, without running them
+    :param rerun_failed: run the testcases not passed in a former run again, instead of those specified
+    :param rerun_from: uuid of the former run or path of its result file (jsonl), the latest run by default
+    :param changed_since: run only the testcases affected by changes since a git reference or a time
+    :param changed_files: run only the testcases affected by changes of these files
+    :param keep_fixtures: keep the fixtures of the last case of each topology initialized if the topology is kept
+        warm, to be reused by the next run in the same process
 
     :rtype: bool
     :return: the result of the case
@@ -46,8 +82,22 @@ def run(testcases=[],
     # testcase definitions
     if not pathes:
         pathes = ["."]
+    start = time.time()
     suite = testsuite.Testsuite(
         pathes, base_path=base_path, recursive=recursive)
+    if discover_only:
+        d = suite.discovery
+        log.info("Discovered %d testcases in %.3fs", len(suite._case_class), time.time() - start)
+        log.info("  walk: %.3fs for %d modules", d["walk_sec"], d["modules"])
+        log.info("  scan: %.3fs, %d parsed, %d unchanged", d["scan_sec"], d["parsed"], d["unchanged"])
+        log.info("  resolve: %.3fs", d["resolve_sec"])
+        log.info("  import: %.3fs for %d modules not resolved", d["import_sec"], d["imported"])
+        return True
+    # result files
+    for spec in (Config().get_config("report", "writers") or []) + list(reports):
+        writer = getWriter(spec)
+        if writer is not None:
+            suite.addWriter(writer)
     # extra arguments
     test_params = {}
     for pair in extra_params:
@@ -57,7 +107,18 @@ def run(testcases=[],
     for t in set(topo_files):
         Topo.addTopo(os.path.join(base_path, t))
     # Load testcases
-    if len(suite_files) > 0:
+    if rerun_failed:
+        # results of a former run
+        result_file = findResults(rerun_from)
+        if result_file is None:
+            log.error("No result file found of %s", "run %s" % rerun_from if rerun_from else "former runs")
+            return False
+        if not suite.loadFailedResults(result_file, test_params):
+            return False
+        if not suite.cases:
+            log.info("No failed testcases to run again in %s", result_file)
+            return True
+    elif len(suite_files) > 0:
         # suite files
         if len(topo_files) == 0:
             for sfile in suite_files:
@@ -69,10 +130,25 @@ def run(testcases=[],
             suite.loadSuiteFile(s, test_params)
     elif data_file:
         # data file
-        suite.loadDataFile(data_file, testcases, test_params)
+        suite.loadDataFile(data_file, testcases, test_params,
+                           shared_fixture=shared_fixture, row_workers=row_workers)
     else:
         # default testcase run
         suite.loadTestcaseReg(testcases, test_params, per_case_params)
+    if changed_since and not suite.selectChanged(changed_since):
+        return False
+    if changed_files is not None:
+        suite.selectAffected(changed_files, "on save")
+    suite.keep_fixtures = keep_fixtures
+    suite.history = loadHistory()
+    if history:
+        suite.fixture_durations = loadFixtureDurations(history)
+        durations = loadDurations(history)
+    else:
+        suite.fixture_durations = suite.history.fixtures
+        durations = suite.history.durations()
+    if shard:
+        suite.shard(shard[0], shard[1], durations or None)
 
     # 3. run the case
     if debug:
@@ -86,6 +162,54 @@ def run(testcases=[],
         print("  You are now in pdb shell.")
         print("  Press 'c' to continue to your testcase steps.")
         print(mark)
-        return p.run('suite.run(dryrun, pause_on_fail)', globals(), locals())
+        return p.run('suite.run(dryrun, pause_on_fail, lazy_connect=lazy_connect, order=order)', globals(), locals())
     else:
-        return suite.run(dryrun, pause_on_fail)
+        return suite.run(dryrun, pause_on_fail, lazy_connect=lazy_connect, topo_workers=topo_workers, order=order)
+
+
+def watch(pathes=["."], base_path='.', recursive=False, **kwargs):
+    """Run testcases, then run those affected by changes of the modules in `pathes` again on each save, until
+    interrupted, see :mod:`chorus.watch`. Topologies are kept connected between runs, the modules not changed are
+    not imported again, and the fixtures of the last case of a topology are reused if the chain of the next case
+    starts with them.
+
+    :param kwargs: the other parameters of :func:`run`
+    :return: the result of the last run
+    """
+    if not pathes:
+        pathes = ["."]
+    folders = set()
+    for p in pathes:
+        p = os.path.join(base_path, p)
+        folders.add(p if os.path.isdir(p) else os.path.dirname(p) or ".")
+    if kwargs.get("topo_workers"):
+        log.warn("Topologies are run one by one in watch mode, to keep them connected.")
+        kwargs["topo_workers"] = None
+    watcher = getWatcher(sorted(folders), recursive, Config().get_config("discovery", "ignore") or [])
+    uuid = Config().get_uuid()
+    Topo.keep_warm = True
+    testsuite.Testsuite.module_cache = {}
+    changed = None
+    runs = 0
+    rslt = None
+    try:
+        while True:
+            rslt = run(pathes=pathes, base_path=base_path, recursive=recursive,
+                       changed_files=changed, keep_fixtures=True, **kwargs)
+            runs += 1
+            # changes since are run only once
+            kwargs["changed_since"] = None
+            log.info("Watching %s for changes, press Ctrl-C to stop.", ", ".join(sorted(folders)))
+            changed = watcher.wait()
+            forgotten = testsuite.Testsuite.forgetModules(changed, DiscoveryIndex.get(indexPath()))
+            log.info("%d files changed, %d modules to import again: %s", len(changed), forgotten, ", ".join(changed))
+            # each run logs to files of its own
+            Config().renew_uuid("%s_%d" % (uuid, runs))
+    except KeyboardInterrupt:
+        log.info("Stopped watching after %d runs.", runs)
+    finally:
+        watcher.close()
+        Topo.cleanWarm()
+        Topo.keep_warm = False
+        testsuite.Testsuite.module_cache = None
+    return rslt
@@ -12,8 +12,12 @@ import subprocess
 import argparse
 from .repository import Repository
 from . import chorus
-from .log import log, logcls, get_log_files
+from .log import log, logcls, get_log_files, setLogPath
 from .config import Config
+from .report import getWriter, loadResults
+from .scheduler import ORDERS
+from .server import attach, serve
+from .testcase import Testcase
 
 
 def main():
@@ -24,6 +28,8 @@ def main():
         run: run chorus script
         debug: debug a chorus script
         lastlog: show the last Nth chorus log in current folder
+        merge-results: merge result files of shards into one report
+        serve: run chorus as a daemon keeping testcases and topologies warm, for `chorus run --attach`
         <module>: module specific commands
     """
 
@@ -165,6 +171,17 @@ class Run(CLI):
             help="The topology file (suite file name plus .topo by default), can occur multi times")
         parser.add_argument("-d", "--data", dest="data_file",
                             help="The data file ")
+        parser.add_argument(
+            "--shared-fixture",
+            dest="shared_fixture",
+            action="store_true",
+            help="Run all rows of the data file in one testcase, calling its fixtures only once.")
+        parser.add_argument(
+            "--row-workers",
+            dest="row_workers",
+            type=int,
+            default=None,
+            help="Max count of data rows running at the same time with --shared-fixture, one by default.")
         parser.add_argument(
             "--repo-uri",
             dest="repo_uri",
@@ -207,11 +224,109 @@ class Run(CLI):
             dest="recursive",
             action="store_true",
             help="Recursively search the test cases")
+        parser.add_argument(
+            "--lazy-connect",
+            dest="lazy_connect",
+            action="store_const",
+            const=True,
+            default=None,
+            help="Connect topology devices on first use, and the used ones in background.")
+        parser.add_argument(
+            "--keepalive",
+            dest="keepalive",
+            type=float,
+            default=None,
+            help="Probe device connections idle for this many seconds, and reopen the dead ones in background.")
+        parser.add_argument(
+            "--topo-workers",
+            dest="topo_workers",
+            type=int,
+            default=None,
+            help="Run cases of different topologies in this many worker processes at the same time.")
+        parser.add_argument(
+            "--shard",
+            dest="shard",
+            type=_shard,
+            default=None,
+            help="Run only the i-th of N shards of the cases in format of \"i/N\", "
+                 "cases of the same topology are in the same shard.")
+        parser.add_argument(
+            "--history",
+            "--shard-history",
+            dest="history",
+            action="append",
+            default=[],
+            help="Result files (jsonl) of former runs, to schedule cases by fixture durations and balance shards "
+                 "by case durations, instead of the history under the log path. May occur multi times.")
+        parser.add_argument(
+            "--order",
+            dest="order",
+            choices=ORDERS,
+            default=None,
+            help="Order cases by the history of former runs, recently failed ones or long running ones first. "
+                 "Cases sharing topologies and fixtures are still kept together.")
+        parser.add_argument(
+            "--rerun-failed",
+            dest="rerun_failed",
+            action="store_true",
+            default=False,
+            help="Run the testcases failed or aborted in a former run again, with the same arguments.")
+        parser.add_argument(
+            "--from",
+            dest="rerun_from",
+            default=None,
+            help="UUID of the former run, or path of its result file (jsonl), for --rerun-failed. "
+                 "The latest run in the log path by default.")
+        parser.add_argument(
+            "--attach",
+            dest="attach",
+            nargs="?",
+            const="",
+            default=None,
+            help="Run on the chorus daemon started by `chorus serve`, whose topologies are kept warm. "
+                 "The socket of the daemon can be specified, serve.socket in chorus.config by default.")
+        parser.add_argument(
+            "--watch",
+            dest="watch",
+            action="store_true",
+            help="Keep running: watch the script folders, and run the testcases affected by changes again on each "
+                 "save, with topologies kept connected. Changed modules are imported again only, and fixtures are "
+                 "reused if not changed. Backend and polling interval are configured by watch in chorus.config.")
+        parser.add_argument(
+            "--changed-since",
+            dest="changed_since",
+            default=None,
+            help="Run only the testcases affected by changes since a git reference, or a time in seconds since "
+                 "the epoch or in ISO format, i.e. origin/master or 2019-06-01T08:00. A testcase is affected if "
+                 "its module imports a changed module, directly or not.")
+        parser.add_argument(
+            "--discover-only",
+            dest="discover_only",
+            action="store_true",
+            default=False,
+            help="Find testcases and show the time taken by each step of discovery, without running them.")
+        parser.add_argument(
+            "--report",
+            dest="reports",
+            action="append",
+            default=[],
+            help="Write results to a file as each testcase finishes, in format of \"<format>[:<path>]\", "
+                 "i.e. junit or jsonl:results.jsonl. May occur multi times.")
         parser.add_argument("pos_pathes", nargs="*", help="testscripts")
 
     @classmethod
     def run(cls, args):
         """Command running logic"""
+        if args.watch and (args.attach is not None or args.rerun_failed or args.discover_only):
+            print("--watch takes no effect with --attach, --rerun-failed or --discover-only")
+            return CLI.ERR_ARG
+
+        if args.attach is not None:
+            if args.debug or args.pause_on_fail:
+                print("Debugging is not supported on chorus daemon")
+                return CLI.ERR_ARG
+            rslt = attach(args, args.attach or None)
+            return CLI.ERR_EXP if rslt is None else rslt
         if args.repo_type == '?':
             rptypes = Repository.listTypes()
             print("Supported repository types:")
@@ -222,28 +337,48 @@ class Run(CLI):
             base_path = Repository.syncPath(
                 type=args.repo_type, uri=args.repo_uri)
 
-        if not args.topo_files and len(args.suite_files) == 0:
+        if not args.topo_files and len(args.suite_files) == 0 and not args.discover_only:
             print("Please specify topology files")
             return CLI.ERR_ARG
 
+        if args.rerun_from and not args.rerun_failed:
+            print("--from takes effect with --rerun-failed only")
+            return CLI.ERR_ARG
+
         if len(args.suite_files) > 0 and args.data_file:
             print("Data file will not take effect when suite file specifed")
             return CLI.ERR_ARG
 
+        if args.keepalive is not None:
+            Config().set_config("topo", "keepalive", args.keepalive)
+
         try:
             args.pathes += args.pos_pathes
-            rslt = chorus.run(testcases=args.testcase,
-                              pathes=args.pathes,
-                              topo_files=args.topo_files,
-                              data_file=args.data_file,
-                              suite_files=args.suite_files,
-                              extra_params=args.extra_params,
-                              debug=args.debug,
-                              dryrun=args.dryrun,
-                              pause_on_fail=args.pause_on_fail,
-                              base_path=base_path,
-                              log_path=args.log_path,
-                              recursive=args.recursive)
+            runner = chorus.watch if args.watch else chorus.run
+            rslt = runner(testcases=args.testcase,
+                          pathes=args.pathes,
+                          topo_files=args.topo_files,
+                          data_file=args.data_file,
+                          suite_files=args.suite_files,
+                          extra_params=args.extra_params,
+                          debug=args.debug,
+                          dryrun=args.dryrun,
+                          pause_on_fail=args.pause_on_fail,
+                          base_path=base_path,
+                          log_path=args.log_path,
+                          recursive=args.recursive,
+                          lazy_connect=args.lazy_connect,
+                          shared_fixture=args.shared_fixture,
+                          row_workers=args.row_workers,
+                          reports=args.reports,
+                          topo_workers=args.topo_workers,
+                          shard=args.shard,
+                          history=args.history,
+                          order=args.order,
+                          discover_only=args.discover_only,
+                          rerun_failed=args.rerun_failed,
+                          rerun_from=args.rerun_from,
+                          changed_since=args.changed_since)
             if rslt:
                 return CLI.PASS
             else:
@@ -253,6 +388,17 @@ class Run(CLI):
             return CLI.ERR_EXP
 
 
+def _shard(value):
+    """Parse \"i/N\" of --shard"""
+    try:
+        i, n = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard should be in format of i/N: %s" % value)
+    if n < 1 or not 1 <= i <= n:
+        raise argparse.ArgumentTypeError("shard should be 1 to N: %s" % value)
+    return i, n
+
+
 class Debug(Run):
     """Debug class, inherates run with -D argument set by default"""
     help = "Debug chorus script"
@@ -351,3 +497,87 @@ class Log(CLI):
                 return CLI.PASS
             else:
                 return CLI.ERR_EXP
+
+
+class MergeResults(CLI):
+    """Merge result files of shards into one report"""
+    help = "Merge result files (jsonl) of shards into one report"
+
+    @classmethod
+    def extend(cls, parser):
+        """cli extending logic
+
+        :param parser: the command line parser instance, refer to [argparse](https://docs.python.org/2/library/argparse.html#action)
+        """
+        parser.add_argument(
+            "-o",
+            "--output",
+            dest="outputs",
+            action="append",
+            default=[],
+            help="Merged result file in format of \"<format>[:<path>]\", i.e. junit:merged.xml. "
+                 "May occur multi times, junit:merged.xml by default.")
+        parser.add_argument("files", nargs="+", help="result files (jsonl) of the shards")
+
+    @classmethod
+    def run(cls, args):
+        """Command running logic"""
+        writers = []
+        for spec in args.outputs or ["junit:merged.xml"]:
+            writer = getWriter(spec)
+            if writer is None:
+                return CLI.ERR_ARG
+            if ":" not in spec:
+                writer.path = "merged" + writer.extension
+            writers.append(writer)
+        counts = {}
+        for w in writers:
+            w.open()
+        try:
+            for f in args.files:
+                for case, result, rcode in loadResults(f):
+                    for w in writers:
+                        w.write(case, result, rcode)
+                    status = Testcase.STATES[rcode]
+                    counts[status] = counts.get(status, 0) + 1
+        finally:
+            for w in writers:
+                w.close()
+        print("Merged %d cases from %d files: %s" % (
+            sum(counts.values()), len(args.files),
+            ", ".join("%s %d" % (k, counts[k]) for k in sorted(counts))))
+        for status in counts:
+            if status not in [Testcase.STATES[Testcase.PASS], Testcase.STATES[Testcase.SKIPPED]]:
+                return CLI.ERR_RUN
+        return CLI.PASS
+
+
+class Serve(CLI):
+    """Run chorus as a daemon: `chorus serve`"""
+    help = "Run chorus as a daemon keeping testcases and topologies warm, for `chorus run --attach`"
+
+    @classmethod
+    def extend(cls, parser):
+        """cli extending logic
+
+        :param parser: the command line parser instance, refer to [argparse](https://docs.python.org/2/library/argparse.html#action)
+        """
+        parser.add_argument(
+            "-s",
+            "--socket",
+            dest="socket",
+            default=None,
+            help="Path of the socket to serve on, serve.socket in chorus.config by default.")
+        parser.add_argument(
+            "--log-path",
+            dest="log_path",
+            default=".",
+            help="Log path of the daemon, runs log to the log path of their own.")
+
+    @classmethod
+    def run(cls, args):
+        """Command running logic"""
+        setLogPath(args.log_path)
+        if serve(Run.run, args.socket):
+            return CLI.PASS
+        return CLI.ERR_EXP
@@ -140,6 +140,10 @@ class Config(metaclass=Singleton):
     def get_uuid(self):
         return self.uuid
 
+    def renew_uuid(self, uuid):
+        """Change the uuid for another run in the same process, i.e. by `chorus serve`"""
+        self._uuid = uuid
+
     def get_config(self, module, key):
         """Get config item
             config should in a two level format
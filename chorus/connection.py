@@ -11,6 +11,7 @@ from .log import log, getLogPrefix, sleep
 import os
 import sys
 import time
+import threading
 import pexpect
 import re
 import traceback
@@ -27,6 +28,60 @@ COLOR_FILTER = re.compile(r"\x1B\[(\d{1,2}(;\d{1,2})*)?[mA-Z]")
 dummy_conn = False
 
 
+class IOStats(object):
+    """Counters of device I/O, collected for the threads it is attached to by `setIOStats`"""
+
+    def __init__(self):
+        self.io_sec = 0.0
+        self.cmd_count = 0
+        self.bytes_recv = 0
+        self._lock = threading.Lock()
+
+    def add(self, io_sec, nbytes):
+        with self._lock:
+            self.io_sec += io_sec
+            self.cmd_count += 1
+            self.bytes_recv += nbytes
+
+
+_io_local = threading.local()
+
+
+def getIOStats():
+    """Get the I/O counters attached to current thread, None if not attached"""
+    return getattr(_io_local, "stats", None)
+
+
+def setIOStats(stats):
+    """Attach I/O counters to current thread, None to detach
+
+    :return: the counters attached formerly
+    """
+    old = getIOStats()
+    _io_local.stats = stats
+    return old
+
+
+def getCancelEvent():
+    """Get the cancel event attached to current thread, None if not attached"""
+    return getattr(_io_local, "cancel", None)
+
+
+def setCancelEvent(event):
+    """Attach a cancel event to current thread, None to detach.
+    Commands sent from the thread are cancelled once the event is set.
+
+    :return: the event attached formerly
+    """
+    old = getCancelEvent()
+    _io_local.cancel = event
+    return old
+
+
+# how often a command checks its cancel event, in seconds
+CANCEL_POLL_SEC = 1
+
+
 class Connection(object):
     """Base interface for connections
     """
@@ -38,6 +93,10 @@ class Connection(object):
     def __init__(self):
         super(Connection, self).__init__()
         self._opened = False
+        # time of the last command, used to find idle connections
+        self.last_active = time.time()
+        # held while a command is running, so that keepalive probes do not interleave
+        self.busy = threading.RLock()
 
     def open(self):
         self._opened = True
@@ -53,6 +112,19 @@ class Connection(object):
     def cmd(self, cmd):
         pass
 
+    def _recordIO(self, start, nbytes):
+        """Count a command to the I/O counters of current thread"""
+        stats = getIOStats()
+        if stats is not None:
+            stats.add(time.time() - start, nbytes)
+
+    def probe(self, timeout=5):
+        """Check if the connection is still usable with a cheap no-op
+
+        :return: True if the connection is alive
+        """
+        return self.isOpen()
+
     def isOpen(self):
         return self._opened
 
@@ -82,10 +154,12 @@ class DummyConnection(Connection):
         super(DummyConnection, self).reopen(delay)
 
     def cmd(self, cmd, *args, **kwargs):
+        self.last_active = time.time()
         log.debug("Command for dummy connection %s received:" % self.name)
         log.debug("  %s" % cmd)
         log.debug("  %s" % ",".join(args))
         log.debug("  %s" % kwargs)
+        self._recordIO(self.last_active, len(cmd))
         # echo the command
         return cmd
 
@@ -261,6 +335,11 @@ class PexpectConnection(Connection):
                 self._clear_echo(cmd)
         if l <= len(cmd):
             log.warning("Command is partially sent: %s", cmd)
+        # wake up regularly to check cancellation
+        cancel = getCancelEvent()
+        exp_timeout = int(timeout)
+        if cancel is not None:
+            exp_timeout = min(exp_timeout, CANCEL_POLL_SEC)
 
         mid_size = len(mid_prompts.keys())
         # Do not match line wraps, in case mid_prompt may container multi-line
@@ -273,7 +352,9 @@ class PexpectConnection(Connection):
                 [prompt, pexpect.EOF, pexpect.TIMEOUT, "[\r\n]+"]
 
         while True:
-            i = self._exp.expect(exp_prompts, timeout=int(timeout))
+            if cancel is not None and cancel.is_set():
+                raise ConnCancelException("command cancelled.")
+            i = self._exp.expect(exp_prompts, timeout=exp_timeout)
             if i < mid_size:
                 to = to + len(self._exp.before) + len(self._exp.after)
                 k = list(mid_prompts.keys())[i]
@@ -365,37 +446,70 @@ class PexpectConnection(Connection):
             clean_timeout=True):
         """A cmd method with retries"""
         out = ""
+        start = time.time()
         # Do not try to reopen connection here, leave it to the upper layer,
         # because there may be initial command to be issued
-        try:
-            for c in cmd.strip().splitlines():
-                out += self._cmd(c,
-                                 prompt,
-                                 mid_prompts,
-                                 mid_ignore,
-                                 timeout,
-                                 control=control,
-                                 nonewline=nonewline,
-                                 failcontinue=failcontinue)
-            return out
-        except ConnTimeoutException:
-            log.error("Send command error due to timeout: %s", cmd)
-            if clean_timeout:
-                log.debug("Clean current process on timeout")
+        with self.busy:
+            try:
+                for c in cmd.strip().splitlines():
+                    out += self._cmd(c,
+                                     prompt,
+                                     mid_prompts,
+                                     mid_ignore,
+                                     timeout,
+                                     control=control,
+                                     nonewline=nonewline,
+                                     failcontinue=failcontinue)
+                return out
+            except ConnTimeoutException:
+                log.error("Send command error due to timeout: %s", cmd)
+                if clean_timeout:
+                    log.debug("Clean current process on timeout")
+                    self._cmd('c', control=True)
+            except ConnCloseException:
+                log.debug("Send command error due to connection closed: %s", cmd)
+            except ConnCancelException:
+                log.error("Command cancelled: %s", cmd)
+                # the event is still set, detach it while cleaning
+                cancel = setCancelEvent(None)
+                try:
+                    self._cmd('c', control=True, timeout=5, failcontinue=True)
+                finally:
+                    setCancelEvent(cancel)
+                raise
+            except (KeyboardInterrupt, SystemExit) as e:
+                log.error("User interrupted.")
+                log.debug("Cascading ^C to device")
                 self._cmd('c', control=True)
-        except ConnCloseException:
-            log.debug("Send command error due to connection closed: %s", cmd)
-        except (KeyboardInterrupt, SystemExit) as e:
-            log.error("User interrupted.")
-            log.debug("Cascading ^C to device")
-            self._cmd('c', control=True)
-            raise e
-        except BaseException:
-            log.error("Send command error due to error:\n %s",
-                      traceback.format_exc())
+                raise e
+            except BaseException:
+                log.error("Send command error due to error:\n %s",
+                          traceback.format_exc())
+            finally:
+                self.last_active = time.time()
+                self._recordIO(start, len(out))
         # leave it to the caller
         raise ConnException("Error sending command %s." % cmd)
 
+    def probe(self, timeout=5):
+        """Send an empty line and check that the transport survives it.
+        Only a dead process or EOF counts as dead: a session left under
+        another prompt (pager, config mode, nested shell) times out
+        waiting for the prompt but is still alive, and must not be reopened.
+        """
+        if not self._opened or self._exp is None or not self._exp.isalive():
+            return False
+        with self.busy:
+            try:
+                self._cmd("", timeout=timeout)
+                return True
+            except (ConnCloseException, OSError):
+                return False
+            except BaseException:
+                return self._exp.isalive()
+            finally:
+                self.last_active = time.time()
+
     def isOpen(self):
         return self._opened
 
@@ -489,6 +603,8 @@ class RestConnection(Connection):
             for p in args["params"]:
                 if not isinstance(args["params"][p], str):
                     args["params"][p] = json.dumps(args["params"][p], separators=(',', ':'))
+        start = time.time()
+        resp = None
         try:
             if self.use_session:
                 self.session.verify = self.ssl_verify
@@ -517,6 +633,8 @@ class RestConnection(Connection):
         except BaseException:
             log.error("Request Error due to:\n %s", traceback.format_exc())
             raise ConnException("Send Request error")
+        finally:
+            self._recordIO(start, len(resp.content) if resp is not None else 0)
 
     def open(self):
         self.connect()
@@ -567,6 +685,17 @@ class ConnTimeoutException(ConnException):
         return repr(self.value)
 
 
+#
+class ConnCancelException(ConnException):
+    """Exception raised when a command is cancelled, i.e. on step timeout"""
+
+    def __init__(self, value):
+        super(ConnCancelException, self).__init__(value)
+
+    def __str__(self):
+        return repr(self.value)
+
+
 ##############################################
 # facilities to connect a specific connection
 def newConn(cname, ctype, **kwargs):
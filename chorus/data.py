@@ -55,7 +55,7 @@ class DataParse(object):
         with open(self.uri, 'r') as f:
             reader = csv.reader(f)
             # header
-            cols = reader.next()
+            cols = next(reader)
             for row in reader:
                 c = dict(zip(cols, row))
                 # c.update(args)
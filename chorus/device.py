@@ -8,12 +8,16 @@ Device base classes.
 """
 
 import threading
+import time
 import re
+import inspect
+import asyncio
 import ipaddress
 
 from . import connection
 from .log import getLog
 from .config import Config
+from .utils import getCommandExecutor
 import sys
 PY3 = (sys.version_info[0] >= 3)
 
@@ -32,6 +36,14 @@ class Device(object):
     supported_con = []
     '''All supported connection methods by plugin name.
     '''
+    max_sessions = None
+    '''Max count of commands sent to the device at the same time, i.e. by parallel substeps. Unlimited by default,
+    can be set in topology files.
+    '''
+    parsers = {}
+    '''Output parsers of the device keyed by command, see :class:`chorus.parser.Parser`.
+    Parsers defined in subclasses and extensions are merged with those of the base classes.
+    '''
     #
     DEFAULT_ROOT = "root"
     DEFAULT_USER = "ubuntu"
@@ -52,6 +64,11 @@ class Device(object):
         self._c = None
         self.log = getLog(self.name)
         self._mac = {}
+        # serialize connection opening between the user and prewarm threads
+        self._conn_lock = threading.RLock()
+        self._sessions = None
+        if self.max_sessions:
+            self._sessions = threading.BoundedSemaphore(int(self.max_sessions))
         self.default_conn_method = self.supported_con[0]
         # update default prompt
         pa = self.init_cmds.get("prompt_after")
@@ -60,10 +77,11 @@ class Device(object):
         else:
             self.prompt = self.__class__.prompt
 
-    def _getConnection(self, method='', tag=None, opened=False):
+    def _getConnection(self, method='', tag=None, opened=False, thread=None):
         """Get the device connection
         Connection are index with two parameters: thread ID and connection method.
         It's also possible to have multi connections on the same thread with the same method by specifying an extra tag
+        A connection can be got on behalf of another thread by specifying its name with `thread`.
         """
         if not method:
             method = self.default_conn_method
@@ -74,10 +92,10 @@ class Device(object):
         method = str(method).lower()
         # For single connections like console, there is only one copy
         conn_name = self.name
-        t = threading.currentThread()
+        tname = thread or threading.currentThread().name
         if not connection.uniqConn(method):
-            conn_name = conn_name + "_%s_%s" % (t.name, method)
-        elif t.name != "MainThread":
+            conn_name = conn_name + "_%s_%s" % (tname, method)
+        elif tname != "MainThread":
             # Give some warnning on multithread
             self.log.warning(
                 "Single connection used with multi thread, conflict may happen")
@@ -87,17 +105,18 @@ class Device(object):
         if tag:
             conn_name = conn_name + "_" + tag
 
-        # new connection only necessary
-        if conn_name not in self._connection:
-            # WARN An implicit arg passing, make sure args of parameter and
-            # name of topo keywords are the same
-            self._connection[conn_name] = connection.newConn(
-                conn_name, method, **self.__dict__)
+        with self._conn_lock:
+            # new connection only necessary
+            if conn_name not in self._connection:
+                # WARN An implicit arg passing, make sure args of parameter and
+                # name of topo keywords are the same
+                self._connection[conn_name] = connection.newConn(
+                    conn_name, method, **self.__dict__)
 
-        if opened and not self._connection[conn_name].isOpen():
-            self._connection[conn_name].prompt = self.prompt
-            self._connection[conn_name].open()
-            self.onFirstConnect(self._connection[conn_name])
+            if opened and not self._connection[conn_name].isOpen():
+                self._connection[conn_name].prompt = self.prompt
+                self._connection[conn_name].open()
+                self.onFirstConnect(self._connection[conn_name])
 
         return self._connection[conn_name]
 
@@ -123,16 +142,16 @@ class Device(object):
                 "Connection method %s not supported by %s" %
                 (method, self.name))
 
-    def connect(self, method=None, tag=None):
+    def connect(self, method=None, tag=None, thread=None):
         """Connect to device"""
         self.log.info("Connecting to device: %s", self.name)
-        self._getConnection(method, tag, opened=True)
+        self._getConnection(method, tag, opened=True, thread=thread)
 
-    def reconnect(self, method=None, tag=None):
-        """Reconnect the default connection"""
+    def reconnect(self, method=None, tag=None, thread=None):
+        """Reconnect the default connection, of another thread if `thread` specified"""
         self.log.info("Reconnecting to device: %s", self.name)
-        self.disconnect(method, tag)
-        self.connect(method=method, tag=tag)
+        self.disconnect(method, tag, thread=thread)
+        self.connect(method=method, tag=tag, thread=thread)
 
     def reconnectAll(self):
         """Reconnect all existing connections, used for reboot"""
@@ -144,10 +163,50 @@ class Device(object):
             conn.reopen()
             self.onFirstConnect(conn)
 
-    def disconnect(self, method=None, tag=None, force=False):
-        """Disconnect the default connection"""
+    def keepalive(self, idle, timeout=5):
+        """Probe the connections idle for `idle` seconds, and reopen those found dead.
+        Connections busy with commands are skipped, and those answering under
+        another prompt are left alone, since only a closed transport counts as dead.
+
+        :param idle: idle seconds before a connection is probed
+        :param timeout: timeout of each probe
+        :return: (count of probes sent, count of connections revived)
+        """
+        sent = revived = 0
+        for conn in list(self._connection.values()):
+            if not conn.isOpen() or time.time() - conn.last_active < idle:
+                continue
+            if not conn.busy.acquire(False):
+                continue
+            try:
+                sent += 1
+                alive = conn.probe(timeout)
+                probed_at = conn.last_active
+            finally:
+                conn.busy.release()
+            if alive:
+                continue
+            # same lock order as `_getConnection`
+            with self._conn_lock, conn.busy:
+                if conn.last_active != probed_at:
+                    # used, and reconnected if necessary, by its owner in the meanwhile
+                    continue
+                self.log.info("Connection %s is dead, reopening", conn.name)
+                try:
+                    conn.close()
+                    conn.prompt = self.prompt
+                    conn.open()
+                    if conn.isOpen():
+                        self.onFirstConnect(conn)
+                        revived += 1
+                except BaseException:
+                    self.log.warning("Reopening connection %s failed", conn.name)
+        return sent, revived
+
+    def disconnect(self, method=None, tag=None, force=False, thread=None):
+        """Disconnect the default connection, of another thread if `thread` specified"""
         self.log.info("Disconnecting device: %s", self.name)
-        self._getConnection(method, tag).close(force)
+        self._getConnection(method, tag, thread=thread).close(force)
 
     def disconnectAll(self):
         """Disconnect the default connection"""
@@ -166,28 +225,60 @@ class Device(object):
             control=False,
             nonewline=False,
             tag=None,
-            failcontinue=False):
-        """Send command to the device, and return the output, the parameters are the same as Connection:cmd"""
+            failcontinue=False,
+            thread=None):
+        """Send command to the device, and return the output, the parameters are the same as Connection:cmd.
+        The command is sent on the connection of another thread if `thread` specified.
+        """
         self.log.info("Sending command: %s", cmd)
-        # retry 3 times
-        for _ in range(3):
-            try:
-                conn = self._getConnection(opened=True, method=method, tag=tag)
-                out = conn.cmd(
-                    cmd,
-                    prompt=prompt,
-                    mid_prompts=mid_prompts,
-                    mid_ignore=mid_ignore,
-                    timeout=timeout,
-                    control=control,
-                    nonewline=nonewline,
-                    failcontinue=failcontinue)
-                return out
-            except Exception:
-                self.log.warn("Command send failed, retrying...")
-                self.reconnect(method, tag)
-        raise DeviceException(
-            "Failed issuing commend to device %s: '%s'" % (self.name, cmd))
+        if self._sessions:
+            self._sessions.acquire()
+        try:
+            # retry 3 times
+            for _ in range(3):
+                try:
+                    conn = self._getConnection(opened=True, method=method, tag=tag, thread=thread)
+                    out = conn.cmd(
+                        cmd,
+                        prompt=prompt,
+                        mid_prompts=mid_prompts,
+                        mid_ignore=mid_ignore,
+                        timeout=timeout,
+                        control=control,
+                        nonewline=nonewline,
+                        failcontinue=failcontinue)
+                    return out
+                except connection.ConnCancelException:
+                    raise
+                except Exception:
+                    # do not retry a cancelled command
+                    cancel = connection.getCancelEvent()
+                    if cancel is not None and cancel.is_set():
+                        raise connection.ConnCancelException("command cancelled.")
+                    self.log.warn("Command send failed, retrying...")
+                    self.reconnect(method, tag, thread)
+            raise DeviceException(
+                "Failed issuing commend to device %s: '%s'" % (self.name, cmd))
+        finally:
+            if self._sessions:
+                self._sessions.release()
+
+    async def acmd(self, cmd, **kwargs):
+        """Awaitable `cmd` for async steps. The command is sent from the command thread pool,
+        so that many commands can be sent at the same time with `asyncio.gather`.
+        It is sent on the connection of the step, commands to the same device are sent one by one.
+        """
+        loop = asyncio.get_event_loop()
+        kwargs.setdefault("thread", threading.current_thread().name)
+        return await loop.run_in_executor(
+            getCommandExecutor(), _withThreadContext(self.cmd, cmd, **kwargs))
+
+    async def atestCmd(self, cmd, testreg, **kwargs):
+        """Awaitable `testCmd` for async steps"""
+        loop = asyncio.get_event_loop()
+        kwargs.setdefault("thread", threading.current_thread().name)
+        return await loop.run_in_executor(
+            getCommandExecutor(), _withThreadContext(self.testCmd, cmd, testreg, **kwargs))
 
     def testCmd(
             self,
@@ -197,7 +288,8 @@ class Device(object):
             prompt=None,
             mid_prompts={},
             mid_ignore=False,
-            timeout=None):
+            timeout=None,
+            thread=None):
         """Send command to the device, check if the output match the teststings in sequence, return None or math object"""
         out = self.cmd(
             cmd,
@@ -205,11 +297,37 @@ class Device(object):
             prompt=prompt,
             mid_prompts=mid_prompts,
             mid_ignore=mid_ignore,
-            timeout=timeout)
+            timeout=timeout,
+            thread=thread)
         self.log.debug(
             "Check if string '%s' is contained in command: %s", testreg, cmd)
         return re.search(testreg, out, flags=0)
 
+    @classmethod
+    def getParser(cls, cmd):
+        """Get the parser registered for a command, None if not found"""
+        for c in inspect.getmro(cls):
+            parsers = c.__dict__.get("parsers")
+            if parsers and cmd in parsers:
+                return parsers[cmd]
+        return None
+
+    def parse(self, cmd, output=None, **kwargs):
+        """Send command to the device and parse the output into records with the registered parser
+
+        :param cmd: the command, also the key of the parser
+        :param output: parse this output instead of sending the command
+        :param kwargs: other arguments passed to `cmd`
+        :return: a list of records
+        """
+        parser = self.getParser(cmd)
+        if parser is None:
+            raise DeviceException(
+                "No parser for command '%s' on device %s" % (cmd, self.name))
+        if output is None:
+            output = self.cmd(cmd, **kwargs)
+        return parser.parse(output)
+
     def setIfIP(self, ifname, ipmask):
         """Set the ip address of a interface"""
         raise DeviceException(
@@ -225,6 +343,79 @@ class Device(object):
         self.disconnectAll()
 
 
+############################
+# Background connecting
+class DevicePrewarmer(threading.Thread):
+    """Connect devices one by one in background, so that the first command sent to them need not wait for login.
+    Connections are opened on behalf of the thread creating the prewarmer, which is the one running test steps.
+
+    :param devices: device instances, in priority order
+    """
+
+    def __init__(self, devices):
+        super(DevicePrewarmer, self).__init__(name="Prewarm")
+        self.daemon = True
+        self.devices = list(devices)
+        self.owner = threading.currentThread().name
+        self._stopped = threading.Event()
+
+    def run(self):
+        for d in self.devices:
+            if self._stopped.is_set():
+                break
+            try:
+                d.connect(thread=self.owner)
+            except BaseException:
+                # leave it to the first command, which retries and raises properly
+                d.log.warning("Prewarming device %s failed", d.name)
+
+    def stop(self):
+        """Stop connecting the remaining devices and wait for the current one"""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+class DeviceKeepalive(threading.Thread):
+    """Probe idle device connections periodically in background, and reopen the dead ones before they are used,
+    so that devices with short exec timeout do not drop connections between testcases.
+
+    :param devices: device instances
+    :param interval: idle seconds before a connection is probed
+    :param timeout: timeout of each probe
+    """
+
+    def __init__(self, devices, interval, timeout=5):
+        super(DeviceKeepalive, self).__init__(name="Keepalive")
+        self.daemon = True
+        self.devices = list(devices)
+        self.interval = interval
+        self.timeout = timeout
+        # metrics
+        self.sent = 0
+        self.revived = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval / 2.0):
+            for d in self.devices:
+                if self._stopped.is_set():
+                    break
+                try:
+                    sent, revived = d.keepalive(self.interval, self.timeout)
+                except BaseException:
+                    d.log.warning("Keepalive of device %s failed", d.name)
+                    continue
+                self.sent += sent
+                self.revived += revived
+
+    def stop(self):
+        """Stop probing and wait for the current probe"""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
 ############################
 # Upgradable interface.
 class Upgradable(object):
@@ -305,6 +496,23 @@ class DeviceException(Exception):
 
 ########################
 # methods
+def _withThreadContext(func, *args, **kwargs):
+    """Bind a call to the I/O counters and the cancel event of the calling thread,
+    for calls made from worker threads"""
+    stats = connection.getIOStats()
+    cancel = connection.getCancelEvent()
+
+    def call():
+        old_stats = connection.setIOStats(stats)
+        old_cancel = connection.setCancelEvent(cancel)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.setIOStats(old_stats)
+            connection.setCancelEvent(old_cancel)
+    return call
+
+
 def getDevice(**kwargs):
     """Get a instance of a device
 
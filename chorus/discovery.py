@@ -0,0 +1,572 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Testcase discovery.
+
+Testcase modules are not imported to find testcases. Each module is parsed into an abstract syntax tree instead, and
+the classes, their base classes, topologies and steps, and the imports of the module are recorded in an index. A
+class is a testcase if one of its bases resolves to `Testcase` through the classes and imports in the index. Only
+the modules holding the selected testcases are imported afterwards, see :class:`~chorus.testsuite.Testsuite`.
+
+The index is kept in a json file under the log folder across runs, configured by `discovery.index`. A module is
+parsed again only if its modification time or size changes, and its content hash differs from the recorded one.
+
+Modules are found by :func:`walk`, which prunes the folders matching the globs of `discovery.ignore`, and are read
+and parsed by a pool of `discovery.workers` threads.
+
+Testcases affected by changes, since a git reference or a time, are those whose modules import the changed modules,
+directly or not, see :meth:`DiscoveryIndex.affected`. Base classes, thus fixture chains, are covered by imports.
+
+Bases which can not be resolved by the index, i.e. classes of libraries outside of the searched paths, are checked by
+importing the library module once, and the verdict is kept in the index as well. Modules with bases which can not be
+resolved at all, i.e. imported by `from x import *` or bound by assignments like `Base = Testcase`, are imported to be
+inspected, as if there was no index.
+"""
+import os
+import re
+import sys
+import ast
+import builtins
+import json
+import time
+import fnmatch
+import inspect
+import hashlib
+import datetime
+import importlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import Config
+from .log import log, logcls
+from .utils import dump_json
+
+INDEX_VERSION = 3
+# modules scanned by a thread at a time
+SCAN_CHUNK = 256
+# value of class attributes which are not literals
+UNKNOWN = object()
+# ISO formats of local times accepted by `changedFiles`
+TIME_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f",
+                "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f")
+
+
+class DiscoveryIndex(object):
+    """Index of testcase modules
+
+    :param path: the index file, None to keep the index in memory only
+    """
+    # {index file: index} loaded, see :meth:`get`
+    _instances = {}
+
+    def __init__(self, path=None):
+        super(DiscoveryIndex, self).__init__()
+        self.path = path
+        # {absolute module path: entry}
+        self.files = {}
+        # {qualified class name outside of the index: whether it is a testcase}
+        self.external = {}
+        self.hits = 0
+        self.misses = 0
+        # seconds spent to scan modules and to resolve testcases
+        self.scan_sec = 0.0
+        self.resolve_sec = 0.0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._modules = {}
+        self._dotted = {}
+        self._deps = {}
+        self._verdicts = {}
+
+    @classmethod
+    def get(cls, path=None):
+        """Get the index of a file, loaded once in a process and kept up to date by each discovery
+
+        :param path: the index file, None for an index in memory only
+        """
+        if path is None:
+            return cls()
+        if path not in cls._instances:
+            cls._instances[path] = cls(path).load()
+        return cls._instances[path]
+
+    def load(self):
+        """Load the index file, the index is empty if the file does not exist, is broken or outdated
+
+        :return: self
+        """
+        if self.path is None or not os.path.isfile(self.path):
+            return self
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (ValueError, OSError) as e:
+            log.warning("Ignoring broken discovery index %s: %s", self.path, e)
+            return self
+        if data.get("version") == [INDEX_VERSION] + list(sys.version_info[:2]):
+            self.files = data.get("files", {})
+            self.external = data.get("external", {})
+        return self
+
+    def save(self):
+        """Write the index file if changed, dropping the modules which no longer exist"""
+        if self.path is None or not self._dirty:
+            return
+        for path in [p for p in self.files if not os.path.exists(p)]:
+            del self.files[path]
+        dump_json(self.path, {"version": [INDEX_VERSION] + list(sys.version_info[:2]),
+                              "files": self.files,
+                              "external": self.external})
+        self._dirty = False
+
+    def scan(self, path):
+        """Get the index entry of a module, parsed again only if changed. Thread safe.
+
+        :param path: path of the module
+        :return: {"imports": {alias: qualified name}, "star": [modules imported by *],
+            "assigns": [names assigned at module level],
+            "classes": {name: {"bases": [...], "topo": ..., "steps": [...], "line": ...}}, "error": ...}.
+            "topo" is only there if assigned in the class, False if not assigned a name or None.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self.files.get(path)
+        if entry is not None and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            with self._lock:
+                self.hits += 1
+            return entry
+        with open(path, 'rb') as f:
+            source = f.read()
+        sha1 = hashlib.sha1(source).hexdigest()
+        if entry is not None and entry["sha1"] == sha1:
+            entry = dict(entry, mtime_ns=st.st_mtime_ns, size=st.st_size)
+            parsed = False
+        else:
+            entry = parseModule(source, path)
+            entry.update({"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha1": sha1})
+            parsed = True
+        with self._lock:
+            self.files[path] = entry
+            self._dirty = True
+            if parsed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def _scanChunk(self, paths):
+        entries = []
+        for path in paths:
+            try:
+                entries.append(self.scan(path))
+            except OSError as e:
+                log.debug("Error reading script %s: %s", path, e)
+                entries.append(None)
+        return entries
+
+    def testcases(self, modules):
+        """Find testcases in modules
+
+        :param modules: [(module name, path)]
+        :return: ([(testcase name, module name, path, class entry)], [(module name, path)] to be imported to
+            find testcases)
+        """
+        self._modules = {}
+        self._verdicts = {}
+        self.hits = 0
+        self.misses = 0
+        start = time.time()
+        workers = int(Config().get_config("discovery", "workers") or 1)
+        paths = [path for _, path in modules]
+        if workers > 1 and len(paths) > SCAN_CHUNK:
+            # in chunks, a future for each module costs as much as checking an unchanged one
+            chunks = [paths[i:i + SCAN_CHUNK] for i in range(0, len(paths), SCAN_CHUNK)]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                entries = [e for chunk in pool.map(self._scanChunk, chunks) for e in chunk]
+        else:
+            entries = self._scanChunk(paths)
+        self.scan_sec = time.time() - start
+        start = time.time()
+        for (name, path), entry in zip(modules, entries):
+            if entry is None:
+                continue
+            if entry.get("error"):
+                log.debug("Error parsing script %s: %s", path, entry["error"])
+                continue
+            self._modules[name] = (path, entry)
+        # {tail of dotted module name: [module names]}
+        self._dotted = {}
+        for name in self._modules:
+            parts = name.replace(os.sep, ".").split(".")
+            for i in range(len(parts)):
+                self._dotted.setdefault(".".join(parts[i:]), []).append(name)
+        self._deps = {}
+        found = []
+        unknown = []
+        for name, (path, entry) in self._modules.items():
+            # in the order of `inspect.getmembers`
+            verdicts = [(cls, self._isTestcase(name, cls, ())) for cls in sorted(entry["classes"])]
+            if [cls for cls, verdict in verdicts if verdict is None]:
+                # all of its testcases are found by inspecting the module
+                unknown.append((name, path))
+                continue
+            found.extend((":".join([name, cls]), name, path, entry["classes"][cls]) for cls, verdict in verdicts
+                         if verdict)
+        self.resolve_sec = time.time() - start
+        return found, unknown
+
+    def _isTestcase(self, module, cls, stack):
+        """Whether a class of an indexed module derives from Testcase, None if not sure"""
+        key = (module, cls)
+        if key in self._verdicts:
+            return self._verdicts[key]
+        if key in stack:
+            return False
+        verdict = False
+        for base in self._modules[module][1]["classes"][cls]["bases"]:
+            v = self._isBase(module, base, stack + (key,))
+            if v:
+                verdict = True
+                break
+            elif v is None:
+                verdict = None
+        self._verdicts[key] = verdict
+        return verdict
+
+    def _isBase(self, module, base, stack):
+        """Whether a name in an indexed module refers to Testcase or a testcase class, None if not sure"""
+        if base is None:
+            # not a plain name, i.e. a call
+            return None
+        entry = self._modules[module][1]
+        head, _, rest = base.partition(".")
+        if head in entry["assigns"]:
+            # i.e. `Base = Testcase`, or rebinding a class
+            return None
+        if not rest and head in entry["classes"]:
+            return self._isTestcase(module, head, stack)
+        if head in entry["imports"]:
+            qualified = entry["imports"][head] + ("." + rest if rest else "")
+        elif not rest:
+            # builtins, unless imported by *, other names are bound in ways not indexed
+            return False if hasattr(builtins, head) and not entry["star"] else None
+        else:
+            qualified = base
+        parent, _, name = qualified.rpartition(".")
+        if name == "Testcase":
+            return True
+        target = self._findModule(module, parent)
+        if target is not None:
+            # tagged apart from the classes in the stack
+            key = ("import", target, name)
+            if key in stack:
+                return False
+            return self._isBase(target, name, stack + (key,))
+        return self._isExternal(qualified)
+
+    def topo(self, module, cls):
+        """Topology of a testcase class of an indexed module, assigned in the class or inherited through the
+        bases in the index. Classes with more than one base are not followed.
+
+        :return: the topology name, None if the class has no topology, i.e. a lib case, False if not sure
+        """
+        seen = set()
+        # a name to resolve in a module
+        key = (module, cls)
+        while key not in seen:
+            seen.add(key)
+            module, name = key
+            if name is None:
+                return False
+            entry = self._modules[module][1]
+            head, _, rest = name.partition(".")
+            if head in entry["assigns"]:
+                return False
+            if not rest and head in entry["classes"]:
+                c = entry["classes"][head]
+                if "topo" in c:
+                    return c["topo"]
+                if len(c["bases"]) != 1:
+                    return False
+                key = (module, c["bases"][0])
+                continue
+            if head in entry["imports"]:
+                qualified = entry["imports"][head] + ("." + rest if rest else "")
+            elif rest:
+                qualified = name
+            else:
+                return False
+            parent, _, name = qualified.rpartition(".")
+            if name == "Testcase":
+                return None
+            target = self._findModule(module, parent)
+            if target is None:
+                return False
+            key = (target, name)
+        return False
+
+    def _findModules(self, module, qualified):
+        """The indexed modules a qualified name imported by a module may refer to. Module names in the index are
+        relative to the searched paths, so they are matched by the longest common tail with the qualified name."""
+        if qualified.startswith("."):
+            # relative to the package of the module
+            level = len(qualified) - len(qualified.lstrip("."))
+            package = module.replace(os.sep, ".").split(".")[:-level]
+            qualified = ".".join(package + [qualified.lstrip(".")]).strip(".")
+        parts = qualified.split(".")
+        for i in range(len(parts)):
+            names = self._dotted.get(".".join(parts[i:]))
+            if names:
+                return names
+        return []
+
+    def _findModule(self, module, qualified):
+        """The indexed module a qualified name imported by a module refers to, see :meth:`_findModules`.
+        None if not found, or if several modules match as well, i.e. `base` and `pkg/base` for `base`."""
+        names = self._findModules(module, qualified)
+        return names[0] if len(names) == 1 else None
+
+    def dependencies(self, module):
+        """Indexed modules imported by a module, so are the modules of its base classes"""
+        deps = self._deps.get(module)
+        if deps is None:
+            entry = self._modules[module][1]
+            deps = set()
+            for qualified in list(entry["imports"].values()) + entry["star"]:
+                # a module, or a name in a module
+                names = self._findModules(module, qualified)
+                if not names and "." in qualified.lstrip("."):
+                    names = self._findModules(module, qualified.rpartition(".")[0])
+                deps.update(names)
+            deps.discard(module)
+            self._deps[module] = deps
+        return deps
+
+    def closure(self, module):
+        """Indexed modules a module depends on, directly or not, including itself"""
+        seen = set([module])
+        stack = [module]
+        while stack:
+            for dep in self.dependencies(stack.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        return seen
+
+    def affected(self, paths):
+        """Indexed modules affected by changes of files, whose closure includes any of the files
+
+        :param paths: paths of the changed files
+        :return: set of module names
+        """
+        paths = set(os.path.realpath(p) for p in paths)
+        changed = [name for name, (path, _) in self._modules.items() if os.path.realpath(path) in paths]
+        users = {}
+        for name in self._modules:
+            for dep in self.dependencies(name):
+                users.setdefault(dep, []).append(name)
+        seen = set(changed)
+        stack = list(changed)
+        while stack:
+            for user in users.get(stack.pop(), []):
+                if user not in seen:
+                    seen.add(user)
+                    stack.append(user)
+        return seen
+
+    def modules(self):
+        """Names of the modules found by :meth:`testcases`"""
+        return set(self._modules)
+
+    def changedSince(self, since):
+        """Indexed modules changed since a time, by modification time
+
+        :param since: seconds since the epoch
+        :return: paths of the modules
+        """
+        return [path for path, entry in self._modules.values() if entry["mtime_ns"] > since * 1e9]
+
+    def _isExternal(self, qualified):
+        """Whether a class outside of the index derives from Testcase, by importing its module"""
+        if qualified in self.external:
+            return self.external[qualified]
+        parent, _, name = qualified.rpartition(".")
+        if not parent:
+            return None
+        try:
+            anc = inspect.getmro(getattr(importlib.import_module(parent), name))
+        except BaseException:
+            log.debug("Unable to resolve base class %s", qualified)
+            return None
+        verdict = (len(anc) > 2) and (anc[-2].__name__ == "Testcase")
+        self.external[qualified] = verdict
+        self._dirty = True
+        return verdict
+
+
+def walk(root, recursive=False, ignore=()):
+    """Find python modules in a folder by `os.scandir`, in the order of names
+
+    :param root: the folder
+    :param recursive: search sub folders as well, except symbolic links
+    :param ignore: globs of folder names not to search, i.e. `.git`
+    :return: [(module name, path)], the module name is the path relative to `root` without extension
+    """
+    pruned = re.compile("|".join(fnmatch.translate(g) for g in ignore)) if ignore else None
+    modules = []
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        try:
+            entries = sorted(os.scandir(os.path.join(root, rel)), key=lambda e: e.name)
+        except OSError as e:
+            log.debug("Error listing %s: %s", os.path.join(root, rel), e)
+            continue
+        folders = []
+        for e in entries:
+            if e.name.endswith(".py"):
+                if e.is_file():
+                    modules.append((os.path.join(rel, e.name).split(".")[0], e.path))
+            elif recursive and e.is_dir(follow_symlinks=False):
+                if pruned is None or not pruned.match(e.name):
+                    folders.append(os.path.join(rel, e.name))
+        stack.extend(reversed(folders))
+    return modules
+
+
+def changedFiles(since, folders, index=None):
+    """Files changed since a git reference or a time
+
+    :param since: a git reference (i.e. a branch, tag or commit), seconds since the epoch, or a local time in one of
+        :data:`TIME_FORMATS`
+    :param folders: folders of the git repositories, for git references only
+    :param index: the :class:`DiscoveryIndex` to find modules modified after a time
+    :return: paths of the changed files, None if failed
+    """
+    try:
+        sec = float(since)
+    except ValueError:
+        sec = None
+        for fmt in TIME_FORMATS:
+            try:
+                sec = datetime.datetime.strptime(since, fmt).timestamp()
+                break
+            except ValueError:
+                continue
+    if sec is not None:
+        return index.changedSince(sec) if index is not None else []
+    changed = []
+    tops = set()
+    for folder in folders:
+        try:
+            top = subprocess.check_output(["git", "-C", folder, "rev-parse", "--show-toplevel"],
+                                          stderr=subprocess.PIPE, universal_newlines=True).strip()
+            if top in tops:
+                continue
+            tops.add(top)
+            # differences of the working tree from the reference, and new files
+            for cmd in (["diff", "--name-only", since, "--"], ["ls-files", "--others", "--exclude-standard"]):
+                out = subprocess.check_output(["git", "-C", top] + cmd,
+                                              stderr=subprocess.PIPE, universal_newlines=True)
+                changed.extend(os.path.join(top, f) for f in out.splitlines() if f)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.error("Unable to find changes since %s in %s: %s", since, folder,
+                      getattr(e, "stderr", None) or e)
+            return None
+    return changed
+
+
+def parseModule(source, path):
+    """Parse the classes and imports of a module, see :meth:`DiscoveryIndex.scan`"""
+    try:
+        tree = ast.parse(source, path)
+    except (SyntaxError, ValueError) as e:
+        return {"imports": {}, "star": [], "assigns": [], "classes": {}, "error": str(e)}
+    imports = {}
+    star = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for a in node.names:
+                if a.asname:
+                    imports[a.asname] = a.name
+                else:
+                    head = a.name.split(".")[0]
+                    imports[head] = head
+        elif isinstance(node, ast.ImportFrom):
+            parent = "." * node.level + (node.module or "")
+            for a in node.names:
+                if a.name == "*":
+                    star.append(parent)
+                else:
+                    sep = "" if parent.endswith(".") else "."
+                    imports[a.asname or a.name] = parent + sep + a.name
+    classes = {}
+    assigns = set()
+    # module level statements, including those in blocks, i.e. `if` or `try`
+    stack = list(reversed(tree.body))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, _BLOCKS):
+            for field in ("body", "orelse", "finalbody"):
+                stack.extend(reversed(getattr(node, field, [])))
+            for handler in reversed(getattr(node, "handlers", [])):
+                stack.extend(reversed(handler.body))
+            continue
+        if isinstance(node, ast.Assign):
+            assigns.update(t.id for target in node.targets for t in ast.walk(target) if isinstance(t, ast.Name))
+            continue
+        if not isinstance(node, ast.ClassDef):
+            continue
+        # {name: value} of class attributes, the value is UNKNOWN if not a literal
+        attrs = {}
+        methods = []
+        for item in node.body:
+            if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                methods.append(item.name)
+            elif isinstance(item, ast.Assign):
+                try:
+                    value = ast.literal_eval(item.value)
+                except (ValueError, TypeError, SyntaxError, RecursionError):
+                    value = UNKNOWN
+                for t in item.targets:
+                    if isinstance(t, ast.Name):
+                        attrs[t.id] = value
+        prefix = attrs.get("METHOD_PREFIX")
+        prefix = prefix if isinstance(prefix, str) else "step"
+        step_reg = re.compile(r'^%s\d+(_\d+)?$' % prefix)
+        # in the order of step ids, then of substep ids
+        steps = sorted((m for m in methods if step_reg.match(m)),
+                       key=lambda m: [int(i) for i in m[len(prefix):].split("_")])
+        classes[node.name] = {"bases": [_dotted(b) for b in node.bases], "steps": steps, "line": node.lineno}
+        if "topo" in attrs:
+            topo = attrs["topo"]
+            classes[node.name]["topo"] = topo if topo is None or isinstance(topo, str) else False
+    return {"imports": imports, "star": star, "assigns": sorted(assigns), "classes": classes, "error": None}
+
+
+# compound statements whose bodies run at module level
+_BLOCKS = (ast.If, ast.Try, ast.With, ast.For, ast.While)
+
+
+def _dotted(node):
+    """Dotted name of a Name or Attribute node, None for other expressions"""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return ".".join(reversed(parts))
+
+
+def indexPath():
+    """The index file configured by `discovery.index`, relative to the log folder, None if disabled"""
+    name = Config().get_config("discovery", "index")
+    if name == "":
+        return None
+    return os.path.join(os.path.dirname(logcls.get().getLogPrefix()), name or "index.json")
@@ -11,11 +11,24 @@ import os
 from ..config import extend
 from ..log import sleep
 from ..device import Device
+from ..parser import Parser
+
+UNKNOWN_HOST = re.compile(r'unknown host')
 
 
 @extend("linux")
 class LinuxClient(object):
     """Linux client capabilities"""
+    parsers = {
+        "ping": Parser(
+            "ping",
+            r"(?P<transmitted>\d+) packets transmitted, (?P<received>\d+)[^\n]*?received"
+            r"(?:, \+(?P<duplicates>\d+) duplicates)?(?:, \+(?P<corrupted>\d+) corrupted)?"
+            r"(?:, \+(?P<errors>\d+) errors)?, (?P<loss>[\d.]+)% packet loss",
+            types={"transmitted": int, "received": int, "duplicates": int,
+                   "corrupted": int, "errors": int, "loss": float}),
+    }
+
     #############################
     # ping
 
@@ -24,63 +37,28 @@ class LinuxClient(object):
         ping_cmd = "ping " + "-c %s" % count + " " + "-s %s" % size + " " + to_host
         self.log.info("Executing " + ping_cmd)
         ping_result = self.cmd(ping_cmd, timeout=timeout)
-        if re.search(r'unknown host', ping_result):
+        if UNKNOWN_HOST.search(ping_result):
             self.log.error("Cannot lookup the host!")
             return False
-        elif re.search(r'(\d+) packets transmitted, (\d+)[\s\S]+received, \+(\d+) errors, (\d+)% packet loss', ping_result):
-            match = re.search(
-                r'(\d+) packets transmitted, (\d+)[\s\S]+received, \+(\d+) errors, (\d+)% packet loss',
-                ping_result)
-            self.log.info("Match info is: \"" + match.group() + "\"")
-            if int(match.group(2)) == 0:
-                self.log.error("error: All ping packets are dropped!")
+        stats = self.parse("ping", output=ping_result)
+        if not stats:
+            self.log.info("Check ping result failed. pls check")
+            return False
+        stat = stats[0]
+        self.log.info("Match info is: \"%s\"" % (stat,))
+        if stat.received == 0:
+            self.log.error("error: All ping packets are dropped!")
+            return False
+        elif stat.received < count:
+            self.log.info("Some ping packets are dropped during ping!")
+            if stat.received < pass_count:
+                self.log.error("Error: Dropped ping packets are too much!")
                 return False
-            elif int(match.group(2)) < count:
-                self.log.info("Some ping packets are dropped during ping!")
-                if int(match.group(2)) < pass_count:
-                    self.log.error("Error: Dropped ping packets are too much!")
-                    return False
-                else:
-                    return True
-        elif re.search(r'(\d+) packets transmitted, (\d+)[\s\S]+received, (\d+)% packet loss', ping_result):
-            match = re.search(
-                r'(\d+) packets transmitted, (\d+)[\s\S]+received, (\d+)% packet loss',
-                ping_result)
-            if int(
-                    match.group(1)) == count and int(
-                    match.group(2)) == int(
-                    match.group(1)):
-                self.log.info("All ping packets are passed!")
+            else:
                 return True
-            elif int(match.group(2)) < count:
-                self.log.info("Some ping packets are dropped during ping!")
-                if int(match.group(2)) < pass_count:
-                    self.log.error("Error: Dropped ping packets are too much!")
-                    return False
-                else:
-                    return True
-            elif re.search(r'(\d+) packets transmitted, (\d+)[\s\S]+received, \+(\d+) duplicates, (\d+)% packet loss',
-                           ping_result):
-                match = re.search(
-                    r'(\d+) packets transmitted, (\d+)[\s\S]+received, \+(\d+) duplicates, (\d+)% packet loss',
-                    ping_result)
-                if int(
-                        match.group(1)) == count and int(
-                        match.group(2)) == int(
-                        match.group(1)):
-                    self.log.info("All ping packets are passed!")
-                    return True
-                elif int(match.group(2)) < count:
-                    self.log.info("Some ping packets are dropped during ping!")
-                    if int(match.group(2)) < pass_count:
-                        self.log.error(
-                            "Error: Dropped ping packets are too much!")
-                        return False
-                    else:
-                        return True
         else:
-            self.log.info("Check ping result failed. pls check")
-            return False
+            self.log.info("All ping packets are passed!")
+            return True
 
     #############################
     # ftp
@@ -0,0 +1,40 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Tests of the parsers of the Linux extension on recorded outputs
+"""
+import pytest
+
+from chorus.extension.linux import LinuxClient
+
+PING = LinuxClient.parsers["ping"]
+
+
+@pytest.mark.parametrize("output, expected", [
+    ("--- 10.0.0.1 ping statistics ---\n"
+     "2 packets transmitted, 2 received, 0% packet loss, time 1001ms\n"
+     "rtt min/avg/max/mdev = 0.045/0.052/0.060/0.007 ms\n",
+     (2, 2, None, None, None, 0.0)),
+    ("5 packets transmitted, 3 received, +1 duplicates, +2 errors, 40% packet loss, time 4005ms\n",
+     (5, 3, 1, None, 2, 40.0)),
+    ("3 packets transmitted, 3 received, +1 duplicates, +2 errors, 40% packet loss\n",
+     (3, 3, 1, None, 2, 40.0)),
+    ("4 packets transmitted, 2 received, +1 duplicates, +1 corrupted, +1 errors, 50% packet loss\n",
+     (4, 2, 1, 1, 1, 50.0)),
+    ("4 packets transmitted, 0 received, +4 errors, 100% packet loss, time 3060ms\n",
+     (4, 0, None, None, 4, 100.0)),
+    ("3 packets transmitted, 3 packets received, 0.0% packet loss\n",
+     (3, 3, None, None, None, 0.0)),
+])
+def test_ping_statistics(output, expected):
+    stats = PING.parse(output)
+    assert len(stats) == 1
+    assert stats[0] == expected
+    assert stats[0]._fields == ("transmitted", "received", "duplicates", "corrupted", "errors", "loss")
+
+
+def test_ping_unknown_host():
+    assert PING.parse("ping: unknown host nowhere\n") == []
@@ -0,0 +1,141 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Case history.
+
+The recent durations and results of each testcase class, and the durations of fixtures, are kept in a json file
+under the log folder across runs. The history is updated by :class:`HistoryWriter` as each case finishes, and used
+to order cases (`chorus run --order`), to estimate fixture costs and to balance shards.
+"""
+import os
+import json
+import time
+
+from . import connection
+from .config import Config
+from .log import log, logcls
+from .report import ResultWriter
+from .testcase import Testcase
+from .utils import dump_json
+
+# weight of the latest duration of a fixture
+FIXTURE_ALPHA = 0.5
+# seconds between saves during a run
+SAVE_INTERVAL = 60
+
+
+class History(object):
+    """Per case history persisted in a json file
+
+    :param path: the history file
+    :param keep: count of recent runs kept for each case
+    """
+
+    def __init__(self, path, keep=10):
+        super(History, self).__init__()
+        self.path = path
+        self.keep = keep
+        self.cases = {}
+        self.fixtures = {}
+
+    def load(self):
+        """Load the history file, the history is empty if the file does not exist or is broken
+
+        :return: self
+        """
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    data = json.load(f)
+                self.cases = data.get("cases", {})
+                self.fixtures = data.get("fixtures", {})
+            except (ValueError, OSError) as e:
+                log.warning("Ignoring broken history file %s: %s", self.path, e)
+        return self
+
+    def save(self):
+        """Write the history file, replaced at once so that it is not broken by a crash"""
+        dump_json(self.path, {"cases": self.cases, "fixtures": self.fixtures})
+
+    def record(self, name, duration, status, fixture_sec=None):
+        """Record a run of a testcase
+
+        :param name: testcase class name
+        :param duration: seconds the testcase ran
+        :param status: the descriptive status of the result
+        :param fixture_sec: {fixture name: {"init": seconds, "clean": seconds}} called by the testcase
+        """
+        h = self.cases.setdefault(name, {"durations": [], "results": []})
+        h["durations"] = (h["durations"] + [duration])[-self.keep:]
+        h["results"] = (h["results"] + [status])[-self.keep:]
+        h["last_sec"] = time.time()
+        for fx, actions in (fixture_sec or {}).items():
+            f = self.fixtures.setdefault(fx, {})
+            for action, sec in actions.items():
+                if action in f:
+                    f[action] = FIXTURE_ALPHA * sec + (1 - FIXTURE_ALPHA) * f[action]
+                else:
+                    f[action] = sec
+
+    def duration(self, name):
+        """Mean duration of recent runs of a testcase, None if never run"""
+        durations = self.cases.get(name, {}).get("durations")
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+    def durations(self):
+        """{testcase class name: mean duration}"""
+        return dict((name, self.duration(name)) for name in self.cases if self.duration(name) is not None)
+
+    def failScore(self, name):
+        """How likely a testcase fails: (whether failed last time, count of recent failures)"""
+        passed = (Testcase.STATES[Testcase.PASS], Testcase.STATES[Testcase.SKIPPED])
+        results = self.cases.get(name, {}).get("results", [])
+        failures = len([r for r in results if r not in passed])
+        return (1 if results and results[-1] not in passed else 0, failures)
+
+
+class HistoryWriter(ResultWriter):
+    """Record each case result into the history file, :func:`historyPath` by default"""
+    extension = ".json"
+
+    def __init__(self, path=None):
+        super(HistoryWriter, self).__init__(path or historyPath())
+        self.history = None
+        self._saved_sec = 0
+
+    def open(self):
+        keep = Config().get_config("report", "history_keep") or 10
+        self.history = History(self.path, int(keep)).load()
+        self._saved_sec = time.time()
+
+    def write(self, case, result, rcode):
+        # dry runs tell nothing about durations
+        if result is None or connection.dummy_conn:
+            return
+        self.history.record(case.get("t_case_class_name"), result.end_sec - result.start_sec,
+                            Testcase.STATES[rcode], result.fixture_sec)
+        if time.time() - self._saved_sec > SAVE_INTERVAL:
+            self.history.save()
+            self._saved_sec = time.time()
+
+    def close(self):
+        if self.history is not None:
+            self.history.save()
+            self.history = None
+
+
+def historyPath():
+    """The history file configured by `report.history`, relative to the log folder"""
+    name = Config().get_config("report", "history") or "history.json"
+    return os.path.join(os.path.dirname(logcls.get().getLogPrefix()), name)
+
+
+def loadHistory():
+    """Load the history of former runs from :func:`historyPath`"""
+    keep = Config().get_config("report", "history_keep") or 10
+    return History(historyPath(), int(keep)).load()
@@ -46,6 +46,7 @@ class BasicLogger(object):
         self.logpath = ""
         self.log_prefix = ""
         self._log_files = {}
+        self._fh = None
         self.formatter = logging.Formatter(
             '[%(asctime)s][%(threadName).8s][%(levelname).4s]<%(name)s>: %(message)s',
             '%b %d %H:%M:%S')
@@ -83,10 +84,14 @@ class BasicLogger(object):
             os.mkdir(path)
         self.log_prefix = os.path.join(path, 'chorus_' + Config().get_uuid())
         self.logpath = self.log_prefix + self.EXTENSION
-        # file log output handler
+        # file log output handler, replacing the one of a former run in the same process
+        if self._fh is not None:
+            self._loggers["root"].removeHandler(self._fh)
+            self._fh.close()
         fh = logging.FileHandler(self.logpath, encoding='utf-8')
         fh.setLevel(logging.DEBUG)
         fh.setFormatter(self.formatter)
+        self._fh = fh
         self._loggers["root"].addHandler(fh)
         self._loggers["root"].addHandler(self.sth)
         # print chorus version on logging init
@@ -160,6 +165,23 @@ class BasicLogger(object):
     def getLogPrefix(self):
         return self.log_prefix
 
+    def forkLog(self, tag):
+        """Log to files of its own only, for worker processes forked from the main one
+
+        :param tag: tag of the worker, appended to the log prefix
+        """
+        root = self._loggers["root"]
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        self._log_files = {}
+        self.log_prefix = self.log_prefix + '_' + tag
+        self.logpath = self.log_prefix + self.EXTENSION
+        fh = logging.FileHandler(self.logpath, encoding='utf-8')
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(self.formatter)
+        self._fh = fh
+        root.addHandler(fh)
+
     def close(self):
         """close the log"""
         pass
@@ -198,6 +220,11 @@ def setLogPath(path):
     logcls.get().setLogPath(path)
 
 
+def forkLog(tag):
+    """Log to files of its own in a worker process"""
+    logcls.get().forkLog(tag)
+
+
 def getLogPrefix():
     """Get log path and prefix"""
     return logcls.get().getLogPrefix() + "_"
@@ -0,0 +1,123 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Structured output parsers.
+
+A :class:`Parser` is a named regular expression which is compiled once and turns the raw output of a
+command into a list of typed records. Each named group of the expression becomes a field of the record,
+and an optional converter (i.e. `int`) can be specified for each field.
+
+Parsers are attached to device classes by the `parsers` class attribute, keyed by command:
+
+::
+
+    class Linux(Device):
+        parsers = {
+            "ip link show": Parser(
+                "ip_link",
+                r"^\\d+: (?P<ifname>[^:@\\s]+)[^\\n]*?mtu (?P<mtu>\\d+)",
+                types={"mtu": int}),
+        }
+
+    for r in device.parse("ip link show"):
+        print(r.ifname, r.mtu)
+
+The expression is applied with `finditer` over the whole output, so the cost of parsing grows linearly with
+the size of the output. Results are cached by the hash of the output, so parsing the same output several times
+only costs a hash calculation.
+"""
+import re
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from .log import log
+
+
+class Parser(object):
+    """Compiled regular expression parser
+
+    :param name: name of the parser, also the type name of the records
+    :param regex: the regular expression, each named group is a field of the record
+    :param types: converters of the fields, i.e. {"mtu": int}. Unmatched fields are kept as None.
+    :param flags: regular expression flags, re.M by default
+    :param cache_size: how many parsed outputs to keep, 0 to disable caching
+    """
+
+    def __init__(self, name, regex, types=None, flags=re.M, cache_size=32):
+        super(Parser, self).__init__()
+        self.name = name
+        self.regex = re.compile(regex, flags)
+        if not self.regex.groupindex:
+            raise ParserException(
+                "Parser %s has no named group in: %s" % (name, regex))
+        # fields in the order they appear in the expression
+        self.fields = sorted(self.regex.groupindex,
+                             key=lambda g: self.regex.groupindex[g])
+        self.types = types or {}
+        for f in self.types:
+            if f not in self.regex.groupindex:
+                raise ParserException(
+                    "Unknown field %s for parser %s" % (f, name))
+        self.record = namedtuple(re.sub(r'\W', '_', name) or "Record",
+                                 self.fields)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _convert(self, match):
+        """Build a typed record from a match object"""
+        values = match.groupdict()
+        for f, conv in self.types.items():
+            if values[f] is not None:
+                values[f] = conv(values[f])
+        return self.record(**values)
+
+    def parse(self, output):
+        """Parse the output into a list of records
+
+        :param output: output string of a command
+        :return: a list of records, one for each match
+        """
+        if not self.cache_size:
+            return [self._convert(m) for m in self.regex.finditer(output)]
+        key = hashlib.sha1(output.encode('utf-8')).digest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return list(self._cache[key])
+        records = tuple(self._convert(m) for m in self.regex.finditer(output))
+        with self._lock:
+            self._cache[key] = records
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return list(records)
+
+    def search(self, output):
+        """Get the first record of the output, or None if not matched"""
+        m = self.regex.search(output)
+        if m is None:
+            return None
+        return self._convert(m)
+
+    def clearCache(self):
+        """Drop all cached results"""
+        with self._lock:
+            self._cache.clear()
+
+
+############################
+# Exceptions
+class ParserException(Exception):
+    """Exception handling class for parsers"""
+
+    def __init__(self, value):
+        super(ParserException, self).__init__()
+        self.value = "Parser Error due to: " + value
+        log.exception("Parser Error happens: %s!!", value)
+
+    def __str__(self):
+        return repr(self.value)
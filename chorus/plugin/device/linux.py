@@ -6,6 +6,9 @@
 import re
 
 from chorus.device import Device
+from chorus.parser import Parser
+
+ETH_IFNAME = re.compile(r"eth\d+$")
 
 
 class Linux(Device):
@@ -23,6 +26,13 @@ class Linux(Device):
             'PS1="chorus_auto# "'],
         "prompt_after": "chorus_auto# "}
     supported_con = ["ssh", "telnet", "local"]
+    parsers = {
+        "ip link show": Parser(
+            "ip_link",
+            r"^\d+: (?P<ifname>[^:\s]+): <(?P<flags>[^>]*)>[^\n]*?mtu (?P<mtu>\d+)[^\n]*\n"
+            r"\s+link/(?P<type>\w+)(?: (?P<mac>[\da-f:]+))?",
+            types={"mtu": int}),
+    }
 
     def __init__(
             self,
@@ -59,14 +69,10 @@ class Linux(Device):
 
     def getIfName(self, macaddress):
         """get the name of a interface by mac address"""
-        # first get the if name by idx
-        output = self.cmd("ip link show")
         # find only ethN
-        ifmacs = re.findall(
-            r"\d+: (eth\d+): .+\n\s+link/\w+ ([\d\:a-z]+)", output)
-        for (ifname, mac) in ifmacs:
-            if mac == macaddress:
-                return ifname
+        for r in self.parse("ip link show"):
+            if r.mac == macaddress and ETH_IFNAME.match(r.ifname):
+                return r.ifname
         self.log.error("No interface with mac address: %s" % macaddress)
         return None
 
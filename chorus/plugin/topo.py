@@ -34,6 +34,15 @@ class FixedTopo(Topo):
         else:
             return False
 
+    def deviceTargets(self):
+        """Devices are told by their ip and port, or by their names if no ip specified"""
+        targets = set()
+        for k, attrs in self.dict.items():
+            if k in self._reserved_keys or k.startswith("x_") or not isinstance(attrs, dict):
+                continue
+            targets.add((attrs.get("ip") or attrs.get("host") or k, attrs.get("port")))
+        return targets
+
     # fixed topo dict is the final front, this class now handles only this one
     def init(self, disconnected=False):
         """parse fixed topo dict and return modified device objects
@@ -78,13 +87,14 @@ class FixedTopo(Topo):
                 else:
                     raise TopoException("ipschema and connection not match")
 
+        for d in self.devices:
+            if 'conn_method' in self.dict[d]:
+                self.devices[d].setDefaultConnMethod(
+                    self.dict[d]["conn_method"])
         # Connect all the devices
         if not disconnected:
             self.log.debug("Connect the devices immediately")
             for d in self.devices:
-                if 'conn_method' in self.dict[d]:
-                    self.devices[d].setDefaultConnMethod(
-                        self.dict[d]["conn_method"])
                 self.devices[d].connect()
 
         self.log.info("End for Fixed topology initialization.")
@@ -0,0 +1,279 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Result writers.
+
+A result writer appends the result of each testcase to a file as soon as the result is settled, and syncs the
+file to disk, so that structured results survive a crash in the middle of a run. Nothing but the file is kept by
+the writers, thus memory does not grow with the count of testcases.
+
+Writers are plugins of type `report`, keyed by format:
+
+::
+
+    report:
+      junit: chorus.report.JunitWriter
+      jsonl: chorus.report.JsonlWriter
+
+The writers enabled by default are configured by `report.writers` in chorus.config, more can be added by
+`chorus run --report <format>[:<path>]`. Results are written next to the log file by default.
+
+Json lines result files can be read back by :func:`loadResults`, i.e. to merge the results of shards with
+`chorus merge-results`, or to run the failed testcases of a former run again with `chorus run --rerun-failed`.
+"""
+import os
+import glob
+import json
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+from .config import Config
+from .log import log, logcls
+from .testcase import Testcase, Result, StepResult, RowResult
+
+
+# result code of each status
+_RCODES = dict((v, k) for k, v in Testcase.STATES.items())
+
+
+class ResultWriter(object):
+    """Base class of result writers
+
+    :param path: the file to write, the log prefix plus :attr:`~extension` by default
+    """
+    extension = ""
+
+    def __init__(self, path=None):
+        super(ResultWriter, self).__init__()
+        self.path = path or logcls.get().getLogPrefix() + self.extension
+        self._file = None
+
+    def open(self):
+        """Create the file, called before the first testcase runs"""
+        self._file = open(self.path, 'wb')
+        log.info("Writing results to %s", self.path)
+
+    def write(self, case, result, rcode):
+        """Append the result of a testcase
+
+        :param case: the case dict of the testsuite
+        :param result: the :class:`~chorus.testcase.Result` of the testcase
+        :param rcode: the final result code of the testcase
+
+        implemented in subclasses
+        """
+        pass
+
+    def close(self):
+        """Close the file, called after all testcases finished"""
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+class JsonlWriter(ResultWriter):
+    """Write a json object for each testcase, one per line"""
+    extension = ".jsonl"
+
+    def write(self, case, result, rcode):
+        record = resultRecord(case, result, rcode)
+        line = json.dumps(record, default=str, ensure_ascii=False) + "\n"
+        self._file.write(line.encode('utf-8'))
+        self._sync()
+
+
+class JunitWriter(ResultWriter):
+    """Write a JUnit XML report. The closing tags are written after each testcase and overwritten by the next
+    one, so the file is a complete report at any time."""
+    extension = ".xml"
+    TAIL = b"</testsuite>\n</testsuites>\n"
+
+    def open(self):
+        super(JunitWriter, self).open()
+        head = '<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n<testsuite name=%s timestamp=%s>\n' % (
+            quoteattr("chorus_" + Config().get_uuid()),
+            quoteattr(time.strftime("%Y-%m-%dT%H:%M:%S")))
+        self._file.write(head.encode('utf-8'))
+        self._tail_pos = self._file.tell()
+        self._file.write(self.TAIL)
+        self._sync()
+
+    def write(self, case, result, rcode):
+        classname = (case.get("t_case_class_name") or "").replace(":", ".")
+        elapsed = result.end_sec - result.start_sec if result is not None else 0
+        xml = '<testcase classname=%s name=%s time="%.3f">' % (
+            quoteattr(classname), quoteattr(case.get("t_case_name") or classname), elapsed)
+        if rcode != Testcase._passvalue:
+            status = Testcase.STATES[rcode]
+            failed_on = result.failed_on if result is not None else []
+            detail = "\n".join("%s: %s" % (f["step"], f["desc"]) for f in failed_on)
+            if rcode == Testcase._skippedvalue:
+                xml += '<skipped/>'
+            else:
+                tag = "failure" if rcode == Testcase._failvalue else "error"
+                xml += '<%s type=%s message=%s>%s</%s>' % (
+                    tag, quoteattr(status), quoteattr(detail.split("\n")[0] or status), escape(detail), tag)
+        xml += '</testcase>\n'
+        self._file.seek(self._tail_pos)
+        self._file.write(xml.encode('utf-8'))
+        self._tail_pos = self._file.tell()
+        self._file.write(self.TAIL)
+        self._file.truncate()
+        self._sync()
+
+
+def resultRecord(case, result, rcode):
+    """Serializable record of a case result, written by :class:`JsonlWriter` and read by :func:`loadResults`"""
+    record = {
+        "uuid": Config().get_uuid(),
+        "name": case.get("t_case_name"),
+        "class": case.get("t_case_class_name"),
+        "topo": case.get("topo"),
+        "status": Testcase.STATES[rcode],
+        "kwargs": case.get("kwargs", {}),
+    }
+    if result is not None:
+        record.update({
+            "start_sec": result.start_sec,
+            "end_sec": result.end_sec,
+            "step_count": result.step_count,
+            "step_run": result.step_run,
+            "failed_on": result.failed_on,
+            "fixtures": result.fixture_sec,
+            "steps": [[_stepDict(r) for r in rlist] for rlist in result.step_results],
+            "rows": [[r.index, Testcase.STATES[r.rcode], r.run_sec, r.error] for r in result.rows],
+        })
+        if case.get("t_case_rows") and result.rows:
+            # data of the rows not passed, to run them again
+            record["row_data"] = dict((r.index, case["t_case_rows"][r.index]) for r in result.rows
+                                      if r.rcode not in (Testcase._passvalue, Testcase._skippedvalue))
+    return record
+
+
+def _stepDict(r):
+    """Serializable dict of a step result"""
+    d = dict((k, getattr(r, k)) for k in StepResult.__slots__)
+    d["status"] = r.status
+    d["start_sec"] = r.start_sec
+    d["end_sec"] = r.end_sec
+    return d
+
+
+def getWriter(spec):
+    """Get a result writer
+
+    :param spec: `<format>[:<path>]`, the format is the tag of the `report` plugin
+    :return: the writer, or None if no such format
+    """
+    tag, _, path = spec.partition(":")
+    cls = Config().get_plugin("report", tag)
+    if cls is None:
+        log.error("No such result format: %s", tag)
+        return None
+    return cls(path or None)
+
+
+def loadResults(path):
+    """Read a result file written by :class:`JsonlWriter`, broken lines of a crashed run are skipped
+
+    :param path: the result file
+    :return: a generator of (case, result, rcode), which can be written to other writers
+    """
+    with open(path, encoding='utf-8') as f:
+        for n, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                log.warning("Broken result at line %d of %s, skipped", n + 1, path)
+                continue
+            rcode = _RCODES.get(record.get("status"), Testcase._unvalue)
+            result = Result(record.get("name"), record.get("step_count", 0), rcode=rcode)
+            result.start_sec = record.get("start_sec", 0)
+            result.end_sec = record.get("end_sec", 0)
+            result.step_run = record.get("step_run", 0)
+            result.failed_on = record.get("failed_on", [])
+            result.fixture_sec = record.get("fixtures", {})
+            result.step_results = [[_stepResult(d) for d in rlist] for rlist in record.get("steps", [])]
+            result.rows = [RowResult(i, _RCODES.get(status, Testcase._unvalue), run_sec, error)
+                           for i, status, run_sec, error in record.get("rows", [])]
+            case = {"t_case_name": record.get("name"),
+                    "t_case_class_name": record.get("class"),
+                    "topo": record.get("topo"),
+                    "kwargs": record.get("kwargs", {})}
+            if "row_data" in record:
+                case["t_case_rows"] = [record["row_data"][i] for i in sorted(record["row_data"], key=int)]
+            yield case, result, rcode
+
+
+def findResults(uuid=None):
+    """Find the result file of a former run in the log folder, written by :class:`JsonlWriter` by default
+
+    :param uuid: uuid of the run, or path of the result file, the latest run by default
+    :return: path of the result file, None if not found
+    """
+    if uuid and os.path.isfile(uuid):
+        return uuid
+    current = logcls.get().getLogPrefix()
+    folder = os.path.dirname(current)
+    if uuid:
+        path = os.path.join(folder, "chorus_%s%s" % (uuid, JsonlWriter.extension))
+        return path if os.path.isfile(path) else None
+    paths = [p for p in glob.glob(os.path.join(folder, "chorus_*" + JsonlWriter.extension))
+             if p != current + JsonlWriter.extension]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def loadDurations(paths):
+    """Mean duration of each testcase class in result files
+
+    :param paths: result files written by :class:`JsonlWriter`
+    :return: {class name: seconds}
+    """
+    total = {}
+    for path in paths:
+        for case, result, _ in loadResults(path):
+            name = case["t_case_class_name"]
+            sec, count = total.get(name, (0.0, 0))
+            total[name] = (sec + result.end_sec - result.start_sec, count + 1)
+    return dict((name, sec / count) for name, (sec, count) in total.items())
+
+
+def loadFixtureDurations(paths):
+    """Mean durations of the fixtures called in result files
+
+    :param paths: result files written by :class:`JsonlWriter`
+    :return: {fixture name: {"init": seconds, "clean": seconds}}
+    """
+    total = {}
+    for path in paths:
+        for _, result, _ in loadResults(path):
+            for name, actions in result.fixture_sec.items():
+                for action, sec in actions.items():
+                    key = (name, action)
+                    t, count = total.get(key, (0.0, 0))
+                    total[key] = (t + sec, count + 1)
+    durations = {}
+    for (name, action), (t, count) in total.items():
+        durations.setdefault(name, {})[action] = t / count
+    return durations
+
+
+def _stepResult(d):
+    r = StepResult(d.get("id"), d.get("desc"))
+    for k in StepResult.__slots__:
+        if k in d:
+            setattr(r, k, d[k])
+    r.rcode = _RCODES.get(d.get("status"), Testcase._unvalue)
+    r.start_sec = d.get("start_sec", 0)
+    r.end_sec = d.get("end_sec", 0)
+    return r
@@ -0,0 +1,157 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Case scheduling.
+
+Cases of the same topology run one after another, and the fixtures of the common prefix of the fixture chains of two
+successive cases are not cleaned up and initialized again in between. The scheduler orders the cases of each
+topology by a depth first walk of the trie of their fixture chains, so that each topology is initialized once and
+each fixture of the trie is initialized and cleaned up only once.
+
+The cost of an order is estimated by the durations of fixtures recorded in former runs, see :class:`FixtureCost`.
+
+An ordering policy (:data:`ORDERS`) weighs cases by their history, see :class:`~chorus.history.History`. Weights
+only reorder topologies and the sibling subtrees of the trie, so the grouping above is kept:
+
+* `failed-first`: cases failed recently run first, the weight of a subtree is the weight of its worst case.
+* `longest-first`: cases taking long run first, the weight of a subtree is the sum of its cases.
+"""
+from collections import OrderedDict
+
+ORDERS = ("failed-first", "longest-first")
+
+
+class FixtureCost(object):
+    """Cost model of fixtures
+
+    :param durations: {fixture name: {"init": seconds, "clean": seconds}} recorded in former runs. Fixtures not
+        recorded cost as much as the mean of the recorded ones, or 1 if nothing recorded.
+    """
+
+    def __init__(self, durations=None):
+        super(FixtureCost, self).__init__()
+        self.durations = durations or {}
+        known = [sec for d in self.durations.values() for sec in d.values()]
+        self.default = sum(known) / len(known) if known else 1.0
+
+    def cost(self, fx, action):
+        """Cost of calling `init` or `clean` of a fixture chain entry, 0 if the fixture does not define it"""
+        if action not in fx:
+            return 0.0
+        return self.durations.get(fx['name'], {}).get(action, self.default)
+
+    def estimate(self, cases):
+        """Estimate the fixture cost of running the cases in order
+
+        :param cases: case dicts of the testsuite
+        :return: (seconds, count of init and clean calls, count of topology initializations)
+        """
+        sec = 0.0
+        calls = 0
+        topos = 0
+        topo = None
+        chain = []
+        for c in list(cases) + [None]:
+            fxs = c['t_case_fx'] if c is not None else []
+            keep = 0
+            if c is not None and c['topo'] == topo:
+                while keep < min(len(chain), len(fxs)) and chain[keep]['name'] == fxs[keep]['name']:
+                    keep += 1
+            elif c is not None:
+                topo = c['topo']
+                topos += 1
+            for fx in chain[keep:]:
+                if 'clean' in fx:
+                    sec += self.cost(fx, 'clean')
+                    calls += 1
+            for fx in fxs[keep:]:
+                if 'init' in fx:
+                    sec += self.cost(fx, 'init')
+                    calls += 1
+            chain = fxs
+        return sec, calls, topos
+
+
+class _Node(object):
+    """Node of the fixture chain trie"""
+    __slots__ = ("children", "cases", "count", "weight")
+
+    def __init__(self):
+        self.children = OrderedDict()
+        self.cases = []
+        self.count = 0
+        self.weight = None
+
+    def insert(self, case):
+        node = self
+        node.count += 1
+        for fx in case['t_case_fx']:
+            node = node.children.setdefault(fx['name'], _Node())
+            node.count += 1
+        node.cases.append(case)
+
+    def walk(self):
+        """Cases in depth first order, in the order they are inserted among siblings"""
+        cases = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            cases.extend(node.cases)
+            stack.extend(reversed(list(node.children.values())))
+        return cases
+
+    def weigh(self, key, combine):
+        """Weigh the subtree and reorder cases and children by weight, heavier first. Sorting is stable, so
+        the order of insertion is kept among equal weights.
+
+        :param key: weight of a case
+        :param combine: weight of a subtree from the weights of its cases and children, i.e. max or sum
+        """
+        # post order without recursion, the trie can be as deep as the class hierarchy
+        stack = [(self, False)]
+        while stack:
+            node, done = stack.pop()
+            if not done:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children.values())
+                continue
+            weights = dict((id(c), key(c)) for c in node.cases)
+            node.cases.sort(key=lambda c: weights[id(c)], reverse=True)
+            node.children = OrderedDict(
+                sorted(node.children.items(), key=lambda item: item[1].weight, reverse=True))
+            node.weight = combine(list(weights.values()) + [child.weight for child in node.children.values()])
+        return self.weight
+
+
+def schedule(cases, order=None, history=None):
+    """Order cases by topology, and by their fixture chains in each topology
+
+    :param cases: case dicts of the testsuite
+    :param order: an ordering policy of :data:`ORDERS`, None to keep the order of insertion
+    :param history: :class:`~chorus.history.History` of former runs, required by `order`
+    :return: a new list of the ordered cases
+    """
+    topos = OrderedDict()
+    for c in cases:
+        if c['topo'] not in topos:
+            topos[c['topo']] = _Node()
+        topos[c['topo']].insert(c)
+    if order is None or history is None:
+        # topologies with less cases first
+        roots = sorted(topos.values(), key=lambda n: n.count)
+    else:
+        if order == "failed-first":
+            key, combine = lambda c: history.failScore(c['t_case_class_name']), max
+        elif order == "longest-first":
+            known = list(history.durations().values())
+            default = sum(known) / len(known) if known else 1.0
+            key, combine = lambda c: history.duration(c['t_case_class_name']) or default, sum
+        else:
+            raise ValueError("Unknown order %s, expecting one of %s" % (order, ", ".join(ORDERS)))
+        for root in topos.values():
+            root.weigh(key, combine)
+        roots = sorted(topos.values(), key=lambda n: n.weight, reverse=True)
+    return [c for root in roots for c in root.walk()]
@@ -0,0 +1,233 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Chorus daemon.
+
+`chorus serve` runs testcases on requests of `chorus run --attach` in a long-lived process, so that what is costly
+to set up is kept warm between runs:
+
+* config and plugins are loaded once.
+* the discovery index is kept in memory, and the libraries imported by testcases stay in `sys.modules`. Testcase
+  modules are still imported again on each run, so that changes of testcases take effect.
+* topologies are not cleaned up after a run, their devices are kept connected for the next run, see
+  :attr:`chorus.topo.Topo.keep_warm`. A topology is added again only if its file changes.
+
+Requests are accepted on a Unix socket, `serve.socket` in chorus.config by default, and run one at a time in the
+main thread of the daemon. A request is a json line of the parsed arguments of `chorus run` and the working folder
+of the client. Log records and case results are streamed back as json lines as the run goes, followed by the exit
+code of the run:
+
+::
+
+    {"log": "[Jun 01 08:00:00][MainThre][INFO]<chorus>: ..."}
+    {"result": {"name": "...", "status": "PASS", ...}}
+    {"exit": 0}
+
+Result records are in the format of :func:`~chorus.report.resultRecord`.
+"""
+import os
+import copy
+import json
+import signal
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+
+from .config import Config
+from .log import log, logcls, setLogPath
+from .report import resultRecord
+from .testsuite import Testsuite
+from .topo import Topo
+
+
+class _Stream(object):
+    """Json lines sent to a client, dropped silently once the client is gone"""
+
+    def __init__(self, wfile):
+        super(_Stream, self).__init__()
+        self.wfile = wfile
+        self.alive = True
+        self._lock = threading.Lock()
+
+    def send(self, **msg):
+        if not self.alive:
+            return
+        line = (json.dumps(msg, default=str, ensure_ascii=False) + "\n").encode('utf-8')
+        with self._lock:
+            try:
+                self.wfile.write(line)
+                self.wfile.flush()
+            except OSError:
+                # nothing is logged here, which would be sent again
+                self.alive = False
+
+
+class _StreamLogHandler(logging.Handler):
+    """Send log records to a client, at the level of the console"""
+
+    def __init__(self, stream):
+        logger = logcls.get()
+        super(_StreamLogHandler, self).__init__(logger.sth.level)
+        self.setFormatter(logger.formatter)
+        self.stream = stream
+
+    def emit(self, record):
+        try:
+            self.stream.send(log=self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class _RunHandler(socketserver.StreamRequestHandler):
+    """Handle a run request"""
+
+    def handle(self):
+        stream = _Stream(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            args = argparse.Namespace(**request["args"])
+            cwd = request["cwd"]
+        except (ValueError, KeyError, TypeError) as e:
+            log.error("Bad run request: %s", e)
+            stream.send(log="Bad run request: %s" % e)
+            stream.send(exit=None)
+            return
+        stream.send(exit=self.server.runRequest(args, cwd, stream))
+
+
+class RunServer(socketserver.UnixStreamServer):
+    """Run testcases on requests over a Unix socket, one run at a time
+
+    :param path: path of the socket
+    :param run: function running a request, i.e. :meth:`chorus.cli.Run.run`, called with the parsed arguments of
+        `chorus run` and returning the exit code
+    """
+
+    def __init__(self, path, run):
+        self.path = path
+        self.run = run
+        self.runs = 0
+        self._cwd = os.getcwd()
+        self._log_path = os.path.dirname(os.path.dirname(logcls.get().getLogPrefix()))
+        self._uuid = Config().get_uuid()
+        super(RunServer, self).__init__(path, _RunHandler)
+
+    def runRequest(self, args, cwd, stream):
+        """Run a request in the working folder of the client, logging to files of the uuid of the client"""
+        self.runs += 1
+        log.info("Run %d requested in %s with uuid %s", self.runs, cwd, args.global_uuid)
+        saved = copy.deepcopy(Config()._config)
+        handler = _StreamLogHandler(stream)
+
+        def sendResult(ts, case, rcode):
+            stream.send(result=resultRecord(case, case.get("t_case_result"), rcode))
+
+        Config().renew_uuid(args.global_uuid)
+        logging.getLogger().addHandler(handler)
+        # a slow client does not hold the run
+        Testsuite.register_callback("on_case_result", sendResult, asynchronous=True)
+        try:
+            os.chdir(cwd)
+            if args.topo_workers:
+                log.warn("Topologies are run one by one by chorus serve, to keep them warm.")
+                args.topo_workers = None
+            return self.run(args)
+        except BaseException:
+            log.exception("Error running request in %s:", cwd)
+            return None
+        finally:
+            Testsuite.unregister_callback("on_case_result", sendResult)
+            logging.getLogger().removeHandler(handler)
+            Config()._config = saved
+            Config().renew_uuid(self._uuid)
+            os.chdir(self._cwd)
+            setLogPath(self._log_path)
+            warm = [t.name for t in Topo.__topos__.values() if t.warm]
+            log.info("Run %d finished, warm topologies: %s", self.runs, ", ".join(warm) or "none")
+
+
+def socketPath(path=None):
+    """Absolute path of the socket, `serve.socket` in chorus.config by default"""
+    return os.path.abspath(path or Config().get_config("serve", "socket") or os.path.join(".log", "chorus.sock"))
+
+
+def serve(run, path=None):
+    """Run the daemon until interrupted or terminated
+
+    :param run: function running a request, see :class:`RunServer`
+    :param path: path of the socket, see :func:`socketPath`
+    """
+    path = socketPath(path)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            log.error("Another chorus daemon is serving on %s", path)
+            return False
+        except OSError:
+            # left by a daemon not stopped normally
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    Topo.keep_warm = True
+    server = RunServer(path, run)
+    log.info("Chorus daemon serving on %s", path)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        log.info("Chorus daemon stopped after %d runs", server.runs)
+    finally:
+        server.server_close()
+        os.unlink(path)
+        Topo.cleanWarm()
+    return True
+
+
+def attach(args, path=None):
+    """Run on the daemon, printing the logs streamed back
+
+    :param args: the parsed arguments of `chorus run`
+    :param path: path of the socket, see :func:`socketPath`
+    :return: the exit code of the run, None if the daemon is not reachable or gone
+    """
+    path = socketPath(path)
+    request = {
+        "args": dict((k, v) for k, v in vars(args).items() if k != "func"),
+        "cwd": os.getcwd(),
+    }
+    # run on the daemon rather than attaching again
+    request["args"]["attach"] = None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        print("Unable to attach to chorus daemon on %s: %s" % (path, e))
+        sock.close()
+        return None
+    counts = {}
+    with sock, sock.makefile('rwb') as f:
+        f.write((json.dumps(request, default=str) + "\n").encode('utf-8'))
+        f.flush()
+        for line in f:
+            msg = json.loads(line.decode('utf-8'))
+            if "log" in msg:
+                print(msg["log"])
+            elif "result" in msg:
+                status = msg["result"]["status"]
+                counts[status] = counts.get(status, 0) + 1
+            elif "exit" in msg:
+                print("%d cases run by chorus daemon: %s" % (
+                    sum(counts.values()), ", ".join("%s %d" % (k, counts[k]) for k in sorted(counts)) or "none"))
+                return msg["exit"]
+    print("Connection to chorus daemon lost")
+    return None
@@ -0,0 +1,253 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Tests of the discovery index on a tree of testcase modules
+"""
+import os
+import json
+
+import pytest
+
+from chorus.discovery import DiscoveryIndex, INDEX_VERSION, parseModule, walk
+
+TREE = {
+    "base.py": "from chorus.testcase import Testcase\n\n\nclass Base(Testcase):\n    topo = 't'\n",
+    "cases.py": "from base import Base\n\n\nclass A(Base):\n    def step1(self):\n        pass\n\n\n"
+                "class Helper(object):\n    pass\n",
+    "alias.py": "import base as b\n\n\nclass B(b.Base):\n    pass\n",
+    "reexport.py": "from base import Base\n",
+    "user.py": "from reexport import Base as Renamed\n\n\nclass R(Renamed):\n    pass\n",
+    "star.py": "from base import *\n\n\nclass S(Base):\n    pass\n",
+    "cycle1.py": "from cycle2 import X\n\n\nclass Y(X):\n    pass\n",
+    "cycle2.py": "from cycle1 import Y\n\n\nclass X(Y):\n    pass\n",
+    "external.py": "import collections\n\n\nclass O(collections.OrderedDict):\n    pass\n",
+    "aliased.py": "from chorus.testcase import Testcase\n\nBase = Testcase\n\n\nclass Aliased(Base):\n    pass\n\n\n"
+                  "class Plain(Testcase):\n    pass\n",
+    "unbound.py": "from chorus.testcase import Testcase\n\nglobals()['Mixin'] = object\n\n\n"
+                  "class Odd(Mixin):\n    pass\n",
+    "conditional.py": "import sys\nfrom chorus.testcase import Testcase\n\nif True:\n"
+                      "    class Conditional(Testcase):\n        topo = 't'\nelse:\n"
+                      "    class Other(Testcase):\n        pass\ntry:\n    import json\nexcept ImportError:\n"
+                      "    class Fallback(Testcase):\n        pass\nfinally:\n    pass\n"
+                      "with open(__file__):\n    class Opened(Testcase):\n        pass\n\n\n"
+                      "class Plain(Testcase):\n    pass\n",
+    "broken.py": "class (:\n",
+    "pkg/__init__.py": "",
+    "pkg/common.py": "from base import Base\n\n\nclass Common(Base):\n    pass\n",
+    "pkg/fx.py": "from .common import Common\n\n\nclass C(Common):\n    topo = None\n",
+    "pkg/sub/deep.py": "from ..common import Common\n\n\nclass D(Common):\n    pass\n",
+    ".git/hooks.py": "from base import Base\n\n\nclass G(Base):\n    pass\n",
+    "venv/lib.py": "",
+    "notes.txt": "",
+}
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for rel, source in TREE.items():
+        path = tmp_path.joinpath(*rel.split("/"))
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        path.write_text(source)
+    return str(tmp_path)
+
+
+def module(name):
+    return name.replace("/", os.sep)
+
+
+def test_walk_prunes_ignored_folders(tree):
+    names = [name for name, _ in walk(tree, True, [".git", "venv*"])]
+    # modules of a folder before its sub folders
+    assert names == [module(n) for n in ["alias", "aliased", "base", "broken", "cases", "conditional", "cycle1",
+                                         "cycle2", "external", "reexport", "star", "unbound", "user",
+                                         "pkg/__init__", "pkg/common", "pkg/fx", "pkg/sub/deep"]]
+    paths = [path for _, path in walk(tree, True)]
+    assert os.path.join(tree, ".git", "hooks.py") in paths and os.path.join(tree, "venv", "lib.py") in paths
+    assert [name for name, _ in walk(tree)] == ["alias", "aliased", "base", "broken", "cases", "conditional",
+                                                "cycle1", "cycle2", "external", "reexport", "star", "unbound",
+                                                "user"]
+    paths = dict(walk(tree, True, [".git", "venv"]))
+    assert paths[module("pkg/sub/deep")] == os.path.join(tree, "pkg", "sub", "deep.py")
+
+
+def test_walk_does_not_follow_links(tree):
+    os.symlink(os.path.join(tree, "pkg"), os.path.join(tree, "link"))
+    names = [name for name, _ in walk(tree, True, [".git", "venv"])]
+    assert not [n for n in names if n.startswith("link")]
+
+
+def test_testcases(tree):
+    index = DiscoveryIndex()
+    found, unknown = index.testcases(walk(tree, True, [".git", "venv"]))
+    assert sorted(name for name, _, _, _ in found) == [
+        "alias:B", "base:Base", "cases:A", "conditional:Conditional", "conditional:Fallback", "conditional:Opened",
+        "conditional:Other", "conditional:Plain", module("pkg/common:Common"), module("pkg/fx:C"),
+        module("pkg/sub/deep:D"), "user:R"]
+    # bases bound by an assignment, by *, or not bound by the module are resolved by importing the module
+    assert sorted(unknown) == [(name, os.path.join(tree, name + ".py")) for name in ["aliased", "star", "unbound"]]
+    # resolved by importing collections once
+    assert index.external == {"collections.OrderedDict": False}
+    entry = dict((name, e) for name, _, _, e in found)["cases:A"]
+    assert entry["steps"] == ["step1"]
+    assert entry["line"] == 4
+
+
+def test_topologies(tree):
+    index = DiscoveryIndex()
+    index.testcases(walk(tree, True, [".git", "venv"]))
+    assert index.topo("cases", "A") == "t"
+    assert index.topo("user", "R") == "t"
+    assert index.topo(module("pkg/sub/deep"), "D") == "t"
+    assert index.topo(module("pkg/fx"), "C") is None
+    # not sure through classes outside of the index, or bases not followed
+    assert index.topo("external", "O") is False
+    assert index.topo("cycle1", "Y") is False
+    assert index.topo("conditional", "Conditional") == "t"
+
+
+def test_dependencies(tree):
+    index = DiscoveryIndex()
+    index.testcases(walk(tree, True, [".git", "venv"]))
+    assert index.dependencies("user") == set(["reexport"])
+    assert index.dependencies(module("pkg/sub/deep")) == set([module("pkg/common")])
+    assert index.closure("user") == set(["user", "reexport", "base"])
+    assert index.affected([os.path.join(tree, "base.py")]) == set(
+        ["base", "cases", "alias", "reexport", "user", "star", module("pkg/common"), module("pkg/fx"),
+         module("pkg/sub/deep")])
+    assert index.affected([os.path.join(tree, "pkg", "fx.py")]) == set([module("pkg/fx")])
+
+
+def test_steps_in_order_of_ids():
+    source = b"class T(object):\n" + b"".join(
+        b"    def %s(self):\n        pass\n" % name for name in [b"step10", b"step2_10", b"step2", b"step2_2", b"test1"])
+    assert parseModule(source, "t.py")["classes"]["T"]["steps"] == ["step2", "step2_2", "step2_10", "step10"]
+
+
+def test_class_attributes():
+    source = (b"class T(object):\n    METHOD_PREFIX = 'check'\n    topo = NAME\n"
+              b"    def check1(self):\n        pass\n    def step1(self):\n        pass\n"
+              b"class U(T):\n    topo = None\n"
+              b"class V(T):\n    pass\n")
+    classes = parseModule(source, "t.py")["classes"]
+    assert classes["T"]["steps"] == ["check1"]
+    assert classes["T"]["topo"] is False
+    assert classes["U"]["topo"] is None
+    assert "topo" not in classes["V"]
+    assert parseModule(b"class (:\n", "t.py")["error"]
+
+
+def test_module_level_blocks_and_assignments(tree):
+    with open(os.path.join(tree, "conditional.py"), "rb") as f:
+        entry = parseModule(f.read(), "conditional.py")
+    assert sorted(entry["classes"]) == ["Conditional", "Fallback", "Opened", "Other", "Plain"]
+    assert entry["imports"]["json"] == "json"
+    with open(os.path.join(tree, "aliased.py"), "rb") as f:
+        assert parseModule(f.read(), "aliased.py")["assigns"] == ["Base"]
+    # names assigned in blocks, and by unpacking
+    assert parseModule(b"if True:\n    A, (B, C) = 1, (2, 3)\n", "t.py")["assigns"] == ["A", "B", "C"]
+
+
+def test_imported_modules_find_all_testcases(tree):
+    """Testcases of a module imported to be inspected are not reported by the index as well"""
+    index = DiscoveryIndex()
+    found, unknown = index.testcases([("aliased", os.path.join(tree, "aliased.py"))])
+    assert found == []
+    assert unknown == [("aliased", os.path.join(tree, "aliased.py"))]
+
+
+def test_scan_invalidation(tree):
+    index = DiscoveryIndex()
+    path = os.path.join(tree, "cases.py")
+    entry = index.scan(path)
+    assert (index.hits, index.misses) == (0, 1)
+    # unchanged modification time and size
+    assert index.scan(path) is entry
+    assert (index.hits, index.misses) == (1, 1)
+    # touched, but the same content
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    touched = index.scan(path)
+    assert (index.hits, index.misses) == (2, 1)
+    assert touched["classes"] == entry["classes"]
+    assert touched["mtime_ns"] == st.st_mtime_ns + 10 ** 9
+    # the same size and modification time are taken as unchanged
+    with open(path, "w") as f:
+        f.write(TREE["cases.py"].replace("class A", "class Z"))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert "A" in index.scan(path)["classes"]
+    assert (index.hits, index.misses) == (3, 1)
+    # the content changed with the modification time
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+    assert "Z" in index.scan(path)["classes"]
+    assert (index.hits, index.misses) == (3, 2)
+    # the size changed
+    with open(path, "a") as f:
+        f.write("\n\nclass W(Base):\n    pass\n")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+    assert "W" in index.scan(path)["classes"]
+    assert (index.hits, index.misses) == (3, 3)
+
+
+def test_save_and_load(tree, tmp_path):
+    path = str(tmp_path / "index.json")
+    index = DiscoveryIndex(path)
+    index.testcases(walk(tree, False))
+    index.save()
+    loaded = DiscoveryIndex(path).load()
+    assert loaded.files == json.loads(json.dumps(index.files))
+    assert loaded.external == index.external
+    found, _ = loaded.testcases(walk(tree, False))
+    assert (loaded.hits, loaded.misses) == (13, 0)
+    assert "cases:A" in [name for name, _, _, _ in found]
+    # removed modules are dropped
+    os.remove(os.path.join(tree, "alias.py"))
+    loaded._dirty = True
+    loaded.save()
+    assert os.path.join(tree, "alias.py") not in DiscoveryIndex(path).load().files
+
+
+def test_load_outdated(tree, tmp_path):
+    path = str(tmp_path / "index.json")
+    with open(path, "w") as f:
+        json.dump({"version": [INDEX_VERSION - 1, 3, 5], "files": {"x.py": {}}}, f)
+    assert DiscoveryIndex(path).load().files == {}
+    with open(path, "w") as f:
+        f.write("{broken")
+    assert DiscoveryIndex(path).load().files == {}
+
+
+def test_ambiguous_module_names(tmp_path):
+    for rel, source in [("base.py", TREE["base.py"]),
+                        ("pkg/base.py", "class Base(object):\n    pass\n"),
+                        ("cases.py", "from base import Base\n\n\nclass A(Base):\n    pass\n"),
+                        ("other.py", "from pkg.base import Base\n\n\nclass N(Base):\n    pass\n")]:
+        path = tmp_path.joinpath(*rel.split("/"))
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        path.write_text(source)
+    index = DiscoveryIndex()
+    found, unknown = index.testcases(walk(str(tmp_path), True))
+    assert index._findModule("cases", "base") is None
+    assert index._findModule("other", "pkg.base") == module("pkg/base")
+    # base of A can be either Base, it is resolved by importing the module
+    assert sorted(name for name, _, _, _ in found) == ["base:Base"]
+    assert [name for name, _ in unknown] == ["cases"]
+    # both are dependencies anyway
+    assert index.dependencies("cases") == set(["base", module("pkg/base")])
+
+
+def test_lazy_import_checks_classes(tmp_path):
+    from chorus.testsuite import Testsuite
+    path = tmp_path / "wrong.py"
+    path.write_text("Case = 1\n\n\nclass Helper(object):\n    topo = 't'\n")
+    suite = Testsuite(pathlist=[str(tmp_path)])
+    for name in ("wrong:Case", "wrong:Helper", "wrong:Missing"):
+        suite._case_class[name] = None
+        suite._case_module[name] = ("wrong", str(path))
+        assert suite._getCaseClass(name) is None
+        assert not suite.addcase(name)
+    assert suite.cases == []
@@ -0,0 +1,117 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Tests of the structured output parsers, and of their lookup by device classes
+"""
+import hashlib
+
+import pytest
+
+from chorus.device import Device
+from chorus.parser import Parser, ParserException
+
+MTU = r"^(?P<ifname>\w+): mtu (?P<mtu>\d+)(?: state (?P<state>\w+))?"
+OUTPUT = "eth0: mtu 1500 state UP\neth1: mtu 9000\n"
+
+
+def sha1(output):
+    return hashlib.sha1(output.encode('utf-8')).digest()
+
+
+def test_fields_in_order_of_expression():
+    p = Parser("if mtu", MTU, types={"mtu": int})
+    assert p.fields == ["ifname", "mtu", "state"]
+    assert p.record.__name__ == "if_mtu"
+
+
+def test_typed_conversion():
+    records = Parser("mtu", MTU, types={"mtu": int}).parse(OUTPUT)
+    assert records == [("eth0", 1500, "UP"), ("eth1", 9000, None)]
+    assert records[0].mtu == 1500 and isinstance(records[0].mtu, int)
+    # unmatched fields are kept as None, not converted
+    assert records[1].state is None
+
+
+def test_search():
+    p = Parser("mtu", MTU, types={"mtu": int})
+    assert p.search(OUTPUT).ifname == "eth0"
+    assert p.search("nothing") is None
+
+
+def test_invalid_parsers():
+    with pytest.raises(ParserException):
+        Parser("plain", r"\d+")
+    with pytest.raises(ParserException):
+        Parser("mtu", MTU, types={"speed": int})
+
+
+def test_cache_keyed_by_sha1_of_output():
+    p = Parser("mtu", MTU, types={"mtu": int})
+    first = p.parse(OUTPUT)
+    assert list(p._cache) == [sha1(OUTPUT)]
+    # a hit returns the cached records without matching again
+    p.regex = None
+    assert p.parse(OUTPUT) == first
+    # the returned list is a copy
+    first.pop()
+    assert len(p.parse(OUTPUT)) == 2
+
+
+def test_cache_lru_eviction():
+    p = Parser("mtu", MTU, cache_size=2)
+    a, b, c = "a: mtu 1", "b: mtu 2", "c: mtu 3"
+    p.parse(a)
+    p.parse(b)
+    p.parse(a)
+    p.parse(c)
+    assert list(p._cache) == [sha1(a), sha1(c)]
+    p.clearCache()
+    assert not p._cache
+
+
+def test_cache_disabled():
+    p = Parser("mtu", MTU, cache_size=0)
+    assert p.parse(OUTPUT)[1].ifname == "eth1"
+    assert not p._cache
+
+
+class Base(Device):
+    parsers = {
+        "show mtu": Parser("base_mtu", MTU),
+        "show ver": Parser("base_ver", r"version (?P<version>\S+)"),
+    }
+
+
+class Child(Base):
+    parsers = {
+        "show mtu": Parser("child_mtu", MTU, types={"mtu": int}),
+    }
+
+
+class Mixin(object):
+    parsers = {
+        "show uptime": Parser("uptime", r"up (?P<days>\d+) days", types={"days": int}),
+    }
+
+
+class Extended(Mixin, Child):
+    """Built like the classes extended by :func:`chorus.config.extend`"""
+
+
+class Plain(Child):
+    """No parsers of its own"""
+
+
+def test_get_parser_along_mro():
+    assert Child.getParser("show mtu").name == "child_mtu"
+    assert Child.getParser("show ver").name == "base_ver"
+    assert Base.getParser("show mtu").name == "base_mtu"
+    assert Plain.getParser("show mtu").name == "child_mtu"
+    assert Extended.getParser("show uptime").name == "uptime"
+    assert Extended.getParser("show mtu").name == "child_mtu"
+    assert Extended.getParser("show ver").name == "base_ver"
+    assert Base.getParser("show uptime") is None
+    assert Device.getParser("show mtu") is None
@@ -0,0 +1,151 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Tests of case scheduling on plain case dicts
+"""
+from collections import OrderedDict
+
+import pytest
+
+from chorus.history import History
+from chorus.scheduler import FixtureCost, _Node, schedule
+
+
+def case(name, topo, *fixtures):
+    """A case dict like those of the testsuite, with fixtures defining both init and clean"""
+    return {"t_case_name": name, "t_case_class_name": name, "topo": topo,
+            "t_case_fx": [{"name": fx, "init": None, "clean": None} for fx in fixtures]}
+
+
+def names(cases):
+    return [c["t_case_name"] for c in cases]
+
+
+def assertGrouped(cases):
+    """Each topology, and each fixture chain in a topology, is run in one go"""
+    seen = set()
+    last = None
+    for c in cases:
+        key = (c["topo"], tuple(fx["name"] for fx in c["t_case_fx"]))
+        if key != last:
+            assert key not in seen
+            seen.add(key)
+            last = key
+    topos = [c["topo"] for c in cases]
+    assert [t for i, t in enumerate(topos) if i == 0 or topos[i - 1] != t] == list(OrderedDict.fromkeys(topos))
+
+
+@pytest.fixture
+def cases():
+    return [case("a1", "t1", "Base", "Fa"),
+            case("x1", "t2", "X"),
+            case("b1", "t1", "Base", "Fb"),
+            case("a2", "t1", "Base", "Fa"),
+            case("c", "t1"),
+            case("b2", "t1", "Base", "Fb")]
+
+
+def test_schedule_groups_topologies_and_prefixes(cases):
+    ordered = schedule(cases)
+    # topologies with less cases first, cases without fixtures before the subtrees, siblings in insertion order
+    assert names(ordered) == ["x1", "c", "a1", "a2", "b1", "b2"]
+    assertGrouped(ordered)
+    assert names(cases) == ["a1", "x1", "b1", "a2", "c", "b2"]
+
+
+def test_estimate(cases):
+    cost = FixtureCost()
+    # every init and clean costs 1 without durations
+    assert cost.estimate(cases) == (16.0, 16, 3)
+    assert cost.estimate(schedule(cases)) == (8.0, 8, 2)
+    assert cost.estimate([]) == (0.0, 0, 0)
+
+
+def test_estimate_by_durations():
+    cost = FixtureCost({"Base": {"init": 10.0, "clean": 2.0}, "Fa": {"init": 4.0}})
+    assert cost.default == pytest.approx(16.0 / 3)
+    # Fa has no init defined, and costs nothing to init
+    cases = [case("a1", "t1", "Base"), case("a2", "t1", "Base", "Fa"), case("b", "t1", "Base", "Fb")]
+    cases[1]["t_case_fx"][1] = {"name": "Fa", "clean": None}
+    sec, calls, topos = cost.estimate(cases)
+    # init Base, clean Fa and init Fb, then clean Fb and Base
+    assert calls == 5
+    assert topos == 1
+    assert sec == pytest.approx(10.0 + cost.default + cost.default + cost.default + 2.0)
+
+
+def test_estimate_shared_prefix():
+    cost = FixtureCost()
+    cases = [case("a", "t1", "Base", "Mid", "Fa"), case("b", "t1", "Base", "Mid", "Fb"), case("c", "t1", "Base")]
+    # init 3, clean Fa init Fb, clean Fb Mid, clean Base
+    assert cost.estimate(cases)[1] == 3 + 2 + 2 + 1
+
+
+def test_weigh():
+    root = _Node()
+    for c in [case("a1", "t", "A"), case("b1", "t", "B"), case("a2", "t", "A"), case("r", "t"),
+              case("b2", "t", "B", "C")]:
+        root.insert(c)
+    weights = {"a1": 1, "a2": 5, "b1": 3, "b2": 3, "r": 0}
+    assert root.weigh(lambda c: weights[c["t_case_name"]], max) == 5
+    assert list(root.children) == ["A", "B"]
+    assert names(root.children["A"].cases) == ["a2", "a1"]
+    assert root.children["B"].weight == 3
+    assert root.count == 5 and root.children["B"].count == 2
+    assert names(root.walk()) == ["r", "a2", "a1", "b1", "b2"]
+
+    assert root.weigh(lambda c: weights[c["t_case_name"]], sum) == 12
+    # A and B both weigh 6 in total, equal weights keep the former order
+    assert list(root.children) == ["A", "B"]
+    weights["b1"] = 4
+    assert root.weigh(lambda c: weights[c["t_case_name"]], sum) == 13
+    assert list(root.children) == ["B", "A"]
+    assert names(root.walk()) == ["r", "b1", "b2", "a2", "a1"]
+
+
+def test_weigh_deep_chain():
+    root = _Node()
+    root.insert(case("deep", "t", *["F%d" % i for i in range(5000)]))
+    assert root.weigh(lambda c: 1, sum) == 1
+
+
+@pytest.fixture
+def history(tmp_path):
+    h = History(str(tmp_path / "history.json"))
+    for name, sec, status in [("a1", 1.0, "PASS"), ("a2", 2.0, "PASS"), ("b1", 30.0, "PASS"),
+                              ("b2", 1.0, "FAIL"), ("c", 5.0, "PASS"), ("x1", 1.0, "PASS")]:
+        h.record(name, sec, status)
+    return h
+
+
+def test_failed_first(cases, history):
+    ordered = schedule(cases, "failed-first", history)
+    # cases without fixtures still run before the fixture subtrees of the topology
+    assert names(ordered) == ["c", "b2", "b1", "a1", "a2", "x1"]
+    assertGrouped(ordered)
+
+
+def test_longest_first(cases, history):
+    ordered = schedule(cases, "longest-first", history)
+    assert names(ordered) == ["c", "b1", "b2", "a2", "a1", "x1"]
+    assertGrouped(ordered)
+
+
+def test_longest_first_unknown_durations(cases, history):
+    # cases never run take the mean duration of the others, 2 seconds, so both subtrees weigh 3
+    del history.cases["b1"]
+    ordered = schedule(cases, "longest-first", history)
+    assert names(ordered) == ["c", "a2", "a1", "b1", "b2", "x1"]
+    assertGrouped(ordered)
+
+
+def test_order_without_history_keeps_insertion(cases):
+    assert names(schedule(cases, "failed-first")) == names(schedule(cases))
+
+
+def test_unknown_order(cases, history):
+    with pytest.raises(ValueError):
+        schedule(cases, "random", history)
@@ -0,0 +1,75 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Tests of the step timeouts of testcases
+"""
+import time
+
+import pytest
+
+from chorus.testcase import StepWatchdog, Testcase
+
+
+def spin(sec):
+    """Busy python code, so that exceptions raised from other threads land in it"""
+    end = time.time() + sec
+    while time.time() < end:
+        pass
+
+
+class Slow(Testcase):
+    """Testcase with steps spinning for a while"""
+
+    def step1Quick(self):
+        """Quick step"""
+        self.watchdog = self._watchdog
+        return Testcase.PASS
+
+    def step2Slow(self):
+        """Slow step"""
+        spin(30)
+        return Testcase.PASS
+
+    def step3Busy(self):
+        """Busy step"""
+        spin(0.5)
+        return Testcase.PASS
+
+
+@pytest.fixture
+def case():
+    return Slow()
+
+
+def test_step_timeout(case):
+    start = time.time()
+    rcode, desc, rlist = case._runStep(2, ["step2Slow"], 0.2)
+    assert time.time() - start < 5
+    assert rcode == Testcase._abortvalue
+    assert "timed out" in desc
+    assert [r.rcode for r in rlist] == [Testcase._abortvalue]
+    # the case goes on with the steps after
+    rcode, _, _ = case._runStep(3, ["step3Busy"], None)
+    assert rcode == Testcase._passvalue
+
+
+def test_substep_timeout(case):
+    rcode, desc, rlist = case._runStep(2, ["step2Slow", "step3Busy"], 0.2)
+    assert rcode == Testcase._abortvalue
+    assert "timed out" in desc
+    assert len(rlist) == 2
+
+
+def test_late_timer(case, monkeypatch):
+    # keep the timer running after the step, as if it fired right when the step finished
+    monkeypatch.setattr(StepWatchdog, "stop", lambda self: None)
+    rcode, _, _ = case._runStep(1, ["step1Quick"], 0.1)
+    assert rcode == Testcase._passvalue
+    # the timer fires while the next step is running, but does not hit it
+    rcode, _, _ = case._runStep(3, ["step3Busy"], None)
+    assert rcode == Testcase._passvalue
+    case.watchdog._timer.join()
+    assert not case.watchdog.fired
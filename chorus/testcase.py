@@ -13,12 +13,44 @@ import re
 import sys
 import traceback
 import pdb
+import asyncio
+import contextlib
+import threading
+import ctypes
+import copy
+from collections import namedtuple
+from concurrent.futures import wait, FIRST_COMPLETED, ThreadPoolExecutor
+try:
+    import resource
+except ImportError:
+    # peak rss is not recorded without resource module
+    resource = None
 
 from .log import log
-from .utils import ChorusThread, roclassproperty
+from .connection import IOStats, setIOStats, setCancelEvent
+from .utils import getExecutor, timedCall, offload, roclassproperty
 
 
-class Testcase(object):
+class TestcaseMeta(type):
+    """Metaclass of testcases, invalidates the cached step tables and fixture chains of testcase classes when
+    their steps or fixtures are changed after definition"""
+    # bumped on each change, caches of older generations are dropped
+    generation = 0
+
+    def __setattr__(cls, name, value):
+        super(TestcaseMeta, cls).__setattr__(name, value)
+        cls._onChange(name)
+
+    def __delattr__(cls, name):
+        super(TestcaseMeta, cls).__delattr__(name)
+        cls._onChange(name)
+
+    def _onChange(cls, name):
+        if name in ("init", "clean") or name.startswith(cls.METHOD_PREFIX):
+            TestcaseMeta.generation += 1
+
+
+class Testcase(metaclass=TestcaseMeta):
     """The base class of chorus testcases. All user defined testcases should inherit from this one.
     Topology:
 
@@ -36,6 +68,14 @@ class Testcase(object):
         Each user defined test step should return Testcase.PASS or Testcase.FAIL. If any uncaught exception
         happens in a step, Testcase will mark that step as Testcase.ABORT.
 
+        Steps, *init* and *clean* can also be defined with *async def*. They are run on an event loop shared by
+        the testsuite, in which device operations can be awaited, i.e.
+
+        ::
+
+            async def step1(self):
+                outs = await asyncio.gather(*[d.acmd("uptime") for d in self.parsed_topo.devices.values()])
+
     Testcase inheritance:
 
         All user testcase must inherit from chorus.Testcase directly or indirectly. Inheritance will not happen with
@@ -80,12 +120,28 @@ class Testcase(object):
     # initialization parameters
     c_continue_on_fail = False  # Continue the next step if any even if current one fails
     '''Continue to run the remaining steps when a step fails.'''
+    c_max_parallel = None
+    '''Max count of substeps of a step running at the same time, all at once by default.'''
+    c_profile_steps = False
+    '''Record cpu time, device I/O and memory usage of each step and substep.'''
+    c_step_timeout = None
+    '''Abort a step running longer than this in seconds, not limited by default.'''
+    c_case_timeout = None
+    '''Time budget in seconds of all steps of the testcase, the remaining steps are aborted once it runs out.'''
+    c_row_workers = None
+    '''Max count of data rows running at the same time when they share fixtures, one by one by default.'''
     # unlike c_continue_on_fail, _pause_on_fail can only be defined for
     # Testcase class
     _pause_on_fail = False
     _p = None
+    # event loop for async steps and fixtures, owned by the testsuite
+    _loop = None
     check_topo_devices = True
     '''Connect topology devices on init.'''
+    lazy_topo_devices = False
+    '''Connect topology devices on their first command instead of on init, used devices are connected in background.'''
+    topo_devices = None
+    '''Topology devices used by the testcase in priority order, inferred from the code if not set.'''
 
     _passvalue = 1 << 2
     _failvalue = 1 << 3
@@ -116,6 +172,10 @@ class Testcase(object):
             self.name = self.__class__.__name__
         self.log = log
         self.result = Result(self.name, rcode=self._unvalue)
+        # result of the step running in current thread
+        self._step_local = threading.local()
+        self._offload_lock = threading.Lock()
+        self._watchdog = None
 
     ######
     # test state as properties for instrumentation
@@ -178,17 +238,192 @@ class Testcase(object):
         """User cleanup step. Override this in subclasses."""
         return Testcase.PASS
 
+    @classmethod
+    def _invoke(cls, func, *args):
+        """Call a step or fixture, coroutines of async ones are run to complete on the shared event loop,
+        or on an event loop of their own out of the main thread, i.e. for data rows running in parallel"""
+        rslt = func(*args)
+        if inspect.iscoroutine(rslt):
+            if threading.current_thread() is not threading.main_thread():
+                loop = asyncio.new_event_loop()
+                try:
+                    return loop.run_until_complete(rslt)
+                finally:
+                    loop.close()
+            if Testcase._loop is None or Testcase._loop.is_closed():
+                Testcase._loop = asyncio.new_event_loop()
+            task = Testcase._loop.create_task(rslt)
+            try:
+                rslt = Testcase._loop.run_until_complete(task)
+            except BaseException:
+                # do not leave an interrupted coroutine to the next run of the loop
+                task.cancel()
+                with contextlib.suppress(BaseException):
+                    Testcase._loop.run_until_complete(asyncio.wait([task], timeout=1))
+                raise
+        return rslt
+
+    def _invokeSubstep(self, func, result):
+        """Call a substep in a worker thread, which runs async ones on an event loop of its own"""
+        self._step_local.result = result
+        watchdog = self._watchdog
+        try:
+            if watchdog is not None:
+                watchdog.watch()
+            with self._profile(result):
+                rslt = func()
+                if inspect.iscoroutine(rslt):
+                    loop = asyncio.new_event_loop()
+                    try:
+                        rslt = loop.run_until_complete(rslt)
+                    finally:
+                        loop.close()
+        finally:
+            if watchdog is not None:
+                watchdog.unwatch()
+        return rslt
+
+    def _profile(self, result):
+        """Profile a step into its result if :attr:`~c_profile_steps` set"""
+        if self.c_profile_steps:
+            return StepProfiler(result)
+        return _NoProfile()
+
+    def offload(self, func, *args, **kwargs):
+        """Run a CPU heavy function, i.e. parsing a huge output, in the process pool shared by the testsuite,
+        so that it does not hold the GIL of parallel substeps. The function and arguments should be picklable,
+        large str or bytes arguments are passed through files instead.
+        The time spent is added to `offload_sec` of the result of current step.
+
+        :param func: a module level function
+        :return: a future of the return of the function
+        """
+        result = getattr(self._step_local, "result", None)
+        start = time.time()
+
+        def done(f):
+            if result is not None:
+                with self._offload_lock:
+                    result.offload_sec += time.time() - start
+
+        future = offload(func, *args, **kwargs)
+        future.add_done_callback(done)
+        return future
+
+    def _runSteps(self, steps):
+        """Run the steps in order into :attr:`~result`
+
+        :param steps: {step id: [substep names]}
+        """
+        sids = sorted(steps.keys())
+        state = Testcase._passvalue
+        deadline = None
+        if self.c_case_timeout:
+            deadline = time.time() + float(self.c_case_timeout)
+        for i in sids:
+            step_erro = {
+                "step": "step" +
+                str(i),
+                "desc": "Failed on test step(s) %s" %
+                i}
+            timeout = float(self.c_step_timeout) if self.c_step_timeout else None
+            if deadline is not None:
+                left = deadline - time.time()
+                if left <= 0:
+                    step_erro["desc"] = "Testcase time budget of %ss ran out" % self.c_case_timeout
+                    log.error(step_erro["desc"])
+                    self.result.rcode = Testcase._abortvalue
+                    self.result.failed_on.append(step_erro)
+                    break
+                timeout = left if timeout is None else min(timeout, left)
+            state, desc, rlist = self._runStep(i, steps[i], timeout)
+            step_erro["desc"] = desc
+            self.result.step_run += 1
+            self.result.step_results.append(rlist)
+            if state != Testcase._passvalue:
+                if state not in Testcase.STATES:
+                    log.warn(
+                        "Unknown test result, make sure you return a Testcase state for the step.")
+                    state = Testcase.UNKNOWN
+                self.result.rcode = state
+                self.result.failed_on.append(step_erro)
+                if not self.c_continue_on_fail:
+                    break
+
+    def _runRows(self, steps, rows):
+        """Run the steps once for each data row, at most :attr:`~c_row_workers` rows at a time.
+        Rows share the fixtures and topology of this testcase, and only a :class:`RowResult` is kept for each.
+
+        :param steps: {step id: [substep names]}
+        :param rows: a list of dict, the arguments of each row
+        """
+        workers = int(self.c_row_workers or 1)
+        if self._pause_on_fail:
+            # pdb can not serve parallel rows
+            workers = 1
+        log.info(">>>Running %d data rows, %d at a time<<<", len(rows), workers)
+        if workers > 1 and len(rows) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                outs = list(pool.map(lambda ir: self._runRow(steps, *ir), enumerate(rows)))
+        else:
+            outs = [self._runRow(steps, i, row) for i, row in enumerate(rows)]
+        failed = 0
+        for row, step_run in outs:
+            self.result.rows.append(row)
+            self.result.step_run += step_run
+            if row.rcode != Testcase._passvalue:
+                failed += 1
+                if self.result.rcode == Testcase._passvalue or row.rcode > self.result.rcode:
+                    self.result.rcode = row.rcode
+        if failed:
+            self.result.failed_on.append(
+                {"step": "rows", "desc": "%d of %d data rows failed" % (failed, len(rows))})
+
+    def _runRow(self, steps, index, row):
+        """Run the steps for a data row
+
+        :return: (:class:`RowResult`, count of steps run)
+        """
+        case = self._forRow(index, row)
+        log.info(">>>Data row %d started: %s<<<", index, row)
+        try:
+            case._runSteps(steps)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            log.exception("*** Exception happens with data row %d", index)
+            case.result.rcode = Testcase._abortvalue
+            case.result.failed_on.append({"step": "row%d" % index, "desc": str(e)})
+        r = case.result
+        r.end_sec = time.time()
+        log.info(">>>Data row %d result: %s<<<", index, r.status)
+        error = "; ".join("%s: %s" % (f["step"], f["desc"]) for f in r.failed_on)
+        return RowResult(index, r.rcode, r.end_sec - r.start_sec, error), r.step_run
+
+    def _forRow(self, index, row):
+        """A copy of the testcase with the arguments of a data row, sharing everything set up by the fixtures"""
+        case = copy.copy(self)
+        case.__dict__.update(row)
+        case.result = Result("%s[%d]" % (self.name, index), rcode=Testcase._passvalue)
+        case.result.step_count = self.result.step_count
+        case.result.stage = Result.STAGE_STEP
+        case._step_local = threading.local()
+        case._offload_lock = threading.Lock()
+        case._watchdog = None
+        return case
+
     def _postClean(self):
         self.parsed_topo.clean()
         return Testcase.PASS
 
     # The calling template
-    def run(self, pause_on_fail=False, fixture_chain=[], next_chain=[]):
+    def run(self, pause_on_fail=False, fixture_chain=[], next_chain=[], rows=None):
         """
 
         :param bool pause_on_fail: Whether pause when a step fails
         :param list fixture_chain: current excuted init fixtures
         :param list next_chain: fixture chain of the next testcase
+        :param list rows: data rows, if specified steps are run once for each row with the fixtures initialized once
         :return: result summary
         """
         log.info("=" * 30)
@@ -236,7 +471,9 @@ class Testcase(object):
             for fx in local_chain[len(fixture_chain):]:
                 if 'init' in fx:
                     self.log.info(">>> Calling init of %s" % fx['name'])
-                    init_rslt = fx['init'](self)
+                    fx_start = time.time()
+                    init_rslt = self._invoke(fx['init'], self)
+                    self.result.fixture_sec.setdefault(fx['name'], {})['init'] = time.time() - fx_start
                     if init_rslt == Testcase._failvalue or init_rslt == Testcase._skippedvalue:
                         break
                     else:
@@ -259,27 +496,12 @@ class Testcase(object):
                 log.info(">>>Running steps ...<<<")
                 log.info("=" * 25)
                 self.result.stage = Result.STAGE_STEP
-                sids = sorted(steps.keys())
-                state = Testcase._passvalue
-                for i in sids:
-                    step_erro = {
-                        "step": "step" +
-                        str(i),
-                        "desc": "Failed on test step(s) %s" %
-                        i}
-                    state, desc, rlist = self._runStep(i, steps[i])
-                    step_erro["desc"] = desc
-                    self.result.step_run += 1
-                    self.result.step_results.append(rlist)
-                    if state != Testcase._passvalue:
-                        if state not in Testcase.STATES:
-                            log.warn(
-                                "Unknown test result, make sure you return a Testcase state for the step.")
-                            state = Testcase.UNKNOWN
-                        self.result.rcode = state
-                        self.result.failed_on.append(step_erro)
-                        if not self.c_continue_on_fail:
-                            break
+                step_erro = {"step": "steps",
+                             "desc": "Failed running test steps"}
+                if rows is None:
+                    self._runSteps(steps)
+                else:
+                    self._runRows(steps, rows)
         except (KeyboardInterrupt, SystemExit) as e:
             log.error("User interrupted.")
             raise e
@@ -315,14 +537,16 @@ class Testcase(object):
                     fx = fixture_chain.pop()
                     if 'clean' in fx:
                         self.log.info(">>> Calling clean of %s" % fx['name'])
+                        fx_start = time.time()
                         # try best to cleanup
                         try:
-                            clean_rslt = fx['clean'](fx['case'])
+                            clean_rslt = self._invoke(fx['clean'], fx['case'])
                         except BaseException as e:
                             log.error("Error happens on cleaning up %s" %
                                       fx['name'])
                             log.exception("  Except: %s" % e)
                             clean_rslt = Testcase._abortvalue
+                        self.result.fixture_sec.setdefault(fx['name'], {})['clean'] = time.time() - fx_start
                 if clean_rslt not in Testcase.STATES:
                     # do not check unknown clean result
                     clean_rslt = Testcase._passvalue
@@ -361,16 +585,30 @@ class Testcase(object):
             log.info("==    Failed on following steps:")
             for f in self.result.failed_on:
                 log.info("    ==  %s: %s", f["step"], f["desc"])
+        if self.result.rows:
+            failed = [r for r in self.result.rows if r.rcode != Testcase._passvalue]
+            log.info("==    Data rows: %d, failed: %d", len(self.result.rows), len(failed))
+            for r in failed:
+                log.info("    ==  row %d: %s (%.3fs) %s", r.index, Testcase.STATES[r.rcode], r.run_sec, r.error)
+        if self.c_profile_steps:
+            log.info("==    Step profiles:")
+            for rlist in self.result.step_results:
+                for r in rlist:
+                    log.info("    ==  %s: wall %.3fs, cpu %.3fs, device io %.3fs in %d commands (%d bytes), "
+                             "offload %.3fs, peak rss +%dKB",
+                             r.id, r.run_sec, r.cpu_sec, r.io_sec, r.cmd_count, r.bytes_recv,
+                             r.offload_sec, r.rss_delta_kb)
         log.info("============================================================\n")
 
     def getResult(self):
         return self.result
 
-    def _runStep(self, sid, steps):
+    def _runStep(self, sid, steps, timeout=None):
         """Internal method to call a step
 
         :param sid: step id
         :param steps: a list of substeps
+        :param timeout: abort the step after the seconds, not limited if None
         :return: (result_code, description, [sub_step_results])
         """
         rcode = Testcase._passvalue
@@ -379,13 +617,18 @@ class Testcase(object):
         log.info("=" * 20)
         log.info(">>>Step %s started<<<", sid)
         log.info("=" * 20)
+        watchdog = self._watchdog = StepWatchdog(timeout) if timeout else None
         if len(steps) == 1:
             ss = getattr(self, steps[0])
             log.info(">>> %s", ss.__doc__)
             desc = ss.__doc__
             subr = StepResult(str(sid), desc)
+            self._step_local.result = subr
             try:
-                rcode = ss()
+                if watchdog is not None:
+                    watchdog.watch()
+                with self._profile(subr):
+                    rcode = self._invoke(ss)
                 if isinstance(rcode, tuple):
                     (subr.rcode, subr.error) = rcode
                     (rcode, rmsg) = rcode
@@ -414,27 +657,70 @@ class Testcase(object):
                 if self._pause_on_fail:
                     pdb.pm()
             finally:
+                if watchdog is not None:
+                    watchdog.unwatch(done=True)
                 subr.end_sec = time.time()
+                subr.run_sec = subr.end_sec - subr.start_sec
+                self._step_local.result = None
                 rlist.append(subr)
         else:
-            threads = []
-            desclist = []
-            sub_results = {}
-            for s in range(len(steps)):
-                sub_num = "_".join(steps[s].split("_")[-2:])
-                ss = getattr(self, steps[s])
+            rlist, rcode, rmsg = self._runSubsteps(steps)
+
+        if watchdog is not None:
+            watchdog.stop()
+            self._watchdog = None
+            if watchdog.fired:
+                rcode = Testcase._abortvalue
+                rmsg = "Step %s timed out after %.1fs" % (sid, timeout)
+                if len(rlist) == 1:
+                    rlist[0].rcode = rcode
+                    rlist[0].error = rmsg
+                log.error(rmsg)
+
+        log.info(">>>Step %s result: %s<<<", sid, Testcase.STATES[rcode])
+        return rcode, rmsg, rlist
+
+    def _runSubsteps(self, steps):
+        """Run substeps in parallel on the shared thread pool, at most :attr:`~c_max_parallel` at a time.
+        Unless :attr:`~c_continue_on_fail` is set, substeps not started yet are cancelled once a substep fails.
+
+        :param steps: a list of substeps
+        :return: ([sub_step_results], result_code, description)
+        """
+        rcode = Testcase._passvalue
+        desclist = []
+        sub_results = {}
+        queued = list(steps)
+        running = {}
+        limit = int(self.c_max_parallel or len(steps))
+        executor = getExecutor()
+        step_start = time.time()
+        failed = False
+        watchdog = self._watchdog
+        while queued or running:
+            while queued and len(running) < limit and not failed:
+                name = queued.pop(0)
+                sub_num = "_".join(name.split("_")[-2:])
+                ss = getattr(self, name)
                 log.info(">>> >>>Sub step %s started<<< <<<", sub_num)
                 log.info(">>> >>> %s", ss.__doc__)
-                sub_results[steps[s]] = StepResult(sub_num, ss.__doc__)
-                t = ChorusThread(target=ss, name=steps[s])
-                threads.append(t)
-                t.start()
-
-            for t in threads:
-                subr = t.join()
-                result = sub_results[t.name]
-                result.end_sec = time.time()
-                log.info("Result for substep %s:", t.name)
+                sub_results[name] = StepResult(sub_num, ss.__doc__)
+                running[executor.submit(
+                    timedCall, self._invokeSubstep, ss, sub_results[name])] = name
+            # wake up regularly to check the step timeout
+            done, _ = wait(list(running), timeout=1 if watchdog else None,
+                           return_when=FIRST_COMPLETED)
+            for f in done:
+                name = running.pop(f)
+                result = sub_results[name]
+                if f.cancelled():
+                    continue
+                subr = f.result()
+                result.start_sec = subr["start"]
+                result.end_sec = subr["end"]
+                result.queue_sec = subr["start"] - step_start
+                result.run_sec = subr["end"] - subr["start"]
+                log.info("Result for substep %s:", name)
                 if subr["exception"] is not None:
                     etype, value, tb = subr["exception"]
                     if etype == AssertionError:
@@ -442,10 +728,10 @@ class Testcase(object):
                         tb_info = traceback.extract_tb(tb)
                         filename, line, func, text = tb_info[-1]
                         log.error(
-                            'Assertion fail for substep %s: %s', t.name, text)
+                            'Assertion fail for substep %s: %s', name, text)
                     else:
                         log.error(" *** Exception happens with step %s:",
-                                  t.name, exc_info=subr["exception"])
+                                  name, exc_info=subr["exception"])
                         result.rcode = Testcase.ABORT
                         result.error = str(subr["exception"])
                 elif isinstance(subr["state"], tuple):
@@ -462,61 +748,101 @@ class Testcase(object):
                     result.rcode = Testcase.UNKNOWN
                     result.error = "Illegal return from substep, please check the code."
                 log.info("  >>> >>>Sub step %s result: %s<<< <<<",
-                         t.name, result.status)
-
-                desclist.append("%s:%s" % (t.name, result.status))
-                rlist.append(result)
+                         name, result.status)
+                log.debug("  Sub step %s queued %.3fs, ran %.3fs",
+                          name, result.queue_sec, result.run_sec)
                 # return the larget(worst) result
                 if result.rcode > rcode:
                     rcode = result.rcode
-            rmsg = "; ".join(desclist)
-
-        log.info(">>>Step %s result: %s<<<", sid, Testcase.STATES[rcode])
-        return rcode, rmsg, rlist
+                if result.rcode != Testcase._passvalue and not self.c_continue_on_fail:
+                    failed = True
+            timedout = watchdog is not None and watchdog.fired
+            if timedout:
+                failed = True
+                # substeps blocking out of python code, i.e. in a sleep, can not be interrupted,
+                # leave them running in the pool and go on
+                if running and time.time() - watchdog.fired_sec > ABANDON_SEC:
+                    for f in list(running):
+                        if f.cancel():
+                            continue
+                        name = running.pop(f)
+                        result = sub_results[name]
+                        result.rcode = Testcase._abortvalue
+                        result.error = "Abandoned after step timeout."
+                        result.end_sec = time.time()
+                        log.error("  >>> >>>Sub step %s abandoned<<< <<<", name)
+                        rcode = max(rcode, result.rcode)
+            if failed:
+                # fail fast, cancel the substeps not started
+                for f in list(running):
+                    if f.cancel():
+                        queued.append(running.pop(f))
+                for name in queued:
+                    sub_num = "_".join(name.split("_")[-2:])
+                    if name not in sub_results:
+                        sub_results[name] = StepResult(sub_num, getattr(self, name).__doc__)
+                    result = sub_results[name]
+                    result.rcode = Testcase._skippedvalue
+                    if timedout:
+                        result.error = "Cancelled due to step timeout."
+                    else:
+                        result.error = "Cancelled due to failure of sibling substeps."
+                    log.info("  >>> >>>Sub step %s cancelled<<< <<<", name)
+                queued = []
+        for name in steps:
+            result = sub_results[name]
+            desclist.append("%s:%s" % (name, result.status))
+        rlist = [sub_results[name] for name in steps]
+        return rlist, rcode, "; ".join(desclist)
 
     def getSteps(self):
         """Instance method of get steps, call `_getSteps` of class by default"""
         return self.__class__._getSteps()
 
+    @classmethod
+    def _cached(cls, key, compute):
+        """Get a value cached in the class itself, computed again only if steps or fixtures of testcases change"""
+        cache = cls.__dict__.get("_class_cache")
+        if cache is None or cache[0] != TestcaseMeta.generation:
+            cache = (TestcaseMeta.generation, {})
+            cls._class_cache = cache
+        if key not in cache[1]:
+            cache[1][key] = compute()
+        return cache[1][key]
+
     @classmethod
     def _getSteps(cls):
         """Collect all the test steps
         Test step should in format of 'step<id>[_subid]'
         This may be called several times, so it should be idempotent
         """
+        hsteps = cls._cached("steps", cls._collectSteps)
+        return dict((sid, list(names)) for sid, names in hsteps.items())
+
+    @classmethod
+    def _collectSteps(cls):
+        """Build the step table of the class, {step id: (step names...)}"""
         log.debug("Getting test steps for {}...".format(cls.name))
-        # inspect all methods
-        all_method = inspect.getmembers(
-            cls, predicate=lambda x: inspect.isfunction(x) or inspect.ismethod(x))
+        step_reg = re.compile(r'^%s\d+(_\d+)?$' % cls.METHOD_PREFIX)
         hsteps = {}
-        for m in all_method:
-            # because all methods including inherited ones will be listed,
-            # filter out the methods defined in this cls only
-            if m[0] in cls.__dict__ and re.match(
-                r'^%s\d+(_\d+)?$' %
-                cls.METHOD_PREFIX,
-                    m[0]):
-                smark = m[0][len(cls.METHOD_PREFIX):].split("_")
-                # master smark smark[0]
-                log.debug("Adding step %s to testcase %s", m[0], cls)
-                if len(smark) == 1:
-                    sid = int(smark[0])
-                    # all in list form to simplify the process
-                    hsteps[sid] = [m[0]]
-                elif len(smark) == 2:
-                    sid = int(smark[0])
-                    if sid in hsteps:
-                        hsteps[sid].append(m[0])
-                    else:
-                        hsteps[sid] = [m[0]]
-                else:
-                    raise TestException(
-                        "Step name not supported %s, %s" % (m[0], cls))
+        # only the methods defined in this cls, sorted by name
+        for name in sorted(cls.__dict__):
+            if not step_reg.match(name):
+                continue
+            m = getattr(cls, name)
+            if not (inspect.isfunction(m) or inspect.ismethod(m)):
+                continue
+            smark = name[len(cls.METHOD_PREFIX):].split("_")
+            # master smark smark[0]
+            log.debug("Adding step %s to testcase %s", name, cls)
+            sid = int(smark[0])
+            # all in list form to simplify the process
+            hsteps.setdefault(sid, []).append(name)
         if len(hsteps.keys()) == 0:
             raise TestException("No steps defined in testcase %s" % cls)
         log.debug("{} steps found(without sub steps)".format(len(hsteps)))
         log.debug("Get test steps for {} finished.".format(cls.name))
-        return hsteps
+        return dict((sid, tuple(names)) for sid, names in hsteps.items())
 
     @classmethod
     def getUserSteps(cls):
@@ -541,9 +867,46 @@ class Testcase(object):
             _, lineno = inspect.getsourcelines(step)
             p.set_break(filename, lineno, funcname=s)
 
+    @classmethod
+    def getTopoDevices(cls, devices):
+        """Get the topology devices used by the testcase, in priority order
+
+        Use :attr:`~topo_devices` if set, or else the devices referred by name in the code of the testcase and its
+        fixtures, i.e. `self.dut.cmd(...)`, in order of appearance.
+
+        :param devices: names of all devices in the topology
+        :return: a list of device names
+        """
+        if cls.topo_devices is not None:
+            return [d for d in cls.topo_devices if d in devices]
+        return [n for n in cls._cached("code_names", cls._collectCodeNames) if n in devices]
+
+    @classmethod
+    def _collectCodeNames(cls):
+        """Names referred by the code of the testcase and its fixtures, in order of appearance"""
+        names = []
+        for c in reversed(inspect.getmro(cls)[:-2]):
+            for attr in c.__dict__.values():
+                code = getattr(attr, "__code__", None)
+                if code is not None:
+                    _collectNames(code, names)
+        uniq = []
+        seen = set()
+        for n in names:
+            if n not in seen:
+                seen.add(n)
+                uniq.append(n)
+        return tuple(uniq)
+
     @classmethod
     def getFixtureChain(cls):
         """Get the chain of fixtures from all ancestors"""
+        # entries are copied because the running chain records the initializing case in them
+        return [dict(fx) for fx in cls._cached("fixtures", cls._collectFixtureChain)]
+
+    @classmethod
+    def _collectFixtureChain(cls):
+        """Build the fixture chain of the class"""
         mros = inspect.getmro(cls)
         chain = []
         if len(mros) > 2:
@@ -554,11 +917,21 @@ class Testcase(object):
                 if "clean" in c.__dict__:
                     entry['clean'] = getattr(c, 'clean')
                 chain.insert(0, entry)
-        return chain
+        return tuple(chain)
+
+
+def _collectNames(code, names):
+    """Collect attribute and global names referred by a code object and its nested functions"""
+    names.extend(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _collectNames(const, names)
 
 
 class AbstractResult(object):
     """Abstract result class, provides basic time calculation and result conversion properties"""
+    # results are kept for the whole run, keep them compact
+    __slots__ = ("rcode", "start_sec", "end_sec")
 
     def __init__(
             self,
@@ -598,6 +971,7 @@ class AbstractResult(object):
 
 class Result(AbstractResult):
     """Test result class"""
+    __slots__ = ("name", "step_count", "step_results", "step_run", "stage", "failed_on", "rows", "fixture_sec")
     STAGE_NOT_RUN = "Not started"
     STAGE_INIT = "Initialization"
     STAGE_STEP = "Running Steps"
@@ -606,31 +980,193 @@ class Result(AbstractResult):
 
     def __init__(self, name,
                  step_count=0,
-                 step_results=[],
+                 step_results=None,
                  rcode=Testcase._unvalue):
         """
         :type step_count: step count of testcase
         :param name: testcase name
-        :param step_results: step result list [StepResult ...]
+        :param step_results: step result list [[StepResult ...] ...], a new list by default
         :param rcode: result code
         """
         super(Result, self).__init__(rcode)
         self.name = name
         self.step_count = step_count
-        self.step_results = step_results
+        self.step_results = [] if step_results is None else step_results
         self.step_run = 0
         self.stage = Result.STAGE_NOT_RUN
         self.failed_on = []
+        # [RowResult ...] of data rows sharing fixtures
+        self.rows = []
+        # {fixture name: {"init": seconds, "clean": seconds}} of fixtures called by the testcase
+        self.fixture_sec = {}
+
+    def compact(self):
+        """A copy of the result without step results, to be kept after the testcase finished"""
+        r = Result(self.name, self.step_count, rcode=self.rcode)
+        r.start_sec = self.start_sec
+        r.end_sec = self.end_sec
+        r.step_run = self.step_run
+        r.stage = self.stage
+        r.failed_on = self.failed_on
+        r.rows = self.rows
+        return r
+
+
+RowResult = namedtuple("RowResult", ["index", "rcode", "run_sec", "error"])
+'''Result of a data row, kept compact for thousands of rows'''
 
 
 class StepResult(AbstractResult):
     """Result of a step/substep"""
+    __slots__ = ("id", "desc", "error", "queue_sec", "run_sec", "offload_sec",
+                 "cpu_sec", "io_sec", "cmd_count", "bytes_recv", "rss_delta_kb")
 
     def __init__(self, id, desc):
         super(StepResult, self).__init__()
         self.id = id
         self.desc = desc
         self.error = ""
+        # seconds waited for a worker and seconds running, for substeps
+        self.queue_sec = 0.0
+        self.run_sec = 0.0
+        # seconds spent by functions offloaded to the process pool
+        self.offload_sec = 0.0
+        # profiles, recorded with Testcase.c_profile_steps
+        self.cpu_sec = 0.0
+        self.io_sec = 0.0
+        self.cmd_count = 0
+        self.bytes_recv = 0
+        self.rss_delta_kb = 0
+
+
+if hasattr(time, "thread_time"):
+    _threadTime = time.thread_time
+elif resource is not None and hasattr(resource, "RUSAGE_THREAD"):
+    def _threadTime():
+        """CPU time of current thread, before python 3.7"""
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+else:
+    # cpu time of the whole process, including other threads
+    _threadTime = time.process_time
+
+
+class _NoProfile(object):
+    """Context manager doing nothing, for steps not profiled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        return False
+
+
+class StepProfiler(object):
+    """Context manager recording the cpu time of current thread, the device I/O made from it and the growth of
+    peak rss of the process into a step result"""
+
+    def __init__(self, result):
+        self.result = result
+        self.stats = IOStats()
+
+    def __enter__(self):
+        self._cpu = _threadTime()
+        self._rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+        self._old_stats = setIOStats(self.stats)
+        return self
+
+    def __exit__(self, etype, value, tb):
+        setIOStats(self._old_stats)
+        r = self.result
+        r.cpu_sec = _threadTime() - self._cpu
+        if resource:
+            r.rss_delta_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self._rss
+        r.io_sec = self.stats.io_sec
+        r.cmd_count = self.stats.cmd_count
+        r.bytes_recv = self.stats.bytes_recv
+        return False
+
+
+# seconds to wait for the substeps to stop after a step timeout before leaving them behind
+ABANDON_SEC = 5
+
+
+def _asyncRaise(tid, etype):
+    """Raise an exception in another thread once it runs python code again, None to drop a pending one"""
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(tid), ctypes.py_object(etype) if etype is not None else None)
+
+
+class StepWatchdog(object):
+    """Timer aborting a step running out of time.
+
+    On timeout, the commands sent from the threads running the step are cancelled, and
+    :class:`StepTimeoutException` is raised in these threads to stop the user code.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.fired = False
+        self.fired_sec = None
+        # the step finished, a timer firing late is ignored
+        self.done = False
+        self.cancel = threading.Event()
+        self._threads = set()
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(timeout, self._fire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            if self.done:
+                return
+            self.fired = True
+            self.fired_sec = time.time()
+            self.cancel.set()
+            for tid in self._threads:
+                _asyncRaise(tid, StepTimeoutException)
+
+    def watch(self):
+        """Watch current thread, called in the threads running the step"""
+        with self._lock:
+            self._threads.add(threading.get_ident())
+            fired = self.fired
+        setCancelEvent(self.cancel)
+        if fired:
+            raise StepTimeoutException()
+
+    def unwatch(self, done=False):
+        """Stop watching current thread, the timeout is dropped if not raised yet
+
+        :param done: the step is finished, in the only thread running it
+        """
+        tid = threading.get_ident()
+        while True:
+            try:
+                with self._lock:
+                    self._threads.discard(tid)
+                    self.done = self.done or done
+                    if self.fired:
+                        _asyncRaise(tid, None)
+                break
+            except StepTimeoutException:
+                # raised right before dropped
+                continue
+        setCancelEvent(None)
+
+    def stop(self):
+        """Stop the timer once the step finished"""
+        with self._lock:
+            self.done = True
+        self._timer.cancel()
+
+
+class StepTimeoutException(Exception):
+    """Exception raised in the threads running a step when it times out"""
+
+    def __str__(self):
+        return "Step timed out."
 
 
 class TestException(Exception):
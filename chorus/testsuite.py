@@ -8,18 +8,28 @@ Testsuite management
 """
 
 import os
+import sys
 import time
-# todo: replace imp with importlib
-import imp
+import importlib.util
 import inspect
 import re
+import asyncio
+import multiprocessing
+import pickle
+import queue
+import threading
+from multiprocessing.connection import wait as waitConn
 
-from chorus.topo import Topo
-from .log import log, getLogPath, addLogFile, removeLogFile, closeLog, link, getLogFile
+from chorus.topo import Topo, TopoInitializer
+from .log import log, getLogPath, addLogFile, removeLogFile, closeLog, link, getLogFile, forkLog
 from . import connection
-from .config import loadClass
+from .config import Config, loadClass
 from .data import DataParse
-from .testcase import Testcase
+from .discovery import DiscoveryIndex, changedFiles, indexPath, walk
+from .testcase import Testcase, Result
+from .report import ResultWriter, loadResults
+from .scheduler import FixtureCost, schedule
+from .utils import shutdownProcessPool
 
 
 class Testsuite(object):
@@ -43,7 +53,14 @@ class Testsuite(object):
         "on_case_run": [lambda ts, tc, result: log.debug("Callback after testcase %s.", tc.name)],
         # Called after each testcase run
         "on_report": [lambda ts, results: log.debug("Callback for testsuite result collection.")],
+        # Called with the final result code of each testcase once settled
+        "on_case_result": [lambda ts, case, rcode: log.debug("Callback on result of %s.", case.get("t_case_name"))],
     }
+    # {callback point: [callbacks]} registered to be called in background, see `register_callback`
+    _async_callbacks = {}
+    # {module path: module} imported by the testsuites of a process, to import only the changed modules again in the
+    # next run, None not to keep modules across testsuites, see `forgetModules`
+    module_cache = None
 
     def __init__(self, pathlist=['.'], base_path='.', recursive=False):
         super(Testsuite, self).__init__()
@@ -51,14 +68,37 @@ class Testsuite(object):
         self._curcase = None
         self._case_results = {}
         self._starttime = time.time()
-        # module to path cache to avoid duplication import
         self.pathlist = pathlist
         self.base_path = base_path
         self.recursive = recursive
-        self._module_path = {}
+        # {module path: module} imported
+        self._modules = {}
+        # {testcase name: class}, None until the module is imported
         self._case_class = {}
+        # {testcase name: (module name, path)} of the modules not imported yet
+        self._case_module = {}
+        # names of the testcases known by the discovery index to have no topology, not imported
+        self._case_lib = set()
+        # counts and seconds of the steps of testcase discovery
+        self.discovery = {}
+        self._index = None
+        # result writers, see `addWriter`
+        self._writers = []
+        # {fixture name: {"init": seconds, "clean": seconds}} recorded in former runs, used to schedule cases
+        self.fixture_durations = {}
+        # :class:`~chorus.history.History` of former runs, used to order cases
+        self.history = None
+        # keep the fixtures of the last case of a topology initialized if the topology is kept warm, to be reused
+        # by the next run, see :meth:`chorus.topo.Topo.cleanFixtures`
+        self.keep_fixtures = False
+        # dispatcher of the callbacks registered asynchronous, which records the time taken by all callbacks
+        self._dispatcher = _CallbackDispatcher()
         self._loadTestCase()
 
+    def addWriter(self, writer):
+        """Add a :class:`~chorus.report.ResultWriter`, to which each case result is written once settled"""
+        self._writers.append(writer)
+
     def loadSuiteFile(self, suite_file, args={}):
         """Get all cases in a `suite file`_,
         a suite file includes lines in following format:
@@ -95,12 +135,15 @@ class Testsuite(object):
             self.addcase(c["name"], **c["args"])
         return True
 
-    def loadDataFile(self, datafile, cases=[], args={}):
+    def loadDataFile(self, datafile, cases=[], args={}, shared_fixture=False, row_workers=None):
         """Load testcases according to `data file`_.
 
         :param str datafile: path to data file
         :param list cases: The testcases to run
         :param dict args: arguments used overwrite those in suite files
+        :param bool shared_fixture: run all data rows in a single testcase, whose fixtures are called only once,
+            instead of a testcase for each row
+        :param int row_workers: max count of rows running at the same time with shared fixtures
         :rtype: Booblean
         """
         arglist = []
@@ -122,9 +165,48 @@ class Testsuite(object):
         data = DataParse(datafile).parse()
         for c in data:
             c.update(args)
+        if shared_fixture:
+            kwargs = dict(args)
+            if row_workers:
+                kwargs["c_row_workers"] = row_workers
+            if not self.addcase(case_name, **kwargs):
+                return False
+            self.cases[-1]["t_case_rows"] = data
+            return True
+        for c in data:
             self.addcase(case_name, **c)
         return True
 
+    def loadFailedResults(self, result_file, args={}):
+        """Load the testcases not passed in a result file of a former run, see :func:`~chorus.report.loadResults`.
+        Testcases run again with the same arguments, and only the data rows not passed run again for testcases
+        with shared fixtures.
+
+        :param str result_file: path to the result file
+        :param dict args: arguments used overwrite those in the result file
+        :rtype: Booblean
+        """
+        rerun = (Testcase._failvalue, Testcase._abortvalue, Testcase._tfvalue, Testcase._cfvalue)
+        try:
+            results = list(loadResults(result_file))
+        except OSError:
+            log.exception("Result file '%s' error" % result_file)
+            return False
+        for case, _, rcode in results:
+            if rcode not in rerun:
+                continue
+            kwargs = dict(case["kwargs"])
+            kwargs.update(args)
+            if not self.addcase(case["t_case_class_name"], **kwargs):
+                continue
+            if self.cases[-1]["topo"] != case["topo"]:
+                log.warn("Topology of testcase %s changed from %s to %s",
+                         case["t_case_class_name"], case["topo"], self.cases[-1]["topo"])
+            if "t_case_rows" in case:
+                self.cases[-1]["t_case_rows"] = case["t_case_rows"]
+        log.info("%d of %d testcases in %s to run again", len(self.cases), len(results), result_file)
+        return True
+
     def loadTestcaseReg(self, cases=[], args={}, per_case_params=[]):
         """Load testcases by regular expression
 
@@ -147,7 +229,7 @@ class Testsuite(object):
                 cur_args = per_case_params[i]
                 cur_args.update(args)
             cur_case = None
-            for tcname in self._case_class:
+            for tcname in list(self._case_class):
                 if re.search(case_name, tcname.split(':')[-1]):
                     cur_case = tcname
                     self.addcase(tcname, **cur_args)
@@ -163,66 +245,52 @@ class Testsuite(object):
                     log.exception("Error loading testcase: %s" % case_name)
 
     def _loadTestCase(self):
-        """Load testcase classes from pathlist"""
-        # load modules
+        """Find testcase classes from pathlist by the discovery index, without importing the modules,
+        see :mod:`chorus.discovery`"""
+        start = time.time()
+        ignore = Config().get_config("discovery", "ignore") or []
+        modules = []
         for p in self.pathlist:
             p = os.path.join(self.base_path, p)
-            modules = []
-            # load module if necessary
-            if p in self._module_path:
-                modules = self._module_path[p]
+            if os.path.isdir(p):
+                if self.recursive:
+                    log.debug("Recursive search testcases from %s ..." % p)
+                modules.extend(walk(p, self.recursive, ignore))
+            elif os.path.isfile(p) and p.endswith('.py'):
+                modules.append((os.path.basename(p).split('.')[0], p))
             else:
-                if os.path.isdir(p):
-                    # p = os.path.abspath(p)
-                    modules_list = []
-                    if self.recursive:
-                        log.debug("Recursive search testcases from %s ..." % p)
-                        for fpath, dirs, fs in os.walk(p):
-                            for f in [x for x in fs if x.endswith('.py')]:
-                                modules_list.append(os.path.join(fpath, f))
-                    else:
-                        for f in [
-                                x for x in os.listdir(p) if x.endswith('.py')]:
-                            modules_list.append(os.path.join(p, f))
-
-                    for m in modules_list:
-                        try:
-                            modules.append(imp.load_source(
-                                os.path.relpath(m, start=p).split(".")[0], m))
-                            log.debug("Testcase Module %s added", m)
-                        except BaseException:
-                            log.debug("Error loading script %s", m)
-
-                    self._module_path[p] = modules
-                elif os.path.isfile(p) and p.endswith('.py'):
-                    modules.append(imp.load_source(
-                        os.path.basename(p).split('.')[0], p))
-                    log.debug("Testcase Module %s added", p)
-                else:
-                    log.error("No valid python file or path specified.")
-                    raise SuiteException("No valid module")
-
-            # map each testcase subclasses in the modules
-            for m in modules:
-                for name, c in inspect.getmembers(m, inspect.isclass):
-                    # skip classes defined in other modules
-                    if c.__module__ != m.__name__:
-                        continue
-                    try:
-                        anc = inspect.getmro(c)
-                    except BaseException:
-                        continue
-                    cname = ":".join([c.__module__, name])
-                    log.debug("%s inspected" % cname)
-                    # The second generation of ancestors is Testcase
-                    if (len(anc) > 2) and (anc[-2].__name__ == "Testcase"):
-                        if cname in self._case_class:
-                            log.warn(
-                                "Duplicate testcase found and ignored: %s" %
-                                cname)
-                        else:
-                            log.info("Testcase %s found", cname)
-                            self._case_class[cname] = c
+                log.error("No valid python file or path specified.")
+                raise SuiteException("No valid module")
+        walk_sec = time.time() - start
+
+        index = DiscoveryIndex.get(indexPath())
+        found, unknown = index.testcases(modules)
+        self._index = index
+        for cname, mname, path, entry in found:
+            if cname in self._case_class:
+                log.warn("Duplicate testcase found and ignored: %s" % cname)
+            else:
+                log.info("Testcase %s found at %s:%d, %d steps", cname, path, entry["line"], len(entry["steps"]))
+                self._case_class[cname] = None
+                self._case_module[cname] = (mname, path)
+                if index.topo(mname, cname.split(":")[-1]) is None:
+                    self._case_lib.add(cname)
+        # modules whose testcases are unknown until imported
+        start = time.time()
+        for mname, path in unknown:
+            m = self._importModule(mname, path)
+            if m is not None:
+                self._inspectModule(m)
+        import_sec = time.time() - start
+        try:
+            index.save()
+        except OSError as e:
+            log.warning("Unable to save discovery index %s: %s", index.path, e)
+        self.discovery = {"modules": len(modules), "parsed": index.misses, "unchanged": index.hits,
+                          "imported": len(unknown), "walk_sec": walk_sec, "scan_sec": index.scan_sec,
+                          "resolve_sec": index.resolve_sec, "import_sec": import_sec}
+        log.debug("Discovery: %(modules)d modules, %(parsed)d parsed, %(unchanged)d unchanged, "
+                  "%(imported)d imported", self.discovery)
         if len(self._case_class) == 0:
             log.debug("No testcase found from local folders!")
             return True
@@ -230,17 +298,113 @@ class Testsuite(object):
             log.info("%s cases found." % len(self._case_class))
             return True
 
+    def _importModule(self, name, path, quiet=True):
+        """Import a testcase module from its path once
+
+        :param quiet: log the error in debug level only if failed
+        :return: the module, None if failed
+        """
+        path = os.path.abspath(path)
+        if path in self._modules:
+            return self._modules[path]
+        if Testsuite.module_cache is not None and path in Testsuite.module_cache:
+            log.debug("Testcase Module %s not changed", path)
+            self._modules[path] = Testsuite.module_cache[path]
+            return self._modules[path]
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+            log.debug("Testcase Module %s added", path)
+        except BaseException:
+            if quiet:
+                log.debug("Error loading script %s", path, exc_info=True)
+            else:
+                log.exception("Error loading script %s", path)
+            del sys.modules[name]
+            module = None
+        self._modules[path] = module
+        if Testsuite.module_cache is not None and module is not None:
+            Testsuite.module_cache[path] = module
+        return module
+
+    @classmethod
+    def forgetModules(cls, paths, index=None):
+        """Forget the changed modules kept in `module_cache`, and those importing them directly or not, so that
+        they are imported again by the next testsuite
+
+        :param paths: paths of the changed files
+        :param index: the :class:`~chorus.discovery.DiscoveryIndex` by which the modules importing them are found
+        :return: count of the modules forgotten
+        """
+        paths = set(os.path.realpath(p) for p in paths)
+        names = index.affected(paths) if index is not None else set()
+        forgotten = 0
+        for path, m in list((cls.module_cache or {}).items()):
+            if os.path.realpath(path) in paths or m.__name__ in names:
+                del cls.module_cache[path]
+                forgotten += 1
+        # libraries under the script folders are imported again as well
+        for name in names:
+            sys.modules.pop(name, None)
+        return forgotten
+
+    def _inspectModule(self, m):
+        """Map each testcase subclass defined in an imported module"""
+        for name, c in inspect.getmembers(m, inspect.isclass):
+            # skip classes defined in other modules
+            if c.__module__ != m.__name__:
+                continue
+            try:
+                anc = inspect.getmro(c)
+            except BaseException:
+                continue
+            cname = ":".join([c.__module__, name])
+            log.debug("%s inspected" % cname)
+            # The second generation of ancestors is Testcase
+            if (len(anc) > 2) and (anc[-2].__name__ == "Testcase"):
+                if cname in self._case_class:
+                    log.warn(
+                        "Duplicate testcase found and ignored: %s" %
+                        cname)
+                else:
+                    log.info("Testcase %s found", cname)
+                    self._case_class[cname] = c
+
+    def _getCaseClass(self, t_case_name):
+        """Get a testcase class, importing its module on first use
+
+        :return: the class, None if not found
+        """
+        cls = self._case_class.get(t_case_name)
+        if cls is None and t_case_name in self._case_module:
+            mname, path = self._case_module.pop(t_case_name)
+            m = self._importModule(mname, path, quiet=False)
+            cls = getattr(m, t_case_name.split(":")[-1], None)
+            if not (inspect.isclass(cls) and issubclass(cls, Testcase)):
+                if m is not None:
+                    log.error("%s is not a testcase, unlike what the discovery index tells", t_case_name)
+                cls = None
+            self._case_class[t_case_name] = cls
+        return cls
+
     def addcase(self, t_case_name, **kwargs):
         """Add a single :class:`.testcase.Testcase` to testsuite
 
         :param str t_case_name: the name of the testcase
         :param kwargs: the testcase parameters
         """
-        if t_case_name not in self._case_class:
-            log.error("Test case not found: %s" % t_case_name)
-            return False
-        cls = self._case_class[t_case_name]
-        if cls.topo is None:
+        if t_case_name in self._case_lib:
+            # known without importing its module
+            topo = None
+        else:
+            cls = self._getCaseClass(t_case_name)
+            if cls is None:
+                log.error("Test case not found: %s" % t_case_name)
+                return False
+            topo = cls.topo
+        if topo is None:
             log.warn("--------------------------------------------------")
             log.warn(
                 "=== Test case %s does not have topo bind ==",
@@ -261,33 +425,91 @@ class Testsuite(object):
         log.info("--------------------------------------------------")
         return True
 
-    def _sortcase(self):
-        """sort cases according to keywords"""
-        topo_dict = {}
-        # sort according to topo
+    def selectChanged(self, since):
+        """Keep only the cases affected by changes, whose modules import changed modules directly or not,
+        see :meth:`~chorus.discovery.DiscoveryIndex.affected`. Cases not found by the discovery index are kept.
+
+        :param since: a git reference, seconds since the epoch, or a time in ISO format
+        :rtype: Booblean
+        """
+        folders = set()
+        for p in self.pathlist:
+            p = os.path.join(self.base_path, p)
+            folders.add(p if os.path.isdir(p) else os.path.dirname(p) or ".")
+        changed = changedFiles(since, sorted(folders), self._index)
+        if changed is None:
+            return False
+        self.selectAffected(changed, "since %s" % since)
+        return True
+
+    def selectAffected(self, changed, reason=""):
+        """Keep only the cases affected by changes of files, see :meth:`selectChanged`
+
+        :param changed: paths of the changed files
+        :param reason: what the changes are, for the log only
+        """
+        affected = self._index.affected(changed)
+        indexed = self._index.modules()
+        total = len(self.cases)
+        self.cases = [c for c in self.cases
+                      if c["t_case_class"].__module__ not in indexed or c["t_case_class"].__module__ in affected]
+        log.info("%d of %d cases affected by %d changed files %s", len(self.cases), total, len(changed), reason)
+
+    def shard(self, index, count, durations=None):
+        """Keep only the cases of a shard, so that a suite can be split across hosts.
+        Cases of the same topology are kept in the same shard, and so are their fixture chains. The assignment
+        is deterministic, topologies are assigned to the least loaded shard, the most costly first.
+
+        :param index: index of the shard, from 1 to `count`
+        :param count: count of shards
+        :param durations: {testcase class name: seconds} to balance shards by, case count by default
+        """
+        cost = {}
+        default = 1.0
+        if durations:
+            known = [durations[c["t_case_class_name"]] for c in self.cases
+                     if c["t_case_class_name"] in durations]
+            if known:
+                default = sum(known) / len(known)
         for c in self.cases:
-            t = c.get("topo")
-            if t in topo_dict:
-                topo_dict[t].append(c)
-            else:
-                topo_dict[t] = [c]
-        # sort cases in each topo according to fixture_chain, i.e. their parent
-        # class
-        for t in topo_dict.values():
-            # t.sort(lambda x,y: cmp(x['t_case_fx'], y['t_case_fx']))
-            t.sort(key=lambda x: x['t_case_fx'])
-        d = list(topo_dict.values())
-        # sort according to case number of each topo, the more cases the higher priority
-        # d.sort(lambda x,y: cmp(len(y), len(x)))
-        d.sort(key=lambda x: len(x))
-        self.cases = [c for sublist in d for c in sublist]
+            sec = durations.get(c["t_case_class_name"], default) if durations else 1.0
+            cost[c["topo"]] = cost.get(c["topo"], 0.0) + sec
+        loads = [0.0] * count
+        assigned = {}
+        for topo_name in sorted(cost, key=lambda t: (-cost[t], str(t))):
+            i = min(range(count), key=lambda k: (loads[k], k))
+            loads[i] += cost[topo_name]
+            assigned[topo_name] = i + 1
+        total = len(self.cases)
+        self.cases = [c for c in self.cases if assigned[c["topo"]] == index]
+        log.info("Shard %d/%d: %d of %d cases in %d topologies, estimated cost %.1f of %.1f",
+                 index, count, len(self.cases), total,
+                 len([t for t in assigned if assigned[t] == index]), loads[index - 1], sum(loads))
+
+    def _sortcase(self, order=None):
+        """Order cases to reduce topology initializations and fixture calls, see :mod:`chorus.scheduler`
+
+        :param order: an ordering policy of :data:`chorus.scheduler.ORDERS` by the history of former runs
+        """
+        if order and (self.history is None or not self.history.cases):
+            log.warn("No history of former runs to order cases by %s.", order)
+        cost = FixtureCost(self.fixture_durations)
+        naive = cost.estimate(self.cases)
+        self.cases = schedule(self.cases, order, self.history)
+        estimated = cost.estimate(self.cases)
+        log.info("Estimated fixture cost: %.1fs in %d init/clean calls with %d topology initializations, "
+                 "%.1fs in %d calls with %d initializations in load order",
+                 estimated[0], estimated[1], estimated[2], naive[0], naive[1], naive[2])
 
     def run(
             self,
             test=False,
             pause_on_fail=False,
             topo_only=False,
-            continue_on_fail=None):
+            continue_on_fail=None,
+            lazy_connect=None,
+            topo_workers=None,
+            order=None):
         """The main logic of running testcases
         Use dummy connection if test specified
 
@@ -295,6 +517,9 @@ class Testsuite(object):
         :param pause_on_fail: drop to pdb prompt on fail
         :param topo_only: just init topology. (do not run any cases, useful for device upgrade)
         :param continue_on_fail: global continue on fail config.
+        :param lazy_connect: global lazy topology devices config.
+        :param topo_workers: run cases of different topologies in this many worker processes at the same time.
+        :param order: order cases by the history of former runs, one of :data:`chorus.scheduler.ORDERS`.
         :return:
         """
         connection.dummy_conn = False
@@ -302,8 +527,12 @@ class Testsuite(object):
             # change connections to dummy
             connection.dummy_conn = True
             continue_on_fail = True
+        # event loop shared by async steps of all cases
+        Testcase._loop = asyncio.new_event_loop()
+        for w in self._writers:
+            w.open()
         # sort cases
-        self._sortcase()
+        self._sortcase(order)
         # case load callback
         self.callback("on_cases_load", self, self.cases)
 
@@ -313,6 +542,93 @@ class Testsuite(object):
         log.info("#" * 60)
         log.info("")
 
+        if topo_workers and int(topo_workers) > 1 and (pause_on_fail or topo_only):
+            log.warn("Topologies are run one by one to pause on fail or init topology only.")
+            topo_workers = None
+        if topo_workers and int(topo_workers) > 1:
+            finished = self._runTopoWorkers(int(topo_workers), continue_on_fail, lazy_connect)
+        else:
+            finished = self._runCases(pause_on_fail, topo_only, continue_on_fail, lazy_connect)
+
+        Testcase._loop.close()
+        Testcase._loop = None
+        shutdownProcessPool()
+        self._closeWriters()
+        if not finished:
+            self._dispatcher.shutdown()
+            return False
+        # callbacks of the cases are finished before reporting
+        self._dispatcher.drain()
+        # report callback
+        self.callback("on_report", self, self._case_results)
+        self._dispatcher.shutdown()
+        self._logCallbackTimes()
+
+        log.info("#" * 60)
+        log.info("### {:^52} ###".format("ALL TESTCASES FINISHED"))
+        log.info("### {:<52} ###".format(
+            "Totally {} cases".format(len(self.cases))))
+        for k in self._case_results:
+            log.info(
+                "### ++{:<50} ###".format("{}: {}".format(k, len(self._case_results[k]))))
+            case_list = [c for c in self._case_results[k]]
+            for case in case_list:
+                case_name = case.get('t_case_name')
+                case_log = getLogFile(case_name)
+                log.info(
+                    "###  |--{:<48} ###".format(link(case_name, case_log)))
+        log.info("### Log: {:<47} ###".format(getLogPath()))
+        log.info("#" * 60)
+
+        # close the log
+        closeLog()
+        rslt_keys = list(self._case_results.keys())
+        if len(rslt_keys) > 0:
+            for k in rslt_keys:
+                if k not in [Testcase.STATES[Testcase.PASS],
+                             Testcase.STATES[Testcase.SKIPPED]]:
+                    return False
+
+        return True
+
+    def _runCases(self, pause_on_fail, topo_only, continue_on_fail, lazy_connect):
+        """Run the cases one by one, refer to `run` for the parameters. A reference of the topology is taken for
+        each batch of cases on it, so that a topology is kept warm until its last batch, see
+        :meth:`~chorus.topo.Topo.release`.
+
+        :return: False if stopped on a testcase error
+        """
+        # {topology: count of the batches not finished}
+        self._topo_refs = {}
+        # {topology: initializer} of the next topologies initialized in background
+        self._initializers = {}
+        for indexes in self._topoGroups():
+            topo = Topo.__topos__.get(self.cases[indexes[0]]['topo'])
+            if topo is not None:
+                topo.acquire()
+                self._topo_refs[topo] = self._topo_refs.get(topo, 0) + 1
+        try:
+            return self._runCaseLoop(pause_on_fail, topo_only, continue_on_fail, lazy_connect)
+        finally:
+            # initialized in background but not run, i.e. stopped on an error
+            for topo, initializer in self._initializers.items():
+                try:
+                    initializer.result()
+                except BaseException:
+                    log.debug("Topology %s initialized in background failed", topo.name, exc_info=True)
+                topo.clean()
+            self._initializers = {}
+            # batches not run, i.e. stopped on an error
+            for topo, count in self._topo_refs.items():
+                if count:
+                    try:
+                        topo.release(count)
+                    except BaseException as e:
+                        log.exception("Topo cleanup exception: %s" % e)
+            Topo.waitCleaned()
+
+    def _runCaseLoop(self, pause_on_fail, topo_only, continue_on_fail, lazy_connect):
+        """Run the cases one by one, see `_runCases`"""
         cur_topo = None
         fixture_chain = []
         next_chain = []
@@ -340,17 +656,35 @@ class Testsuite(object):
                     t.result.rcode = state
                     self._add_case_result(c, state)
                     continue
+                if cur_topo.warm and connection.dummy_conn:
+                    # connected devices are not for dry runs
+                    cur_topo.clean()
+                reuse = cur_topo.warm
                 log.info("#" * 60)
                 log.info("### {:^52} ###".format(
-                    "Initializing Topology: %s" % topo_name))
+                    ("Reusing Warm Topology: %s" if reuse else "Initializing Topology: %s") % topo_name))
                 log.info("#" * 60)
                 log.info("")
-                fixture_chain = []
+                fixture_chain = self._reuseFixtures(cur_topo, c['t_case_fx']) if reuse else []
                 try:
-                    self.callback("before_topo_init", self, cur_topo)
-                    cur_topo.init(
-                        disconnected=not self._curcase.check_topo_devices)
-                    self.callback("on_topo_init", self, cur_topo)
+                    if not reuse:
+                        lazy, disconnected = self._topoConnecting(i, lazy_connect, topo_only)
+                        initializer = self._initializers.pop(cur_topo, None)
+                        if initializer is None:
+                            self.callback("before_topo_init", self, cur_topo)
+                            Topo.waitCleaned(cur_topo)
+                            cur_topo.init(disconnected=disconnected)
+                        else:
+                            waited = initializer.result()
+                            log.info("Topology %s initialized in background in %.1fs, %.1fs waited", topo_name,
+                                     initializer.end_sec - initializer.start_sec, waited)
+                        if lazy:
+                            cur_topo.prewarm(self._topoDevices(i, cur_topo))
+                        keepalive = Config().get_config("topo", "keepalive")
+                        if keepalive and not topo_only:
+                            cur_topo.keepalive(float(keepalive))
+                        self.callback("on_topo_init", self, cur_topo)
+                    cur_topo.hold()
                     if topo_only:
                         log.info("Test finished due to 'topo_only' mark set.")
                         removeLogFile(cname)
@@ -366,9 +700,12 @@ class Testsuite(object):
                     removeLogFile(cname)
                     break
             # check next chain
+            keep_fixtures = False
             if i == len(self.cases) - \
                     1 or self.cases[i + 1]['topo'] != topo_name:
-                next_chain = []
+                # fixtures shared with itself are kept for the next run
+                keep_fixtures = self.keep_fixtures and cur_topo.staysWarm()
+                next_chain = c['t_case_fx'] if keep_fixtures else []
             else:
                 next_chain = self.cases[i + 1]['t_case_fx']
 
@@ -391,11 +728,15 @@ class Testsuite(object):
             # override running state
             if continue_on_fail is not None:
                 tccls.c_continue_on_fail = continue_on_fail
+            # initialize the next topology while the last cases of this one run
+            if not topo_only:
+                self._pipelineTopo(i, cur_topo, lazy_connect)
             # before run callback
             self.callback("before_case_run", self, t)
             # run case
             r = t.run(pause_on_fail=pause_on_fail,
-                      fixture_chain=fixture_chain, next_chain=next_chain)
+                      fixture_chain=fixture_chain, next_chain=next_chain,
+                      rows=c.get("t_case_rows"))
             c["t_case_result"] = r
             state = r.rcode
             # after run callback
@@ -404,46 +745,214 @@ class Testsuite(object):
             if i == len(self.cases) - \
                     1 or self.cases[i + 1]['topo'] != topo_name:
                 try:
-                    cur_topo.clean()
+                    if keep_fixtures:
+                        cur_topo.fixtures = fixture_chain
+                    self._topo_refs[cur_topo] -= 1
+                    # clean up in background if the next topology does not wait for its devices
+                    next_topo = Topo.__topos__.get(self.cases[i + 1]['topo']) if i + 1 < len(self.cases) else None
+                    cur_topo.release(background=next_topo is not None and self._pipelining() and
+                                     not cur_topo.sharesDevices(next_topo))
                 except BaseException as e:
                     log.exception("Topo cleanup exception: %s" % e)
                     state = Testcase._tfvalue
 
             self._add_case_result(c, state)
             removeLogFile(cname)
+        return True
 
-        # report callback
-        self.callback("on_report", self, self._case_results)
+    def _topoConnecting(self, i, lazy_connect, topo_only):
+        """How devices of the topology of the case `i` are connected, refer to `run` for the parameters
 
-        log.info("#" * 60)
-        log.info("### {:^52} ###".format("ALL TESTCASES FINISHED"))
-        log.info("### {:<52} ###".format(
-            "Totally {} cases".format(len(self.cases))))
-        for k in self._case_results:
-            log.info(
-                "### ++{:<50} ###".format("{}: {}".format(k, len(self._case_results[k]))))
-            case_list = [c for c in self._case_results[k]]
-            for case in case_list:
-                case_name = case.get('t_case_name')
-                case_log = getLogFile(case_name)
-                log.info(
-                    "###  |--{:<48} ###".format(link(case_name, case_log)))
-        log.info("### Log: {:<47} ###".format(getLogPath()))
-        log.info("#" * 60)
+        :return: (prewarm the devices in background, initialize the topology disconnected)
+        """
+        tccls = self.cases[i]['t_case_class']
+        lazy = tccls.lazy_topo_devices
+        if lazy_connect is not None:
+            lazy = lazy_connect
+        lazy = lazy and tccls.check_topo_devices and not topo_only
+        return lazy, lazy or not tccls.check_topo_devices
 
-        # close the log
-        closeLog()
-        rslt_keys = list(self._case_results.keys())
-        if len(rslt_keys) > 0:
-            for k in rslt_keys:
-                if k not in [Testcase.STATES[Testcase.PASS],
-                             Testcase.STATES[Testcase.SKIPPED]]:
-                    return False
+    @staticmethod
+    def _pipelining():
+        """Count of the last cases of a topology, during which the next topology is initialized in background"""
+        return int(Config().get_config("topo", "pipeline") or 0)
+
+    def _pipelineTopo(self, i, cur_topo, lazy_connect):
+        """Start initializing the topology of the next batch in background, if the case `i` is one of the last
+        `topo.pipeline` cases of the current topology, and the next topology is neither warm, nor sharing devices
+        with the current one"""
+        pipeline = self._pipelining()
+        if pipeline <= 0:
+            return
+        j = i + 1
+        while j < len(self.cases) and self.cases[j]['topo'] == cur_topo.name:
+            j += 1
+        if j >= len(self.cases) or j - i > pipeline:
+            return
+        topo = Topo.__topos__.get(self.cases[j]['topo'])
+        if topo is None or topo.warm or topo in self._initializers or topo.sharesDevices(cur_topo):
+            return
+        _, disconnected = self._topoConnecting(j, lazy_connect, False)
+        log.info("Initializing topology %s in background", topo.name)
+        self.callback("before_topo_init", self, topo)
+        self._initializers[topo] = TopoInitializer(topo, disconnected)
+        self._initializers[topo].start()
+
+    def _reuseFixtures(self, topo, chain):
+        """Take over the fixtures kept initialized on a warm topology, as many as the fixture chain of the next
+        case starts with, the rest are cleaned up. A fixture is reused only if its init and clean are the same
+        functions, not reloaded since.
+
+        :return: the fixtures reused
+        """
+        keep = 0
+        for kept, fx in zip(topo.fixtures, chain):
+            if kept['name'] != fx['name'] or kept.get('init') is not fx.get('init') or \
+                    kept.get('clean') is not fx.get('clean'):
+                break
+            keep += 1
+        topo.cleanFixtures(keep)
+        fixture_chain, topo.fixtures = topo.fixtures, []
+        if fixture_chain:
+            log.info("Reusing fixtures kept on topology %s: %s", topo.name,
+                     ", ".join(fx['name'] for fx in fixture_chain))
+        return fixture_chain
+
+    def _topoGroups(self):
+        """Indexes of the sorted cases, grouped by topology"""
+        groups = []
+        for i, c in enumerate(self.cases):
+            if groups and self.cases[groups[-1][-1]]['topo'] == c['topo']:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+        return groups
+
+    def _runTopoWorkers(self, workers, continue_on_fail, lazy_connect):
+        """Run each topology group in a worker process, at most `workers` at the same time.
+        Workers log to files of their own, and send back each case result as it is settled,
+        which is then reported as if the case ran in this process.
+
+        :return: True
+        """
+        ctx = multiprocessing.get_context("fork")
+        pending = self._topoGroups()
+        # worker process: (case indexes, result pipe, None once it hit EOF)
+        running = {}
+        reported = set()
+        log.info("Running %d topologies in %d worker processes", len(pending), workers)
+        try:
+            while pending or running:
+                while pending and len(running) < workers:
+                    indexes = pending.pop(0)
+                    topo_name = self.cases[indexes[0]]['topo']
+                    reader, writer = ctx.Pipe(duplex=False)
+                    p = ctx.Process(target=self._runTopoGroup, name="Topo_%s" % topo_name,
+                                    args=(indexes, writer, continue_on_fail, lazy_connect))
+                    p.start()
+                    writer.close()
+                    running[p] = (indexes, reader)
+                    log.info("Topology %s started with %d cases in worker process %d",
+                             topo_name, len(indexes), p.pid)
+                waitConn([r for _, r in running.values() if r is not None] +
+                         [p.sentinel for p in running])
+                for p, (indexes, reader) in list(running.items()):
+                    # results sent right before exiting are still readable
+                    if reader is not None and not self._receiveResults(reader, reported):
+                        # the worker closed its end, only its exit is left to wait for
+                        reader.close()
+                        reader = None
+                        running[p] = (indexes, reader)
+                    if not p.is_alive():
+                        p.join()
+                        if reader is not None:
+                            reader.close()
+                        del running[p]
+                        self._finishTopoGroup(indexes, reported, p.exitcode)
+        except BaseException:
+            for p in running:
+                p.terminate()
+            raise
+        return True
+
+    def _receiveResults(self, reader, reported):
+        """Report the case results sent by a worker
 
+        :return: False if the worker closed the pipe, True otherwise
+        """
+        while reader.poll():
+            try:
+                i, name, result, rcode = pickle.loads(reader.recv_bytes())
+            except EOFError:
+                return False
+            c = self.cases[i]
+            c["t_case_name"] = name
+            c["t_case_result"] = result
+            reported.add(i)
+            self._add_case_result(c, rcode)
         return True
 
+    def _finishTopoGroup(self, indexes, reported, exitcode):
+        """Abort cases not reported by a worker which exited abnormally"""
+        topo_name = self.cases[indexes[0]]['topo']
+        log.info("Topology %s finished in worker process, exit code: %s", topo_name, exitcode)
+        if exitcode == 0:
+            return
+        for i in indexes:
+            if i in reported:
+                continue
+            c = self.cases[i]
+            result = Result(c["t_case_name"], rcode=Testcase._abortvalue)
+            result.failed_on.append({"step": "worker",
+                                     "desc": "Topology worker exited with code %s" % exitcode})
+            c["t_case_result"] = result
+            self._add_case_result(c, Testcase._abortvalue)
+
+    def _runTopoGroup(self, indexes, results, continue_on_fail, lazy_connect):
+        """Entry of topology worker processes"""
+        topo_name = self.cases[indexes[0]]['topo']
+        forkLog(topo_name)
+        self.cases = [self.cases[i] for i in indexes]
+        self._case_results = {}
+        self._writers = [_QueueWriter(results, self.cases, indexes)]
+        # reported by the main process
+        Testsuite._callback_points = dict(Testsuite._callback_points, on_report=[], on_case_result=[])
+        # the background thread of the main process is not forked
+        self._dispatcher = _CallbackDispatcher()
+        Testcase._loop = asyncio.new_event_loop()
+        try:
+            self._runCases(False, False, continue_on_fail, lazy_connect)
+        finally:
+            self._dispatcher.shutdown()
+            Testcase._loop.close()
+            Testcase._loop = None
+            shutdownProcessPool()
+            self._closeWriters()
+            closeLog()
+            results.close()
+
+    def _topoDevices(self, start, topo):
+        """Devices used by the cases sharing the topology from `start`, in order of use"""
+        names = []
+        for c in self.cases[start:]:
+            if c['topo'] != topo.name:
+                break
+            for d in c['t_case_class'].getTopoDevices(topo.devices):
+                if d not in names:
+                    names.append(d)
+        return names
+
     def _add_case_result(self, case, state_code):
-        """Store the case result to _case_results"""
+        """Store a summary of the case result to _case_results. The case keeps its arguments, fixtures and data
+        rows for later runs, but only the compact result, so that step results of finished cases are not kept
+        for the rest of the run."""
+        for w in self._writers:
+            try:
+                w.write(case, case.get("t_case_result"), state_code)
+            except Exception:
+                log.exception("Error writing result of %s to %s", case.get("t_case_name"), w.path)
+        self.callback("on_case_result", self, case, state_code)
+        summary = self._summarize(case)
         state = Testcase.STATES[state_code]
         log.info("#" * 60)
         log.info("### {:<52} ###".format(
@@ -452,9 +961,32 @@ class Testsuite(object):
         log.info("#" * 60)
         log.info("")
         if state in self._case_results:
-            self._case_results[state].append(case)
+            self._case_results[state].append(summary)
         else:
-            self._case_results[state] = [case]
+            self._case_results[state] = [summary]
+
+    def _closeWriters(self):
+        for w in self._writers:
+            try:
+                w.close()
+            except Exception:
+                log.exception("Error closing result file %s", w.path)
+
+    @staticmethod
+    def _summarize(case):
+        """Replace the result of a finished case by the compact one
+
+        :return: a summary of the case, with names, topology, arguments and the compact result
+        """
+        result = case.get("t_case_result")
+        if result is not None:
+            result = case["t_case_result"] = result.compact()
+        return {"t_case_name": case.get("t_case_name"),
+                "t_case_class_name": case.get("t_case_class_name"),
+                "t_case_class": case.get("t_case_class"),
+                "topo": case.get("topo"),
+                "kwargs": case.get("kwargs"),
+                "t_case_result": result}
 
     def callback(self, cb_point, *args):
         if cb_point not in Testsuite._callback_points:
@@ -462,11 +994,29 @@ class Testsuite(object):
                 "Error calling callback: no such callback point %s", cb_point)
             return False
         # call each callback in registration order
+        asynchronous = Testsuite._async_callbacks.get(cb_point, [])
         for cb in Testsuite._callback_points[cb_point]:
-            cb(*args)
+            if cb in asynchronous:
+                self._dispatcher.submit(cb_point, cb, args)
+            else:
+                self._dispatcher.call(cb_point, cb, args)
+
+    def _logCallbackTimes(self):
+        """Log the time taken by callbacks, those slower than `callback.slow` seconds at a time are warned"""
+        slow = float(Config().get_config("callback", "slow") or 1.0)
+        for key, t in sorted(self._dispatcher.times.items(), key=lambda item: -item[1]["total_sec"]):
+            detail = "%s: %d calls, %.3fs in total, %.3fs at most%s" % (
+                key, t["calls"], t["total_sec"], t["max_sec"], " in background" if t["async"] else "")
+            if t["max_sec"] >= slow:
+                log.warn("Slow callback %s", detail)
+            else:
+                log.debug("Callback %s", detail)
+        if self._dispatcher.blocked_sec:
+            log.warn("Run blocked %.3fs by a full queue of background callbacks, %d at most",
+                     self._dispatcher.blocked_sec, self._dispatcher.maxsize)
 
     @classmethod
-    def register_callback(cls, cb_point, callback):
+    def register_callback(cls, cb_point, callback, asynchronous=False):
         """register different callbackpoints for testsuite
 
         Current supported callbacks are:
@@ -476,9 +1026,21 @@ class Testsuite(object):
         * before_case_run: Called before each testcase run
         * on_case_run: Called after each testcase run
         * on_report: Called after each testcase run
+        * on_case_result: Called with the final result code of each testcase once settled
+
+        With `topo.pipeline` set to n, the next topology is initialized in background during the last n cases of a
+        topology. Its `before_topo_init` is then called before `before_case_run` of the first of these cases, not
+        after `on_case_run` of the last one, and its `on_topo_init` once its first case is about to run.
+
+        Asynchronous callbacks are called one by one in a background thread, in the order they are called, so that
+        slow ones, i.e. uploading results, do not hold the testcases. The run waits if `callback.queue_size` calls
+        are pending, and until all of them finished before `on_report`, and again after `on_report`. Dicts and
+        lists passed to them are copied, as case dicts keep only compact results once reported. Exceptions of
+        asynchronous callbacks are logged only. The time taken by all callbacks is logged after the run.
 
         :param cb_point: the callback point
         :param callback: the callback function
+        :param asynchronous: call the callback in background
         :rtype: bool
         """
         if cb_point not in cls._callback_points:
@@ -487,9 +1049,128 @@ class Testsuite(object):
                 cb_point)
             return False
         cls._callback_points[cb_point].append(callback)
+        if asynchronous:
+            cls._async_callbacks.setdefault(cb_point, []).append(callback)
+        return True
+
+    @classmethod
+    def unregister_callback(cls, cb_point, callback):
+        """Remove a callback registered by `register_callback`
+
+        :rtype: bool
+        """
+        if callback not in cls._callback_points.get(cb_point, []):
+            return False
+        cls._callback_points[cb_point].remove(callback)
+        if callback in cls._async_callbacks.get(cb_point, []):
+            cls._async_callbacks[cb_point].remove(callback)
         return True
 
 
+class _CallbackDispatcher(object):
+    """Call callbacks of a testsuite, asynchronous ones in a background thread started on first use, and record
+    the time taken by each callback
+
+    :param maxsize: max count of pending calls, `callback.queue_size` by default
+    """
+
+    def __init__(self, maxsize=None):
+        super(_CallbackDispatcher, self).__init__()
+        self.maxsize = int(maxsize or Config().get_config("callback", "queue_size") or 256)
+        # {"<callback point>:<callback name>": {"calls", "total_sec", "max_sec", "async"}}
+        self.times = {}
+        # seconds the run waited for a full queue
+        self.blocked_sec = 0.0
+        self._queue = queue.Queue(self.maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def call(self, cb_point, cb, args, asynchronous=False):
+        """Call a callback and record the time taken"""
+        start = time.time()
+        try:
+            cb(*args)
+        finally:
+            self._record(cb_point, cb, time.time() - start, asynchronous)
+
+    def submit(self, cb_point, cb, args):
+        """Call a callback in background, waiting if the queue is full"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name="Callbacks", daemon=True)
+            self._thread.start()
+        args = tuple(type(a)(a) if type(a) in (dict, list) else a for a in args)
+        start = time.time()
+        self._queue.put((cb_point, cb, args))
+        waited = time.time() - start
+        if waited > 0.01:
+            self.blocked_sec += waited
+
+    def drain(self):
+        """Wait until all pending calls finished"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def shutdown(self):
+        """Finish pending calls and stop the background thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                cb_point, cb, args = item
+                try:
+                    self.call(cb_point, cb, args, asynchronous=True)
+                except Exception:
+                    log.exception("Error in callback %s on %s", _callbackName(cb), cb_point)
+            finally:
+                self._queue.task_done()
+
+    def _record(self, cb_point, cb, sec, asynchronous):
+        with self._lock:
+            t = self.times.setdefault("%s:%s" % (cb_point, _callbackName(cb)),
+                                      {"calls": 0, "total_sec": 0.0, "max_sec": 0.0, "async": asynchronous})
+            t["calls"] += 1
+            t["total_sec"] += sec
+            t["max_sec"] = max(t["max_sec"], sec)
+
+
+def _callbackName(cb):
+    return "%s.%s" % (getattr(cb, "__module__", None) or "", getattr(cb, "__qualname__", None) or repr(cb))
+
+
+class _QueueWriter(ResultWriter):
+    """Send case results of a topology worker to the main process"""
+
+    def __init__(self, results, cases, indexes):
+        super(_QueueWriter, self).__init__(path="<main process>")
+        self.results = results
+        # index of each case in the main process
+        self._indexes = dict((id(c), i) for c, i in zip(cases, indexes))
+
+    def open(self):
+        pass
+
+    def write(self, case, result, rcode):
+        i = self._indexes[id(case)]
+        name = case.get("t_case_name")
+        try:
+            data = pickle.dumps((i, name, result, rcode), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            log.exception("Result of %s can not be sent, sending the summary", name)
+            data = pickle.dumps((i, name, result.compact(), rcode), pickle.HIGHEST_PROTOCOL)
+        # pickled once here, not again by the pipe
+        self.results.send_bytes(data)
+
+    def close(self):
+        pass
+
+
 class SuiteException(Exception):
     """Exception handling class for testsuite"""
 
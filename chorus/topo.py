@@ -6,9 +6,18 @@
 """
 Topology basic classes
 """
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+from . import connection
 from .log import log, getLog
 from .utils import load_yaml
 from .config import Config, loadClass
+from .device import DevicePrewarmer, DeviceKeepalive
+from .testcase import Testcase
 
 
 ############################
@@ -53,6 +62,15 @@ class Topo(object):
     """Base Topo class"""
     # stores all topologies for latter use
     __topos__ = {}
+    # {absolute path of topology file: (modification time, topology)}, to add a file only once
+    __files__ = {}
+    # keep devices connected when released, for the next run in the same process, set by `chorus serve` and
+    # `chorus run --watch`
+    keep_warm = False
+    # {topology name: topology} warm and not in use, the least recently used first, see `release`
+    __warm__ = OrderedDict()
+    # {topology: thread} cleaning up in background, see `waitCleaned`
+    __cleaning__ = {}
     #
     __toporeader = loadClass(Config().get_config("topo", "reader"))
 
@@ -71,6 +89,14 @@ class Topo(object):
         # manditory member
         self.devices = {}
         self.x_args = {}
+        self._prewarmer = None
+        self._keepalive = None
+        # initialized and not cleaned up since, thus reusable without initializing again
+        self.warm = False
+        # count of the batches of scripts to run on the topology, see `acquire`
+        self.refs = 0
+        # fixture chain entries left initialized by the last case run on the warm topology, see `cleanFixtures`
+        self.fixtures = []
         if self._validate():
             self._register()
         else:
@@ -112,13 +138,165 @@ class Topo(object):
                 self.x_args[k] = self.dict[k]
                 del(self.dict[k])
 
-    def clean(self):
+    def prewarm(self, names):
+        """Connect devices in background after a disconnected init,
+            devices not in names are left to be connected on their first command
+
+        :param names: device names in priority order
+        """
+        devices = [self.devices[n] for n in names if n in self.devices]
+        if not devices:
+            return
+        self.log.info("> Prewarming devices: %s", ", ".join(d.name for d in devices))
+        self._prewarmer = DevicePrewarmer(devices)
+        self._prewarmer.start()
+
+    def keepalive(self, interval):
+        """Probe idle device connections in background until the topology is cleaned up
+
+        :param interval: idle seconds before a connection is probed
+        """
+        self.log.info("> Keeping device connections alive every %s seconds", interval)
+        self._keepalive = DeviceKeepalive(self.devices.values(), interval)
+        self._keepalive.start()
+
+    def clean(self, thread=None):
         """Cleaning up topology,
             typically called after a batch of scripts with same topo finished
+
+        :param thread: name of the thread whose connections are closed, the current one by default
         """
         self.log.info("> Cleaning up topology %s", self.name)
+        Topo.__warm__.pop(self.name, None)
+        self.cleanFixtures()
+        if self._prewarmer:
+            self._prewarmer.stop()
+            self._prewarmer = None
+        if self._keepalive:
+            self._keepalive.stop()
+            self.log.info("> Keepalive: %d probes sent, %d connections revived",
+                          self._keepalive.sent, self._keepalive.revived)
+            self._keepalive = None
         for d in self.devices.values():
-            d.disconnect()
+            d.disconnect(thread=thread)
+        self.warm = False
+
+    def acquire(self, count=1):
+        """Take references of the topology for batches of scripts about to run on it, so that it is kept warm
+        in between, see :meth:`release`
+
+        :param count: count of the batches
+        """
+        self.refs += count
+
+    def hold(self):
+        """Mark the topology initialized, or reused, for a batch of scripts. It is out of the warm topologies not
+        in use while the batch runs, thus not cleaned up for others."""
+        self.warm = True
+        Topo.__warm__.pop(self.name, None)
+
+    def staysWarm(self, count=1):
+        """Whether the topology is kept warm once `count` references are released, never for dry runs"""
+        return (self.refs > count or Topo.keep_warm) and not connection.dummy_conn
+
+    def release(self, count=1, background=False):
+        """Release references of the topology after batches of scripts with same topo finished.
+        It is kept warm for the batches referring to it later, and for the next run in the same process if
+        :attr:`keep_warm`, otherwise cleaned up. At most `topo.warm_max` topologies not in use are kept warm, the
+        least recently used ones are cleaned up beyond.
+
+        :param count: count of the batches finished, or not to run
+        :param background: clean up in background, see :meth:`waitCleaned`
+        """
+        stays = self.staysWarm(count)
+        self.refs = max(0, self.refs - count)
+        if not self.warm:
+            return
+        if stays:
+            self.log.info("> Keeping topology %s warm, %d batches to run on it", self.name, self.refs)
+            Topo.__warm__.pop(self.name, None)
+            Topo.__warm__[self.name] = self
+            Topo._evictWarm()
+        elif background:
+            # not reusable from now on
+            self.warm = False
+            Topo.__warm__.pop(self.name, None)
+            cleaner = threading.Thread(target=self._cleanQuietly, name="Clean_%s" % self.name,
+                                       args=(threading.currentThread().name,))
+            cleaner.daemon = True
+            Topo.__cleaning__[self] = cleaner
+            cleaner.start()
+        else:
+            self.clean()
+
+    def _cleanQuietly(self, thread):
+        try:
+            self.clean(thread=thread)
+        except BaseException:
+            log.exception("Topo cleanup exception: %s" % self.name)
+
+    @classmethod
+    def waitCleaned(cls, topo=None):
+        """Wait for the topologies cleaning up in background
+
+        :param topo: wait only for the topology and those sharing devices with it, all by default
+        """
+        for t, cleaner in list(cls.__cleaning__.items()):
+            if topo is None or t is topo or t.sharesDevices(topo):
+                cleaner.join()
+                cls.__cleaning__.pop(t, None)
+
+    def deviceTargets(self):
+        """Where the devices of the topology are reached, to tell whether topologies share devices, before they
+        are initialized. Implemented in subclasses
+
+        :return: a set of hashable targets, None if unknown
+        """
+        return None
+
+    def sharesDevices(self, other):
+        """Whether the topology may share devices with another one, assumed so if the targets are unknown"""
+        mine, others = self.deviceTargets(), other.deviceTargets()
+        return mine is None or others is None or bool(mine & others)
+
+    @classmethod
+    def _evictWarm(cls):
+        """Clean up the least recently used warm topologies beyond `topo.warm_max`"""
+        limit = Config().get_config("topo", "warm_max")
+        limit = 4 if limit is None else int(limit)
+        while len(cls.__warm__) > limit:
+            _, topo = cls.__warm__.popitem(last=False)
+            topo.log.info("> Topology %s is the least recently used of more than %d warm ones", topo.name, limit)
+            try:
+                topo.clean()
+            except BaseException:
+                log.exception("Topo cleanup exception: %s" % topo.name)
+
+    def cleanFixtures(self, keep=0):
+        """Clean up the fixtures kept initialized on the topology, the latest first
+
+        :param keep: count of fixtures at the head of the chain not to clean up
+        """
+        while len(self.fixtures) > keep:
+            fx = self.fixtures.pop()
+            if 'clean' not in fx:
+                continue
+            self.log.info("> Calling clean of kept fixture %s", fx['name'])
+            try:
+                Testcase._invoke(fx['clean'], fx['case'])
+            except BaseException:
+                self.log.exception("Error cleaning up kept fixture %s", fx['name'])
+
+    @classmethod
+    def cleanWarm(cls):
+        """Clean up all the topologies kept warm"""
+        cls.waitCleaned()
+        for topo in list(cls.__topos__.values()):
+            if topo.warm:
+                try:
+                    topo.clean()
+                except BaseException:
+                    log.exception("Topo cleanup exception: %s" % topo.name)
 
     @classmethod
     def getTopo(cls, name):
@@ -131,7 +309,19 @@ class Topo(object):
 
     @classmethod
     def addTopo(cls, uri):
-        """Manage all aviable topologies"""
+        """Manage all aviable topologies, a file is added again only if modified since added"""
+        path = os.path.abspath(uri)
+        mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+        if path in cls.__files__:
+            added, topo = cls.__files__.pop(path)
+            if mtime is not None and added == mtime:
+                log.debug("Topology file %s not modified" % uri)
+                cls.__files__[path] = (added, topo)
+                return
+            log.info("Topology file %s modified, replacing topology %s" % (uri, topo.name))
+            if topo.warm:
+                topo.clean()
+            cls.__topos__.pop(str(topo.name), None)
         log.info("Adding topology file %s" % uri)
         reader = cls.__toporeader(uri)
         topodict = reader.parse()
@@ -147,7 +337,53 @@ class Topo(object):
                 (topodict['type'], uri))
         else:
             # init and register
-            topocls(topodict)
+            topo = topocls(topodict)
+            if mtime is not None:
+                cls.__files__[path] = (mtime, topo)
+
+
+class TopoInitializer(threading.Thread):
+    """Initialize a topology in background, i.e. while the cases of the former topology run. Devices are connected
+    on behalf of the thread creating the initializer, which is the one running test steps, as
+    :class:`~chorus.device.DevicePrewarmer` does.
+
+    :param topo: the topology
+    :param disconnected: do not connect the devices
+    """
+
+    def __init__(self, topo, disconnected=False):
+        super(TopoInitializer, self).__init__(name="Init_%s" % topo.name)
+        self.daemon = True
+        self.topo = topo
+        self.disconnected = disconnected
+        self.owner = threading.currentThread().name
+        self.start_sec = time.time()
+        self.end_sec = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            # devices shared with topologies cleaning up are not ready yet
+            Topo.waitCleaned(self.topo)
+            self.topo.init(disconnected=True)
+            if not self.disconnected:
+                for d in self.topo.devices.values():
+                    d.connect(thread=self.owner)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        finally:
+            self.end_sec = time.time()
+
+    def result(self):
+        """Wait until the topology is initialized, raising the exception of the initialization if any
+
+        :return: seconds waited
+        """
+        start = time.time()
+        self.join()
+        if self._exc_info is not None:
+            raise self._exc_info[1].with_traceback(self._exc_info[2])
+        return time.time() - start
 
 
 ############################
@@ -7,14 +7,18 @@
 Utils
 """
 
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import sys
 import os
 import glob
 import json
+import time
+import tempfile
 import yaml
 
 from .log import log
+from .config import Config
 
 
 ##############################################
@@ -46,6 +50,135 @@ class ChorusThread(Thread):
         return self._return
 
 
+# The thread pool shared by all parallel substeps
+_executor = None
+# The thread pool sending commands of async steps, apart from substeps waiting for them
+_command_executor = None
+_executor_lock = Lock()
+DEFAULT_WORKERS = 32
+
+
+def getExecutor():
+    """Get the shared thread pool, sized by `substep_workers` of the testcase config"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = Config().get_config("testcase", "substep_workers")
+            _executor = ThreadPoolExecutor(max_workers=int(workers or DEFAULT_WORKERS))
+        return _executor
+
+
+def getCommandExecutor():
+    """Get the thread pool of awaitable commands, sized by `command_workers` of the testcase config.
+    It is separated from the substep pool, so that async substeps filling up that pool never wait for
+    commands queued behind them.
+    """
+    global _command_executor
+    with _executor_lock:
+        if _command_executor is None:
+            workers = Config().get_config("testcase", "command_workers")
+            _command_executor = ThreadPoolExecutor(max_workers=int(workers or DEFAULT_WORKERS))
+        return _command_executor
+
+
+def timedCall(target, *args, **kwargs):
+    """Call target and collect its return like `ChorusThread`, plus the start and end time"""
+    rslt = {"state": None, "exception": None, "start": time.time()}
+    try:
+        rslt["state"] = target(*args, **kwargs)
+    except BaseException:
+        rslt["exception"] = sys.exc_info()
+    rslt["end"] = time.time()
+    return rslt
+
+
+##############################################
+# Process pool
+# The process pool shared by offloaded functions
+_process_pool = None
+# str or bytes arguments larger than this are passed by file instead of pickled
+OFFLOAD_THRESHOLD = 1 << 20
+# ram based file system if available
+SHM_PATH = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def getProcessPool():
+    """Get the shared process pool, sized by `offload_workers` of the testcase config, cpu count by default"""
+    global _process_pool
+    with _executor_lock:
+        if _process_pool is None:
+            workers = Config().get_config("testcase", "offload_workers")
+            _process_pool = ProcessPoolExecutor(
+                max_workers=int(workers) if workers else None)
+        return _process_pool
+
+
+def shutdownProcessPool():
+    """Shutdown the shared process pool, it will be recreated on next use"""
+    global _process_pool
+    with _executor_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown()
+            _process_pool = None
+
+
+class FilePayload(object):
+    """A large str or bytes argument of an offloaded function, passed through a file under the ram based file
+    system instead of being pickled through the pool pipe"""
+
+    def __init__(self, data):
+        self.is_str = isinstance(data, str)
+        fd, self.path = tempfile.mkstemp(prefix="chorus_", dir=SHM_PATH)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data.encode('utf-8') if self.is_str else data)
+
+    def load(self):
+        """Read the data back, called in the worker process"""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        return data.decode('utf-8') if self.is_str else data
+
+    def release(self):
+        """Remove the file, called in the owner process"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _runOffloaded(func, args, kwargs):
+    """Worker side of `offload`, loads file payloads and calls the function"""
+    args = [a.load() if isinstance(a, FilePayload) else a for a in args]
+    kwargs = dict((k, v.load() if isinstance(v, FilePayload) else v)
+                  for k, v in kwargs.items())
+    return func(*args, **kwargs)
+
+
+def offload(func, *args, **kwargs):
+    """Run a picklable function in the shared process pool
+
+    :return: a future of the result
+    """
+    payloads = []
+
+    def wrap(arg):
+        if isinstance(arg, (str, bytes)) and len(arg) >= OFFLOAD_THRESHOLD:
+            payloads.append(FilePayload(arg))
+            return payloads[-1]
+        return arg
+
+    args = [wrap(a) for a in args]
+    kwargs = dict((k, wrap(v)) for k, v in kwargs.items())
+    try:
+        future = getProcessPool().submit(_runOffloaded, func, args, kwargs)
+    except BaseException:
+        for p in payloads:
+            p.release()
+        raise
+    future.add_done_callback(lambda f: [p.release() for p in payloads])
+    return future
+
+
 ##############################################
 # Reflection
 # attach a class to an object
@@ -114,6 +247,19 @@ def load_json(fileuri):
         fd.close()
 
 
+def dump_json(fileuri, obj):
+    """Write a dict into a json file, replaced at once so that it is not broken by a crash"""
+    fd, tmp = tempfile.mkstemp(prefix=".%s" % os.path.basename(fileuri),
+                               dir=os.path.dirname(os.path.abspath(fileuri)))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(obj, f)
+        os.replace(tmp, fileuri)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def load_yaml(fileuri):
     """Load yaml file into a dict"""
     fd = open(fileuri, 'r')
@@ -0,0 +1,234 @@
+# -*-coding: utf-8-*-
+#
+# Copyright (c) 2019 Chorus Team.
+#
+
+"""
+Script watching.
+
+`chorus run --watch` runs testcases, then waits for changes of the python modules in the script folders and runs
+the testcases affected by them again, until interrupted. Changes are watched by inotify on Linux, and by polling the
+modification times of the modules elsewhere, or if inotify is not available, i.e. out of watches or on network file
+systems. The backend and the polling interval are configured in the `watch` section of chorus.config.
+
+Saves of several files in a row, i.e. by an editor or a `git checkout`, are coalesced into one change, once nothing
+changes for `watch.settle` seconds.
+"""
+import os
+import re
+import errno
+import ctypes
+import ctypes.util
+import fnmatch
+import select
+import struct
+import time
+
+from .config import Config
+from .log import log
+from .discovery import walk
+
+# inotify(7)
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF
+_EVENT = struct.Struct("iIII")
+
+
+class Watcher(object):
+    """Base class of watchers of python modules in folders
+
+    :param folders: the folders to watch
+    :param recursive: watch sub folders as well
+    :param ignore: globs of folder names not to watch, see :func:`~chorus.discovery.walk`
+    """
+
+    def __init__(self, folders, recursive=False, ignore=()):
+        super(Watcher, self).__init__()
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.recursive = recursive
+        self.ignore = list(ignore)
+        self.settle = float(Config().get_config("watch", "settle") or 0.3)
+
+    def wait(self):
+        """Wait until modules change
+
+        :return: sorted paths of the modules changed, created or removed
+        """
+        changed = self._changes(None)
+        while True:
+            more = self._changes(self.settle)
+            if not more:
+                return sorted(changed)
+            changed |= more
+
+    def close(self):
+        """Release the resources of the watcher"""
+        pass
+
+    def _changes(self, timeout):
+        """Paths of the modules changed in `timeout` seconds, waiting for the first change if None,
+        implemented in subclasses"""
+        pass
+
+    def _modules(self):
+        return [path for folder in self.folders for _, path in walk(folder, self.recursive, self.ignore)]
+
+
+class PollWatcher(Watcher):
+    """Find changes by the modification time and size of the modules, every `watch.poll` seconds"""
+
+    def __init__(self, folders, recursive=False, ignore=()):
+        super(PollWatcher, self).__init__(folders, recursive, ignore)
+        self.interval = float(Config().get_config("watch", "poll") or 1.0)
+        self._stats = self._snapshot()
+
+    def _snapshot(self):
+        stats = {}
+        for path in self._modules():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def _changes(self, timeout):
+        start = time.time()
+        while True:
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+            stats = self._snapshot()
+            changed = set(p for p in set(stats) | set(self._stats) if stats.get(p) != self._stats.get(p))
+            self._stats = stats
+            if changed or (timeout is not None and time.time() - start >= timeout):
+                return changed
+
+
+class InotifyWatcher(Watcher):
+    """Find changes by inotify events of the folders, raising OSError if inotify is not available"""
+
+    def __init__(self, folders, recursive=False, ignore=()):
+        super(InotifyWatcher, self).__init__(folders, recursive, ignore)
+        self._pruned = re.compile("|".join(fnmatch.translate(g) for g in ignore)) if ignore else None
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify not supported")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # {watch descriptor: folder}
+        self._watches = {}
+        # modules known to exist, to tell those gone with a folder deleted or moved away
+        self._known = set()
+        try:
+            for folder in self.folders:
+                self._watchTree(folder)
+        except OSError:
+            self.close()
+            raise
+        self._known.update(self._modules())
+
+    def _watchTree(self, root):
+        """Watch a folder, and its sub folders if recursive"""
+        stack = [root]
+        while stack:
+            folder = stack.pop()
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), _IN_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, "Unable to watch %s: %s" % (folder, os.strerror(err)))
+            self._watches[wd] = folder
+            if not self.recursive:
+                continue
+            try:
+                stack.extend(e.path for e in os.scandir(folder) if e.is_dir(follow_symlinks=False) and
+                             (self._pruned is None or not self._pruned.match(e.name)))
+            except OSError as e:
+                log.debug("Error listing %s: %s", folder, e)
+
+    def _unwatchTree(self, root):
+        """Stop watching a folder deleted or moved away, and its sub folders
+
+        :return: the modules known under the folder
+        """
+        prefix = os.path.join(root, "")
+        for wd, folder in list(self._watches.items()):
+            if folder == root or folder.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+        gone = set(p for p in self._known if p.startswith(prefix))
+        self._known -= gone
+        return gone
+
+    def _changes(self, timeout):
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, size = _EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + size].rstrip(b"\0"))
+                offset += _EVENT.size + size
+                if mask & _IN_Q_OVERFLOW:
+                    log.warn("Too many changes to watch one by one, taking all modules as changed.")
+                    self._known = set(self._modules())
+                    changed.update(self._known)
+                    continue
+                if mask & _IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                folder = self._watches.get(wd)
+                if folder is None or not name:
+                    continue
+                path = os.path.join(folder, name)
+                if mask & _IN_ISDIR:
+                    if mask & (_IN_CREATE | _IN_MOVED_TO) and self.recursive and \
+                            (self._pruned is None or not self._pruned.match(name)):
+                        try:
+                            self._watchTree(path)
+                        except OSError as e:
+                            log.warn("%s, changes there are not watched.", e)
+                        added = set(p for _, p in walk(path, True, self.ignore))
+                        self._known |= added
+                        changed |= added
+                    elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                        # moved back in or not, the folder is watched again by its own event
+                        changed |= self._unwatchTree(path)
+                elif name.endswith(".py"):
+                    if mask & (_IN_DELETE | _IN_MOVED_FROM):
+                        self._known.discard(path)
+                    else:
+                        self._known.add(path)
+                    changed.add(path)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def getWatcher(folders, recursive=False, ignore=()):
+    """Get a watcher of the backend configured by `watch.backend`: `inotify`, `poll`, or `auto` to fall back to
+    polling if inotify is not available
+    """
+    backend = Config().get_config("watch", "backend") or "auto"
+    if backend != "poll":
+        try:
+            return InotifyWatcher(folders, recursive, ignore)
+        except (OSError, AttributeError) as e:
+            if backend == "inotify":
+                raise
+            log.info("Watching by polling, inotify not available: %s", e)
+    return PollWatcher(folders, recursive, ignore)